@@ -6,7 +6,48 @@
 from __future__ import division
 from __future__ import print_function
 
-from .functions.slideseg import run
+import sys
+from importlib import import_module
+
+# the objects are imported at their first use (e.g. the Snakefile imports
+# SlideSeg.pipeline without loading OpenCV and PIL)
+_OBJECTS = {
+  'run'             : '.functions.slideseg',
+  'iter_chips'      : '.functions.slideseg',
+  'PatchReader'     : '.functions.reader',
+  'HeatmapStitcher' : '.functions.stitching',
+  'ChipStatistics'  : '.functions.statistics',
+  'ChipSampler'     : '.functions.sampling',
+  'ChipPlan'        : '.functions.chipplan',
+  'LabelRaster'     : '.functions.labelraster',
+  'NeighborIndex'   : '.functions.knn',
+}
+
+
+def __getattr__ (name):
+  '''
+  Imports the objects of the package on demand
+  '''
+  if name in _OBJECTS:
+    obj = getattr(import_module(_OBJECTS[name], __name__), name)
+    globals()[name] = obj
+    return obj
+
+  raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+
+
+def __dir__ ():
+  '''
+  Lists the objects of the package (also the ones not imported yet)
+  '''
+  return sorted(set(globals()) | set(_OBJECTS))
+
+
+# (module __getattr__ requires python 3.7)
+if sys.version_info < (3, 7):
+  for _name in _OBJECTS:
+    __getattr__(_name)
+
 
 __all__ = ['SlideSeg']
 
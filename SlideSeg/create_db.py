@@ -1,79 +1,201 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
+from __future__ import division
+
 import os
 import cv2
 import pickle
+import shutil
 import argparse
+import tempfile
 import pandas as pd
 from glob import glob
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
 
+COLUMNS = ['svs', 'file', 'patch']
+
+
 def parse_args ():
 
   description = 'Histological DB creator'
 
   parser = argparse.ArgumentParser(description=description)
 
-  parser.add_argument('--svs_folder', required=True, type=str, action='store', help='Path to the SVS files')
+  parser.add_argument('--svs_folder', required=True,  type=str, action='store', help='Path to the SVS files')
+  parser.add_argument('--output',     required=False, type=str, action='store', default='Melanoma_db.csv', help='Output DB filename')
+  parser.add_argument('--workers',    required=False, type=int, action='store', default=1,     help='Number of slides processed in parallel (processes)')
+  parser.add_argument('--threads',    required=False, type=int, action='store', default=4,     help='Number of threads decoding the patches of each slide')
+  parser.add_argument('--chunksize',  required=False, type=int, action='store', default=10000, help='Number of counter rows read (and patches decoded) at once')
+  parser.add_argument('--resume',     required=False, action='store_true', default=False,     help='Keep the slides already written by a previous (interrupted) run')
 
   args = parser.parse_args()
 
   params = {
-              'svs'    : args.svs_folder,
-              'format' : '{0}_output/{0}.csv'
+              'svs'       : args.svs_folder,
+              'format'    : '{0}_output/{0}.csv',
+              'output'    : args.output,
+              'workers'   : args.workers,
+              'threads'   : args.threads,
+              'chunksize' : args.chunksize,
+              'resume'    : args.resume,
             }
 
   return params
 
-if __name__ == '__main__':
+
+def readpatch (filename):
+  '''
+  Reads a patch in RGB fmt and returns its pickle version
+  '''
+  img = cv2.imread(filename, cv2.IMREAD_COLOR)
+  img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+  return pickle.dumps(img)
+
+
+def slide_rows (file, params):
+  '''
+  Writes the DB rows of the pure-melanoma patches of a slide into a temporary part file
+
+  Parameters
+  ----------
+    file : str
+      Slide name (without extension)
+
+    params : dict
+      Parameters of the DB creation (see parse_args)
+
+  Returns
+  -------
+    (file, part, npatches) : tuple
+      Slide name, path of the part file and number of its rows
+
+  Notes
+  -----
+  The counter file is read in chunks and the patches of each chunk are
+  decoded by a pool of threads (cv2 releases the GIL), so the memory used
+  by a slide is bounded by the chunk size and not by its number of patches.
+  '''
+  # fill the format string with the current infos
+  fmt = params['format'].format(file)
+  # re-create the counter filename
+  counter_file = os.path.join(params['svs'], fmt)
+  patch_dir = os.path.join(params['svs'], '{}_output'.format(file), 'image_chips')
+
+  output_dir = os.path.dirname(os.path.abspath(params['output']))
+  fd, part = tempfile.mkstemp(dir=output_dir, prefix='.{}_'.format(file), suffix='.part')
+
+  try:
+    npatches = _write_rows(file, counter_file, patch_dir, fd, params)
+  except BaseException:
+    os.remove(part)
+    raise
+
+  return (file, part, npatches)
+
+
+def _write_rows (file, counter_file, patch_dir, fd, params):
+  '''
+  Writes the DB rows of a slide into the (open) part file and returns their number
+  '''
+  npatches = 0
+
+  with os.fdopen(fd, 'w', encoding='utf-8', newline='') as out, ThreadPool(params['threads']) as pool:
+
+    # read the csv counter file
+    for data in pd.read_csv(counter_file, sep=',', header=0, chunksize=params['chunksize']):
+      # filter the counter according to the following query
+      melanoma = data[(data['extra-tissue']     == 0) &
+                      (data['background']       == 0) &
+                      (data['nevo-benigno']     == 0) &
+                      (data['melanoma-maligno'] == 1)
+                      ]
+
+      # re-create the right filename location and decode the patches (in order)
+      patches = pool.map(readpatch, [os.path.join(patch_dir, f) for f in melanoma['Filename']])
+
+      rows = pd.DataFrame([('{}.svs'.format(file), f, p) for f, p in zip(melanoma['Filename'], patches)], columns=COLUMNS)
+      rows.to_csv(out, sep=',', header=False, index=False)
+      npatches += len(rows)
+
+  return npatches
+
+
+def _slide_rows (args):
+  '''
+  Unpacks the arguments of slide_rows for the process pool
+  '''
+  return slide_rows(*args)
+
+
+def readprogress (progress_file):
+  '''
+  Reads the slides already written in the DB and the DB size after the last one
+  '''
+  done, offset = [], None
+
+  if os.path.isfile(progress_file):
+    with open(progress_file, 'r', encoding='utf-8') as fp:
+      for row in fp.read().splitlines():
+        file, size = row.rsplit(',', 1)
+        done.append(file)
+        offset = int(size)
+
+  return (done, offset)
+
+
+def main ():
 
   params = parse_args()
 
   # list all the SVS files into the given folder
   svs = glob(os.path.join(params['svs'], '*.{}'.format('svs')))
-  # extract the file name (without extension) from the file list
-  files = [os.path.splitext(os.path.basename(x))[0] for x in svs]
+  # extract the file name (without extension) from the file list (in a fixed order, so that a run can be resumed)
+  files = sorted(os.path.splitext(os.path.basename(x))[0] for x in svs)
 
-  # final DB obj
-  db = []
+  # the completed slides and the DB size after each of them
+  progress_file = '{}.progress'.format(params['output'])
+  done, offset = readprogress(progress_file) if params['resume'] else ([], None)
 
-  for file in files:
+  if done and os.path.isfile(params['output']) and os.path.getsize(params['output']) >= offset:
+    # drop the rows of a slide interrupted by a crash
+    with open(params['output'], 'r+b') as out:
+      out.truncate(offset)
+    print('Resuming after {} slides'.format(len(done)))
 
-    # fill the format string with the current infos
-    fmt = params['format'].format(file)
-    # re-create the counter filename
-    counter_file = os.path.join(params['svs'], fmt)
+  else:
+    done = []
+    # write the header of the DB
+    pd.DataFrame(columns=COLUMNS).to_csv(params['output'], sep=',', header=True, index=False)
+    open(progress_file, 'w', encoding='utf-8').close()
 
-    # read the csv counter filen
-    data = pd.read_csv(counter_file, sep=',', header=0)
-    # filter the counter accordin to the following query
-    melanoma = data[(data['extra-tissue']     == 0) &
-                    (data['background']       == 0) &
-                    (data['nevo-benigno']     == 0) &
-                    (data['melanoma-maligno'] == 1)
-                    ]
-    print('Found {} pure-melanoma patches in {}.svs'.format(len(melanoma), file))
+  todo = [file for file in files if file not in set(done)]
 
-    # for each filename extracted from the counter db
-    for f in melanoma['Filename']:
+  with Pool(params['workers']) as pool, open(params['output'], 'ab') as out, open(progress_file, 'a', encoding='utf-8') as progress:
 
-      # re-create the right filename location
-      filename = os.path.join(params['svs'],
-                              '{}_output'.format(file),
-                              'image_chips', f)
-      # import the image into RGB fmt
-      img = cv2.imread(filename, cv2.IMREAD_COLOR)
-      img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    # the slides are processed in parallel, but they are appended to the DB in order as soon as they are ready
+    for file, part, npatches in pool.imap(_slide_rows, ((file, params) for file in todo)):
 
-      # append to the final DB some infos and the pickle version of the current image
-      db.append(('{}.svs'.format(file), f, pickle.dumps(img)))
+      print('Found {} pure-melanoma patches in {}.svs'.format(npatches, file))
 
-  # convert the dataset into a Pandas DB
-  db = pd.DataFrame(db, columns=['svs', 'file', 'patch'])
+      with open(part, 'rb') as fp:
+        shutil.copyfileobj(fp, out)
+      os.remove(part)
 
-  # dump the DB for next processing steps
-  db.to_csv('Melanoma_db.csv', sep=',', header=True, index=False)
+      # the slide is recorded as completed only when its rows are on disk
+      out.flush()
+      os.fsync(out.fileno())
+      progress.write('{},{:d}\n'.format(file, out.tell()))
+      progress.flush()
+
+  os.remove(progress_file)
+
+
+if __name__ == '__main__':
 
+  main()
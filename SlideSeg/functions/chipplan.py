@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import json
+import numpy as np
+from collections import OrderedDict
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# one record for each planned chip: bit k of labels is set if the chip includes the k-th annotation key
+CHIP_DTYPE = np.dtype([('level', np.uint8), ('col', np.int32), ('row', np.int32), ('labels', np.uint64)])
+
+# maximum number of annotation keys of a plan
+MAX_KEYS = 64
+
+
+class ChipPlan (object):
+
+  def __init__ (self, chips=None, keys=(), dims=((1, 1), ), basename='', suffix='png'):
+    '''
+    Compact plan of the chips of a slide
+
+    Parameters
+    ----------
+      chips : array_like
+        Structured array of chips with CHIP_DTYPE (level, col, row, labels)
+
+      keys : list
+        Annotation keys, in the order of the label bits
+
+      dims : list
+        Dimension (width, height) of each level of the slide
+
+      basename : str
+        Prefix of the chip names
+
+      suffix : str
+        Extension of the chip names
+
+    Notes
+    -----
+    The plan stores 17 bytes for each chip: the chip names, keys and scale
+    factors are generated only when required (see name, chip and items),
+    so the plan of millions of chips can be kept in memory, saved as .npy
+    and memory-mapped by parallel workers.
+    '''
+    if len(keys) > MAX_KEYS:
+      raise ValueError('Too many annotation keys for a chip plan! Maximum {0}. Given {1}'.format(MAX_KEYS, len(keys)))
+
+    self.chips = np.empty(shape=(0, ), dtype=CHIP_DTYPE) if chips is None else chips
+    self.keys = list(keys)
+    self.dims = [tuple(map(int, dim)) for dim in dims]
+    self.basename = basename
+    self.suffix = suffix
+
+  def __len__ (self):
+    '''
+    Number of planned chips
+    '''
+    return len(self.chips)
+
+  def __getitem__ (self, index):
+    '''
+    Returns the plan of a subset of chips (slice, boolean mask or indexes)
+    '''
+    return ChipPlan(self.chips[index], self.keys, self.dims, self.basename, self.suffix)
+
+  def name (self, i):
+    '''
+    Returns the filename of the i-th chip
+    '''
+    level, col, row, _ = self.chips[i]
+    return '{0}_{1}_{2}_{3}.{4}'.format(self.basename, level, row, col, self.suffix)
+
+  def names (self):
+    '''
+    Generates the filenames of the chips
+    '''
+    for level, col, row, _ in self.chips.tolist():
+      yield '{0}_{1}_{2}_{3}.{4}'.format(self.basename, level, row, col, self.suffix)
+
+  def labelkeys (self, labels):
+    '''
+    Returns the annotation keys of a label bitmask (NONE if the chip has no annotation)
+    '''
+    labels = int(labels)
+    keys = [key for k, key in enumerate(self.keys) if labels >> k & 1]
+    return keys if keys else ['NONE']
+
+  def chip (self, i):
+    '''
+    Returns the keys, level, col, row and scale factors of the i-th chip
+    (the chip list expected by cropchip and cropcontext)
+    '''
+    level, col, row, labels = self.chips[i].tolist()
+    width, height = self.dims[level]
+    return [self.labelkeys(labels), level, col, row, self.dims[0][0] / width, self.dims[0][1] / height]
+
+  def items (self):
+    '''
+    Generates the (name, chip) pair of each chip, as the items of a dictionary
+    '''
+    for i in range(len(self.chips)):
+      yield (self.name(i), self.chip(i))
+
+  def imagelist (self):
+    '''
+    Returns the filenames of the chips which include each annotation key
+    (keys without chips are skipped)
+
+    Returns
+    -------
+      image_dict : OrderedDict
+        Annotation keys and generators of the corresponding chip filenames
+    '''
+    labels = self.chips['labels']
+    image_dict = OrderedDict()
+
+    for k, key in enumerate(self.keys):
+      index = np.flatnonzero(labels & np.uint64(1 << k))
+
+      if len(index):
+        image_dict[key] = (self.name(i) for i in index)
+
+    return image_dict
+
+  def sort (self):
+    '''
+    Returns the plan sorted by level, col and row (the scanning order of getchips)
+    '''
+    return self[np.argsort(self.chips, order=('level', 'col', 'row'), kind='stable')]
+
+  @classmethod
+  def concatenate (cls, plans):
+    '''
+    Concatenates the plans of different bands or shards of the same slide
+    '''
+    plans = list(plans)
+
+    if not plans:
+      return cls()
+
+    first = plans[0]
+    chips = np.concatenate([plan.chips for plan in plans]) if len(plans) > 1 else first.chips
+
+    return cls(chips, first.keys, first.dims, first.basename, first.suffix)
+
+  def save (self, filename):
+    '''
+    Writes the plan into a .npy file (the chips) and a .json file with the
+    same name (keys, dims, basename and suffix)
+
+    Parameters
+    ----------
+      filename : str
+        Output .npy filename
+
+    Returns
+    -------
+    None
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+    np.save(filename, self.chips)
+
+    with open('{0}.json'.format(os.path.splitext(filename)[0]), 'w', encoding='utf-8') as fp:
+      json.dump({'keys' : self.keys, 'dims' : self.dims, 'basename' : self.basename, 'suffix' : self.suffix}, fp, indent=2)
+
+  @classmethod
+  def load (cls, filename, mmap_mode='r'):
+    '''
+    Reads a plan written by save
+
+    Parameters
+    ----------
+      filename : str
+        Input .npy filename
+
+      mmap_mode : str
+        Memory-map mode of the chips (None loads them in memory)
+
+    Returns
+    -------
+      plan : ChipPlan
+        The loaded plan
+    '''
+    with open('{0}.json'.format(os.path.splitext(filename)[0]), 'r', encoding='utf-8') as fp:
+      meta = json.load(fp)
+
+    return cls(np.load(filename, mmap_mode=mmap_mode), meta['keys'], meta['dims'], meta['basename'], meta['suffix'])
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    return '<ChipPlan (chips: {0}, keys: {1}, levels: {2})>'.format(len(self.chips), len(self.keys), len(self.dims))
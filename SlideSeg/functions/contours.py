@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import cv2
+import hashlib
+import tempfile
+import numpy as np
+import xml.etree.ElementTree as ET
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def parsepoint (text):
+  '''
+  Converts the text of a point tag into integer coordinates
+
+  Parameters
+  ----------
+    text : str
+      Point coordinates in the Seeden Viewer fmt (e.g. '123.4, 567.8')
+
+  Returns
+  -------
+    (x, y) : tuple
+      Rounded coordinates (same rounding of round(eval(text)))
+  '''
+  x, y = text.strip().strip('()').split(',')
+  return (round(float(x)), round(float(y)))
+
+
+def parsecontours (xml_path):
+  '''
+  Reads xml (roi) file and converts its contours into compact arrays
+
+  Parameters
+  ----------
+    xml_path : str
+      Path to the xml file
+
+  Returns
+  -------
+    contours : dict
+      Dictionary with the 'names' (upper case) and 'colors' of the contours,
+      the int32 'points' of all the contours concatenated and the 'offsets'
+      of each contour into points (contour i is points[offsets[i] : offsets[i + 1]])
+  '''
+
+  # Import xml file and get root
+  tree = ET.parse(xml_path)
+  root = tree.getroot()
+
+  names, colors, points, offsets = [], [], [], [0]
+
+  # Find data in xml file
+  for reg in root.iter('contour'):
+    names.append(reg.get('name').upper())
+    colors.append(reg.get('color'))
+
+    points.extend(parsepoint(vert.text) for vert in reg.iter('point'))
+    offsets.append(len(points))
+
+  return {
+           'names'   : np.asarray(names, dtype=str),
+           'colors'  : np.asarray(colors, dtype=str),
+           'offsets' : np.asarray(offsets, dtype=np.int64),
+           'points'  : np.asarray(points, dtype=np.int32).reshape(-1, 2),
+         }
+
+
+def filedigest (filename, blocksize=1 << 20):
+  '''
+  Computes the sha1 digest of a file
+
+  Parameters
+  ----------
+    filename : str
+      Path to the file
+
+    blocksize : int
+      Number of bytes read at each step
+
+  Returns
+  -------
+    digest : str
+      Hexadecimal sha1 digest
+  '''
+  sha = hashlib.sha1()
+
+  with open(filename, 'rb') as fp:
+    for block in iter(lambda : fp.read(blocksize), b''):
+      sha.update(block)
+
+  return sha.hexdigest()
+
+
+def cachefilename (xml_path, cache_dir):
+  '''
+  Returns the filename of the contour cache of a xml file
+
+  Parameters
+  ----------
+    xml_path : str
+      Path to the xml file
+
+    cache_dir : str
+      Directory of the contour cache
+
+  Returns
+  -------
+    filename : str
+      Path of the .npz cache file
+  '''
+  name, _ = os.path.splitext(os.path.basename(xml_path))
+  return os.path.join(cache_dir, '{0}.npz'.format(name))
+
+
+def savecontours (filename, contours, xml_path):
+  '''
+  Writes the contour arrays into a .npz cache file
+
+  Parameters
+  ----------
+    filename : str
+      Path of the .npz cache file
+
+    contours : dict
+      Contour arrays as returned by parsecontours
+
+    xml_path : str
+      Path to the source xml file (its mtime, size and digest are stored as cache key)
+
+  Returns
+  -------
+  None
+
+  Notes
+  -----
+  The file is written in a temporary file and then moved in place, so
+  concurrent readers never see a partial cache.
+  '''
+  stat = os.stat(xml_path)
+  directory = os.path.dirname(os.path.abspath(filename))
+  os.makedirs(directory, exist_ok=True)
+
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+
+  with os.fdopen(fd, 'wb') as fp:
+    np.savez(fp, mtime=stat.st_mtime_ns, size=stat.st_size, sha1=filedigest(xml_path), **contours)
+
+  os.replace(tmp, filename)
+
+
+def loadcache (cache_file, xml_path):
+  '''
+  Loads the contour arrays of a .npz cache file if it is valid for the xml file
+
+  Parameters
+  ----------
+    cache_file : str
+      Path of the .npz cache file
+
+    xml_path : str
+      Path to the source xml file
+
+  Returns
+  -------
+    contours : dict
+      Contour arrays as returned by parsecontours (None if the cache is
+      missing or outdated)
+
+  Notes
+  -----
+  The cache is valid if the xml file has the same mtime and size stored in
+  the cache or, if they changed, the same sha1 digest.
+  '''
+  if cache_file is None or not os.path.isfile(cache_file):
+    return None
+
+  with np.load(cache_file) as data:
+    stat = os.stat(xml_path)
+
+    if (int(data['mtime']) == stat.st_mtime_ns and int(data['size']) == stat.st_size) or \
+        str(data['sha1']) == filedigest(xml_path):
+      return {key : data[key] for key in ('names', 'colors', 'offsets', 'points')}
+
+  return None
+
+
+def simplifytolerance (downsample=1., accuracy=.5):
+  '''
+  Returns the Douglas-Peucker tolerance of the contours rasterized at a slide level
+
+  Parameters
+  ----------
+    downsample : float
+      Size (in level 0 pixels) of the pixels of the rasterized level
+
+    accuracy : float
+      Maximum distance (in pixels of the rasterized level) between the
+      simplified and the original contours (less than 1 for sub-pixel accuracy)
+
+  Returns
+  -------
+    tolerance : float
+      Tolerance in level 0 pixels (the unit of the contour points)
+  '''
+  return float(accuracy) * float(downsample)
+
+
+def simplifycontours (contours, tolerance):
+  '''
+  Simplifies the contours with the Douglas-Peucker algorithm
+
+  Parameters
+  ----------
+    contours : dict
+      Contour arrays as returned by parsecontours
+
+    tolerance : float
+      Maximum distance (in level 0 pixels) between the simplified and the
+      original contours (see simplifytolerance)
+
+  Returns
+  -------
+    contours : dict
+      Contour arrays with the simplified points
+
+  Notes
+  -----
+  The simplified contours keep a subset of the original vertices. Contours
+  which would collapse to less than 3 vertices are kept unchanged.
+  '''
+  offsets = contours['offsets']
+  points = contours['points']
+
+  simplified, sizes = [], []
+
+  for start, stop in zip(offsets[:-1], offsets[1:]):
+    cnt = points[start : stop].reshape(-1, 1, 2)
+
+    if len(cnt) > 3:
+      approx = cv2.approxPolyDP(cnt, epsilon=tolerance, closed=True)
+      if len(approx) >= 3:
+        cnt = approx
+
+    simplified.append(cnt.reshape(-1, 2))
+    sizes.append(len(cnt))
+
+  contours = dict(contours)
+  contours['offsets'] = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]).astype(np.int64)
+  contours['points'] = np.concatenate(simplified).astype(np.int32) if simplified else points
+
+  return contours
+
+
+def readcontours (xml_path, cache_dir=None, cache_file=None, tolerance=None):
+  '''
+  Loads the contours of a xml file from its cache, parsing it only if required
+
+  Parameters
+  ----------
+    xml_path : str
+      Path to the xml file
+
+    cache_dir : str
+      Directory of the contour cache (None disables the cache)
+
+    cache_file : str
+      Explicit path of the .npz cache file (it overrides cache_dir)
+
+    tolerance : float
+      Douglas-Peucker tolerance of the contours (see simplifycontours, None
+      loads the original contours)
+
+  Returns
+  -------
+    contours : dict
+      Contour arrays as returned by parsecontours
+
+  Notes
+  -----
+  The cache is valid if the xml file has the same mtime and size stored in
+  the cache or, if they changed, the same sha1 digest.
+  The simplified contours of each tolerance (i.e. of each rasterized level)
+  are cached in their own file ({name}_tol{tolerance}.npz), next to the
+  original ones.
+  '''
+  if cache_file is None and cache_dir is not None:
+    cache_file = cachefilename(xml_path, cache_dir)
+
+  if tolerance:
+    simplified_file = None if cache_file is None else '{0}_tol{1:g}.npz'.format(os.path.splitext(cache_file)[0], tolerance)
+
+    contours = loadcache(simplified_file, xml_path)
+    if contours is not None:
+      return contours
+
+    contours = simplifycontours(readcontours(xml_path, cache_file=cache_file), tolerance)
+
+    if simplified_file is not None:
+      savecontours(simplified_file, contours, xml_path)
+
+    return contours
+
+  contours = loadcache(cache_file, xml_path)
+  if contours is not None:
+    return contours
+
+  contours = parsecontours(xml_path)
+
+  if cache_file is not None:
+    savecontours(cache_file, contours, xml_path)
+
+  return contours
+
+
+def itercontours (contours):
+  '''
+  Iterates over the cached contours
+
+  Parameters
+  ----------
+    contours : dict
+      Contour arrays as returned by parsecontours or readcontours
+
+  Returns
+  -------
+    iterator : generator
+      (name, color, points) of each contour, points with shape (-1, 1, 2) as required by cv2.fillPoly
+  '''
+  offsets = contours['offsets']
+  points = contours['points']
+
+  for name, color, start, stop in zip(contours['names'], contours['colors'], offsets[:-1], offsets[1:]):
+    yield (str(name), str(color), points[start : stop].reshape(-1, 1, 2))
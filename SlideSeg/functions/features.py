@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import cv2
+import json
+import tqdm
+import hashlib
+import numpy as np
+from functools import partial
+from collections import OrderedDict
+from multiprocessing import get_context
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# increase it when the implementation of a feature changes, so the cached matrices are invalidated
+FEATURES_VERSION = 1
+
+
+def graylevels (batch):
+  '''
+  Converts a batch of BGR images into float32 gray levels
+  '''
+  return batch[..., 0] * np.float32(.114) + batch[..., 1] * np.float32(.587) + batch[..., 2] * np.float32(.299)
+
+
+def color_moments (batch):
+  '''
+  Mean and standard deviation of each channel
+
+  Parameters
+  ----------
+    batch : array_like
+      float32 BGR images with shape (n, rows, cols, 3)
+
+  Returns
+  -------
+    features : array_like
+      Array with shape (n, 6)
+  '''
+  return np.concatenate((batch.mean(axis=(1, 2)), batch.std(axis=(1, 2))), axis=1)
+
+
+def color_hist (batch, bins=16):
+  '''
+  Normalized histogram of each channel
+
+  Parameters
+  ----------
+    batch : array_like
+      float32 BGR images with shape (n, rows, cols, 3)
+
+    bins : int
+      Number of bins of each channel
+
+  Returns
+  -------
+    features : array_like
+      Array with shape (n, 3 * bins)
+  '''
+  n, rows, cols, channels = batch.shape
+
+  # a single bincount for the whole batch: each (image, channel) pair has its own bins
+  index = (batch * (bins / 256.)).astype(np.int64).clip(0, bins - 1)
+  index += (np.arange(n * channels, dtype=np.int64) * bins).reshape(n, 1, 1, channels)
+
+  hist = np.bincount(index.ravel(), minlength=n * channels * bins).reshape(n, channels * bins)
+
+  return hist / (rows * cols)
+
+
+def texture (batch, bins=32):
+  '''
+  Texture statistics of the gray levels: mean and standard deviation of the
+  gradient magnitude, variance of the laplacian and entropy of the gray levels
+
+  Parameters
+  ----------
+    batch : array_like
+      float32 BGR images with shape (n, rows, cols, 3)
+
+    bins : int
+      Number of bins of the gray level histogram used by the entropy
+
+  Returns
+  -------
+    features : array_like
+      Array with shape (n, 4)
+  '''
+  gray = graylevels(batch)
+  n = len(gray)
+
+  gx = np.diff(gray, axis=2)[:, :-1, :]
+  gy = np.diff(gray, axis=1)[:, :, :-1]
+  magnitude = np.sqrt(gx**2 + gy**2)
+
+  laplacian = gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:] + gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] - 4 * gray[:, 1:-1, 1:-1]
+
+  index = (gray * (bins / 256.)).astype(np.int64).clip(0, bins - 1)
+  index += (np.arange(n, dtype=np.int64) * bins).reshape(n, 1, 1)
+  prob = np.bincount(index.ravel(), minlength=n * bins).reshape(n, bins) / gray[0].size
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    entropy = -np.where(prob > 0, prob * np.log2(prob), 0.).sum(axis=1)
+
+  return np.stack((magnitude.mean(axis=(1, 2)), magnitude.std(axis=(1, 2)), laplacian.var(axis=(1, 2)), entropy), axis=1)
+
+
+def fft (batch, bins=16):
+  '''
+  Radial profile of the log-magnitude of the gray level spectrum
+
+  Parameters
+  ----------
+    batch : array_like
+      float32 BGR images with shape (n, rows, cols, 3)
+
+    bins : int
+      Number of radial bins (from the zero frequency to the Nyquist one)
+
+  Returns
+  -------
+    features : array_like
+      Array with shape (n, bins)
+  '''
+  gray = graylevels(batch)
+  n, rows, cols = gray.shape
+
+  magnitude = np.log1p(np.abs(np.fft.rfft2(gray)))
+
+  fy = np.fft.fftfreq(rows).reshape(-1, 1)
+  fx = np.fft.rfftfreq(cols).reshape(1, -1)
+  radius = np.sqrt(fx**2 + fy**2) / np.sqrt(.5)
+  index = (radius * bins).astype(np.int64).clip(0, bins - 1).ravel()
+
+  counts = np.bincount(index, minlength=bins)
+  profile = np.stack([np.bincount(index, weights=m.ravel(), minlength=bins) for m in magnitude])
+
+  return profile / np.maximum(counts, 1)
+
+
+FEATURES = OrderedDict([('color_moments', color_moments),
+                        ('color_hist', color_hist),
+                        ('texture', texture),
+                        ('fft', fft),
+                       ])
+
+
+def featurespec (features=None):
+  '''
+  Normalizes the definition of a feature set
+
+  Parameters
+  ----------
+    features : list or dict
+      Feature names (default all the available features) or dictionary of
+      feature names and their keyword arguments (e.g. {'color_hist' : {'bins' : 8}})
+
+  Returns
+  -------
+    (spec, digest) : tuple
+      Ordered list of (name, kwargs) pairs and its hexadecimal sha1 digest
+      (it includes FEATURES_VERSION)
+  '''
+  if features is None:
+    features = list(FEATURES)
+
+  if not isinstance(features, dict):
+    features = {name : dict() for name in features}
+
+  spec = []
+  for name, kwargs in features.items():
+    if name not in FEATURES:
+      raise ValueError('Invalid feature {0}! Possible values are {1}'.format(name, ', '.join(FEATURES)))
+    spec.append((name, dict(sorted((kwargs or dict()).items()))))
+
+  digest = hashlib.sha1(json.dumps([FEATURES_VERSION, spec], sort_keys=True).encode('utf-8')).hexdigest()
+
+  return spec, digest
+
+
+def batchfeatures (filenames, spec):
+  '''
+  Computes the features of a batch of images
+
+  Parameters
+  ----------
+    filenames : list
+      Image filenames
+
+    spec : list
+      Feature set as returned by featurespec
+
+  Returns
+  -------
+    features : array_like
+      float32 array with shape (len(filenames), nfeatures)
+
+  Notes
+  -----
+  The images of the batch with the same shape are stacked and processed
+  together by vectorized numpy functions.
+  '''
+  images = [cv2.imread(f, cv2.IMREAD_COLOR) for f in filenames]
+
+  for f, img in zip(filenames, images):
+    if img is None:
+      raise IOError('Unable to read the image {0}'.format(f))
+
+  groups = OrderedDict()
+  for i, img in enumerate(images):
+    groups.setdefault(img.shape, []).append(i)
+
+  features = None
+
+  for shape, index in groups.items():
+    batch = np.stack([images[i] for i in index]).astype(np.float32)
+    values = np.concatenate([FEATURES[name](batch, **kwargs) for name, kwargs in spec], axis=1)
+
+    if features is None:
+      features = np.empty(shape=(len(images), values.shape[1]), dtype=np.float32)
+
+    features[index] = values
+
+  return features
+
+
+def filesignature (filename):
+  '''
+  Returns the (mtime, size) signature of a file
+  '''
+  stat = os.stat(filename)
+  return (stat.st_mtime_ns, stat.st_size)
+
+
+def computefeatures (names, directory, output_dir, features=None, batch_size=256, nprocs=None):
+  '''
+  Computes (or updates) the memory-mapped feature matrix of a set of patches
+
+  Parameters
+  ----------
+    names : list
+      Patch filenames, in the order of the chip index (e.g. the Filename column of the patches db)
+
+    directory : str
+      Directory of the patches
+
+    output_dir : str
+      Directory of the feature cache (features.npy, names.npy, signatures.npy and spec.json)
+
+    features : list or dict
+      Feature set (see featurespec)
+
+    batch_size : int
+      Number of patches processed by each task
+
+    nprocs : int
+      Number of processes (default all the available cpus)
+
+  Returns
+  -------
+    features : array_like
+      Read-only memory-mapped float32 matrix with shape (len(names), nfeatures),
+      row i holding the features of names[i]
+
+  Notes
+  -----
+  The rows of the previous cache are reused if the feature set is the same
+  and the patch file has the same mtime and size: only new or modified
+  patches are computed.
+  '''
+  spec, digest = featurespec(features)
+  names = [str(name) for name in names]
+
+  os.makedirs(output_dir, exist_ok=True)
+  feature_file = os.path.join(output_dir, 'features.npy')
+  names_file = os.path.join(output_dir, 'names.npy')
+  signature_file = os.path.join(output_dir, 'signatures.npy')
+  spec_file = os.path.join(output_dir, 'spec.json')
+
+  signatures = np.asarray([filesignature(os.path.join(directory, name)) for name in names], dtype=np.int64).reshape(-1, 2)
+
+  # rows of the previous cache still valid
+  cached = dict()
+  if all(os.path.isfile(f) for f in (feature_file, names_file, signature_file, spec_file)):
+
+    with open(spec_file, 'r', encoding='utf-8') as fp:
+      previous = json.load(fp)
+
+    if previous['digest'] == digest:
+      old_names = np.load(names_file)
+      old_signatures = np.load(signature_file)
+      cached = {str(name) : (i, tuple(sign)) for i, (name, sign) in enumerate(zip(old_names, old_signatures))}
+
+  reuse = [(i, cached[name][0]) for i, name in enumerate(names) if name in cached and cached[name][1] == tuple(signatures[i])]
+  todo = sorted(set(range(len(names))) - {i for i, _ in reuse})
+
+  print('Features: {0} cached, {1} to compute'.format(len(reuse), len(todo)))
+
+  # nothing changed
+  if not todo and len(cached) == len(names) and all(i == j for i, j in reuse):
+    return np.load(feature_file, mmap_mode='r')
+
+  # number of features from a sample patch
+  nfeatures = batchfeatures([os.path.join(directory, names[0])], spec).shape[1] if names else 0
+
+  tmp_file = os.path.join(output_dir, '.features.tmp.npy')
+  matrix = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(len(names), nfeatures))
+
+  if reuse:
+    old = np.load(feature_file, mmap_mode='r')
+    rows, old_rows = map(np.asarray, zip(*reuse))
+    for start in range(0, len(rows), batch_size):
+      matrix[rows[start : start + batch_size]] = old[old_rows[start : start + batch_size]]
+    del old
+
+  batches = [todo[i : i + batch_size] for i in range(0, len(todo), batch_size)]
+  files = [[os.path.join(directory, names[i]) for i in batch] for batch in batches]
+
+  # spawned workers: forking from a multi-threaded parent (e.g. a Snakemake job) can deadlock
+  with get_context('spawn').Pool(nprocs) as pool:
+    for batch, values in tqdm.tqdm(zip(batches, pool.imap(partial(batchfeatures, spec=spec), files)), total=len(batches)):
+      matrix[batch] = values
+
+  matrix.flush()
+  del matrix
+
+  # the matrix and the index are replaced only when complete, and the spec is written last
+  if os.path.isfile(spec_file):
+    os.remove(spec_file)
+
+  np.save(names_file, np.asarray(names, dtype=str))
+  np.save(signature_file, signatures)
+  os.replace(tmp_file, feature_file)
+
+  with open(spec_file, 'w', encoding='utf-8') as fp:
+    json.dump({'digest' : digest, 'version' : FEATURES_VERSION, 'features' : spec,
+               'nfeatures' : nfeatures, 'npatches' : len(names)}, fp, indent=2)
+
+  return np.load(feature_file, mmap_mode='r')
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import json
+import numpy as np
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+INDEX_VERSION = 1
+
+
+class NeighborIndex (object):
+
+  def __init__ (self, directory, chunk_size=1 << 16):
+    '''
+    Exact nearest-neighbour index of the patch coordinates (e.g. the eigenslices)
+
+    Parameters
+    ----------
+      directory : str
+        Directory of the index (see NeighborIndex.build)
+
+      chunk_size : int
+        Number of indexed points scanned at once by the queries
+
+    Notes
+    -----
+    The index is a vectorized brute force over memory-mapped files: the
+    coordinates (coords.npy, float32), their squared norms (norms.npy), the
+    patch names (names.npy) and the alphabetical order of the names
+    (order.npy), so opening the index reads only the metadata and the
+    queries scan the coordinates chunk by chunk.
+    The candidates are selected with the expanded squared distance
+    (|x|^2 - 2 x.q + |q|^2, one matrix product for the whole batch of
+    queries) and the best ones are re-ranked with the exact float64
+    distance, breaking the ties by index: the rounding of the matrix
+    product (which depends on the chunk size, on the batch size and on the
+    BLAS threads) only affects the candidates, not the returned distances
+    and their order.
+    '''
+    self.directory = directory
+    self.chunk_size = max(int(chunk_size), 1)
+
+    with open(os.path.join(directory, 'index.json'), 'r', encoding='utf-8') as fp:
+      self.meta = json.load(fp)
+
+    if self.meta.get('version') != INDEX_VERSION:
+      raise ValueError('Invalid index {0}! Expected version {1}. Given {2}'.format(directory, INDEX_VERSION, self.meta.get('version')))
+
+    self.coords = np.load(os.path.join(directory, 'coords.npy'), mmap_mode='r')
+    self.norms = np.load(os.path.join(directory, 'norms.npy'), mmap_mode='r')
+    self.names = np.load(os.path.join(directory, 'names.npy'), mmap_mode='r')
+    self.order = np.load(os.path.join(directory, 'order.npy'), mmap_mode='r')
+
+  @classmethod
+  def build (cls, directory, names, coords, **kwargs):
+    '''
+    Writes the index of a set of points
+
+    Parameters
+    ----------
+      directory : str
+        Output directory of the index
+
+      names : array_like
+        Identifier (e.g. the patch filename) of each point
+
+      coords : array_like
+        Coordinates of the points with shape (points, dimensions)
+
+      kwargs : dict
+        Arguments of the NeighborIndex constructor
+
+    Returns
+    -------
+      index : NeighborIndex
+        The opened index
+    '''
+    coords = np.asarray(coords, dtype=np.float32)
+    names = np.asarray(names, dtype=np.bytes_)
+
+    if coords.ndim != 2 or len(coords) != len(names):
+      raise ValueError('Invalid index data! Expected one row of coordinates for each name. Given {0} names and coordinates with shape {1}'.format(len(names), coords.shape))
+
+    if len(np.unique(names)) != len(names):
+      raise ValueError('Invalid index data! The names of the points must be unique')
+
+    os.makedirs(directory, exist_ok=True)
+
+    np.save(os.path.join(directory, 'coords.npy'), coords)
+    np.save(os.path.join(directory, 'norms.npy'), np.einsum('ij,ij->i', coords, coords, dtype=np.float64))
+    np.save(os.path.join(directory, 'names.npy'), names)
+    np.save(os.path.join(directory, 'order.npy'), np.argsort(names, kind='stable'))
+
+    # the metadata are written last: an index without them is incomplete
+    with open(os.path.join(directory, 'index.json'), 'w', encoding='utf-8') as out:
+      json.dump({'version' : INDEX_VERSION, 'points' : int(len(coords)), 'dimensions' : int(coords.shape[1])}, out)
+
+    return cls(directory, **kwargs)
+
+  def __len__ (self):
+    '''
+    Number of indexed points
+    '''
+    return len(self.coords)
+
+  @property
+  def dimensions (self):
+    '''
+    Number of coordinates of each point
+    '''
+    return self.coords.shape[1]
+
+  def lookup (self, names):
+    '''
+    Returns the indexes of the given names
+
+    Parameters
+    ----------
+      names : list
+        Identifiers of the indexed points
+
+    Returns
+    -------
+      indexes : array_like
+        Index of each name
+    '''
+    keys = np.asarray(names, dtype=np.bytes_)
+    sorted_names = self.names[self.order]
+    pos = np.searchsorted(sorted_names, keys)
+
+    found = (pos < len(self)) & (sorted_names[np.minimum(pos, len(self) - 1)] == keys)
+
+    if not found.all():
+      missing = [str(name) for name, ok in zip(names, found) if not ok]
+      raise KeyError('Names not found in the index {0}: {1}'.format(self.directory, ', '.join(missing[:10])))
+
+    return np.asarray(self.order[pos], dtype=np.int64)
+
+  def name (self, indexes):
+    '''
+    Returns the names of the given indexes
+    '''
+    return [name.decode('utf-8') for name in self.names[np.asarray(indexes)]]
+
+  def query (self, points, k=10, batch_size=64, exclude=None):
+    '''
+    Finds the k nearest neighbours (euclidean distance) of a batch of points
+
+    Parameters
+    ----------
+      points : array_like
+        Query coordinates with shape (queries, dimensions)
+
+      k : int
+        Number of neighbours of each query
+
+      batch_size : int
+        Number of queries processed at once
+
+      exclude : array_like
+        Index of a point excluded from the neighbours of each query (e.g.
+        the query itself), or -1 to keep all the points
+
+    Returns
+    -------
+      (indexes, distances) : tuple
+        Arrays with shape (queries, k) of the indexes of the neighbours and
+        of their distances, sorted by distance (and by index among equal
+        distances); if k is larger than the available points the missing
+        neighbours have index -1 and infinite distance
+    '''
+    points = np.atleast_2d(np.asarray(points, dtype=np.float32))
+    nq = len(points)
+    exclude = np.full(shape=(nq, ), fill_value=-1, dtype=np.int64) if exclude is None else np.asarray(exclude, dtype=np.int64)
+
+    if points.shape[1] != self.dimensions:
+      raise ValueError('Invalid query! Expected {0} coordinates. Given {1}'.format(self.dimensions, points.shape[1]))
+
+    k = int(k)
+    indexes = np.full(shape=(nq, k), fill_value=-1, dtype=np.int64)
+    distances = np.full(shape=(nq, k), fill_value=np.inf, dtype=np.float64)
+
+    # candidates re-ranked with the exact distance (margin for the rounding of the expanded distance)
+    ncand = min(2 * k + 8, len(self))
+
+    for first in range(0, nq, batch_size):
+      batch = points[first : first + batch_size]
+      skip = exclude[first : first + batch_size]
+
+      best_idx = np.empty(shape=(len(batch), 0), dtype=np.int64)
+      best_dist = np.empty(shape=(len(batch), 0), dtype=np.float32)
+
+      # a small first chunk gives the threshold which filters the following ones
+      bounds = [0, *range(min(self.chunk_size, 64 * ncand), len(self), self.chunk_size), len(self)]
+
+      for start, stop in zip(bounds[:-1], bounds[1:]):
+        chunk = np.asarray(self.coords[start : stop])
+
+        # |x|^2 - 2 x.q (|q|^2 is the same for all the candidates of a query)
+        dist = self.norms[start : start + len(chunk)].astype(np.float32) - 2. * (batch @ chunk.T)
+
+        self._mask(dist, skip, start)
+
+        # best candidates of the chunk, merged with the ones of the previous chunks
+        if best_dist.shape[1] == ncand:
+          dist, idx = self._below(dist, best_dist.max(axis=1), start)
+        else:
+          idx = np.broadcast_to(np.arange(start, start + len(chunk)), dist.shape)
+        dist, idx = self._select(dist, idx, ncand)
+
+        best_dist, best_idx = self._select(np.concatenate([best_dist, dist], axis=1), np.concatenate([best_idx, idx], axis=1), ncand)
+
+      # exact re-ranking of the candidates
+      valid = np.isfinite(best_dist)
+      exact = ((np.asarray(self.coords[best_idx.ravel()], dtype=np.float64).reshape(*best_idx.shape, -1) - batch[:, None, :].astype(np.float64)) ** 2).sum(axis=-1)
+      exact = np.where(valid, exact, np.inf)
+      order = np.lexsort((best_idx, exact), axis=1)[:, : k]
+
+      found = min(k, order.shape[1])
+      indexes[first : first + len(batch), : found] = np.take_along_axis(np.where(valid, best_idx, -1), order, axis=1)
+      distances[first : first + len(batch), : found] = np.sqrt(np.take_along_axis(exact, order, axis=1))
+
+    return (indexes, distances)
+
+  @staticmethod
+  def _select (dist, idx, ncand):
+    '''
+    Keeps the ncand smallest distances of each row (and their indexes)
+    '''
+    if dist.shape[1] <= ncand:
+      return (dist, idx)
+
+    keep = np.argpartition(dist, ncand - 1, axis=1)[:, : ncand]
+    return (np.take_along_axis(dist, keep, axis=1), np.take_along_axis(idx, keep, axis=1))
+
+  @staticmethod
+  def _below (dist, threshold, start):
+    '''
+    Keeps only the distances of each row not larger than its threshold (the
+    worst candidate found so far), padding the rows with infinite distances
+    '''
+    rows, cols = np.nonzero(dist <= threshold[:, None])
+    counts = np.bincount(rows, minlength=len(dist))
+
+    # position of each kept distance in its row
+    pos = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    below = np.full(shape=(len(dist), max(counts.max(initial=0), 1)), fill_value=np.inf, dtype=dist.dtype)
+    idx = np.full(shape=below.shape, fill_value=-1, dtype=np.int64)
+    below[rows, pos] = dist[rows, cols]
+    idx[rows, pos] = cols + start
+
+    return (below, idx)
+
+  @staticmethod
+  def _mask (dist, skip, start):
+    '''
+    Sets to infinity the distance of the excluded points of a chunk
+    '''
+    rows = np.nonzero((skip >= start) & (skip < start + dist.shape[1]))[0]
+    dist[rows, skip[rows] - start] = np.inf
+
+  def similar (self, names, k=10, batch_size=64):
+    '''
+    Finds the k most similar points of indexed points (the points themselves excluded)
+
+    Parameters
+    ----------
+      names : list
+        Identifiers of the query points
+
+      k : int
+        Number of neighbours of each query
+
+      batch_size : int
+        Number of queries processed at once
+
+    Returns
+    -------
+      neighbours : list
+        List (one for each query) of (name, distance) pairs, sorted by distance
+    '''
+    queries = self.lookup(names)
+    points = np.asarray(self.coords[queries])
+    indexes, distances = self.query(points, k=k, batch_size=batch_size, exclude=queries)
+
+    return [[(self.name([i])[0], float(d)) for i, d in zip(row_idx, row_dist) if i >= 0] for row_idx, row_dist in zip(indexes, distances)]
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    return '<NeighborIndex (points: {0}, dimensions: {1})>'.format(len(self), self.dimensions)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# label 0 is the background, so at most 255 annotation colors
+MAX_LABELS = 255
+
+
+def encoderows (labels):
+  '''
+  Run-length encodes the rows of a label image
+
+  Parameters
+  ----------
+    labels : array_like
+      Label image with shape (rows, cols), 0 for the background
+
+  Returns
+  -------
+    (counts, starts, ends, values) : tuple
+      Number of runs of each row and first column, last column (excluded)
+      and label of each run, in row-major order (background runs are not stored)
+  '''
+  nrows, ncols = labels.shape
+
+  padded = np.zeros(shape=(nrows, ncols + 2), dtype=labels.dtype)
+  padded[:, 1 : -1] = labels
+
+  # a run boundary is placed before each column where the label changes
+  rows, cols = np.nonzero(padded[:, 1:] != padded[:, :-1])
+
+  same = rows[1:] == rows[:-1]
+  rows, starts, ends = rows[:-1][same], cols[:-1][same], cols[1:][same]
+
+  values = labels[rows, starts]
+  keep = values != 0
+  rows, starts, ends, values = rows[keep], starts[keep], ends[keep], values[keep]
+
+  counts = np.bincount(rows, minlength=nrows)
+
+  return (counts, starts.astype(np.int32), ends.astype(np.int32), values.astype(np.uint8))
+
+
+class LabelRaster (object):
+
+  def __init__ (self, offsets, starts, ends, values, width, colors):
+    '''
+    Run-length encoded annotation mask
+
+    Parameters
+    ----------
+      offsets : array_like
+        Index of the first run of each row in starts, ends and values, plus
+        the end of the last row (length rows + 1)
+
+      starts : array_like
+        First column of each run
+
+      ends : array_like
+        Last column (excluded) of each run
+
+      values : array_like
+        Label of each run (1 for the first color, 2 for the second one, ...)
+
+      width : int
+        Number of columns of the mask
+
+      colors : list
+        RGB color code of each label
+
+    Notes
+    -----
+    Only the runs of annotated pixels are stored (about 9 bytes for each
+    contour crossed by a row), so the mask of a whole slide takes a few
+    megabytes instead of 3 bytes for each pixel.
+    The rectangle queries (labels, colorset, dense) touch only the runs of
+    the rows of the rectangle. Indexing the raster as the dense mask
+    (raster[upper : lower, left : right]) returns the same RGB array, so the
+    raster can replace the mask in getchips, cropchip and cropcontext.
+    '''
+    if len(colors) > MAX_LABELS:
+      raise ValueError('Too many annotation colors for a label raster! Maximum {0}. Given {1}'.format(MAX_LABELS, len(colors)))
+
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.starts = starts
+    self.ends = ends
+    self.values = values
+    self.width = int(width)
+    self.colors = [tuple(int(c) for c in color) for color in colors]
+
+    # RGB color of each label and packed color (as statistics.packcolor) of each label
+    self.lut = np.zeros(shape=(len(self.colors) + 1, 3), dtype=np.uint8)
+    if self.colors:
+      self.lut[1:] = self.colors
+    self.packed = [(r << 16) | (g << 8) | b for r, g, b in self.lut.astype(np.int64).tolist()]
+
+  @classmethod
+  def fromlabels (cls, bands, width, colors):
+    '''
+    Encodes a label image given as a sequence of horizontal bands
+
+    Parameters
+    ----------
+      bands : iterable
+        Label images with shape (rows, width), top to bottom (e.g. a generator
+        which rasterizes one band at a time)
+
+      width : int
+        Number of columns of the mask
+
+      colors : list
+        RGB color code of each label
+
+    Returns
+    -------
+      raster : LabelRaster
+        The encoded mask
+    '''
+    counts, starts, ends, values = [np.zeros(shape=(0, ), dtype=np.int64)], [], [], []
+
+    for band in bands:
+      band_counts, band_starts, band_ends, band_values = encoderows(band)
+      counts.append(band_counts)
+      starts.append(band_starts)
+      ends.append(band_ends)
+      values.append(band_values)
+
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+
+    starts = np.concatenate(starts) if starts else np.empty(shape=(0, ), dtype=np.int32)
+    ends = np.concatenate(ends) if ends else np.empty(shape=(0, ), dtype=np.int32)
+    values = np.concatenate(values) if values else np.empty(shape=(0, ), dtype=np.uint8)
+
+    return cls(offsets, starts, ends, values, width, colors)
+
+  @property
+  def height (self):
+    '''
+    Number of rows of the mask
+    '''
+    return len(self.offsets) - 1
+
+  @property
+  def shape (self):
+    '''
+    Shape of the equivalent dense RGB mask
+    '''
+    return (self.height, self.width, 3)
+
+  @property
+  def dtype (self):
+    '''
+    Data type of the equivalent dense RGB mask
+    '''
+    return self.lut.dtype
+
+  @property
+  def nbytes (self):
+    '''
+    Memory used by the runs (shared among the bands of the same raster)
+    '''
+    return self.offsets.nbytes + self.starts.nbytes + self.ends.nbytes + self.values.nbytes
+
+  def __len__ (self):
+    '''
+    Number of rows of the mask
+    '''
+    return self.height
+
+  def band (self, upper, lower):
+    '''
+    Returns the rows [upper, lower) of the mask (the runs are shared)
+    '''
+    upper, lower, _ = slice(upper, lower).indices(self.height)
+    return LabelRaster(self.offsets[upper : max(lower, upper) + 1], self.starts, self.ends, self.values, self.width, self.colors)
+
+  def _clip (self, upper, lower, left, right):
+    '''
+    Clips a rectangle to the mask as numpy slicing does
+    '''
+    upper, lower, _ = slice(upper, lower).indices(self.height)
+    left, right, _ = slice(left, right).indices(self.width)
+    return (upper, max(lower, upper), left, max(right, left))
+
+  def runs (self, upper, lower, left, right):
+    '''
+    Returns the runs which intersect a rectangle, clipped to it
+
+    Parameters
+    ----------
+      upper : int
+        First row of the rectangle
+
+      lower : int
+        Last row (excluded) of the rectangle
+
+      left : int
+        First column of the rectangle
+
+      right : int
+        Last column (excluded) of the rectangle
+
+    Returns
+    -------
+      (rows, starts, ends, values) : tuple
+        Row, first and last column (excluded) relative to the rectangle and
+        label of each run
+    '''
+    upper, lower, left, right = self._clip(upper, lower, left, right)
+
+    first, last = self.offsets[upper], self.offsets[lower]
+    counts = np.diff(self.offsets[upper : lower + 1])
+    rows = np.repeat(np.arange(lower - upper), counts)
+
+    starts = self.starts[first : last]
+    ends = self.ends[first : last]
+    # (an empty rectangle has no run)
+    inside = (starts < right) & (ends > left) & (left < right)
+
+    return (rows[inside],
+            np.maximum(starts[inside], left) - left,
+            np.minimum(ends[inside], right) - left,
+            self.values[first : last][inside])
+
+  def labels (self, upper, lower, left, right):
+    '''
+    Returns the labels present in a rectangle (0 if it includes background pixels)
+    '''
+    upper, lower, left, right = self._clip(upper, lower, left, right)
+    rows, starts, ends, values = self.runs(upper, lower, left, right)
+
+    labels = set(np.unique(values).tolist())
+
+    # the runs of a row do not overlap
+    if (ends - starts).sum() < (lower - upper) * (right - left):
+      labels.add(0)
+
+    return labels
+
+  def colorset (self, upper, lower, left, right):
+    '''
+    Returns the packed colors (see statistics.packcolor) present in a rectangle,
+    i.e. np.unique(packcolors(mask[upper : lower, left : right]))
+    '''
+    return {self.packed[label] for label in self.labels(upper, lower, left, right)}
+
+  def dense (self, upper, lower, left, right, rgb=True):
+    '''
+    Decodes a rectangle of the mask
+
+    Parameters
+    ----------
+      upper : int
+        First row of the rectangle
+
+      lower : int
+        Last row (excluded) of the rectangle
+
+      left : int
+        First column of the rectangle
+
+      right : int
+        Last column (excluded) of the rectangle
+
+      rgb : bool
+        Whether to return the RGB colors or the labels
+
+    Returns
+    -------
+      mask : array_like
+        RGB mask (rows, cols, 3) or labels (rows, cols) of the rectangle,
+        clipped to the mask as numpy slicing does
+    '''
+    upper, lower, left, right = self._clip(upper, lower, left, right)
+    rows, starts, ends, values = self.runs(upper, lower, left, right)
+
+    # the labels are the cumulative sum of the run steps along each row
+    steps = np.zeros(shape=(lower - upper, right - left + 1), dtype=np.int16)
+    np.add.at(steps, (rows, starts), values)
+    np.add.at(steps, (rows, ends), -values.astype(np.int16))
+
+    labels = np.cumsum(steps[:, :-1], axis=1).astype(np.uint8)
+
+    return self.lut[labels] if rgb else labels
+
+  def __getitem__ (self, index):
+    '''
+    Decodes the RGB mask of a rectangle: raster[upper : lower, left : right]
+    '''
+    if not isinstance(index, tuple):
+      index = (index, slice(None))
+
+    rows, cols = index[:2]
+    if rows.step not in (None, 1) or cols.step not in (None, 1):
+      raise ValueError('Strided indexing is not supported by LabelRaster')
+
+    return self.dense(rows.start, rows.stop, cols.start, cols.stop)
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    return '<LabelRaster (shape: {0}x{1}, runs: {2}, labels: {3}, bytes: {4})>'.format(self.height, self.width,
+                                                                                     int(self.offsets[-1] - self.offsets[0]), len(self.colors), self.nbytes)
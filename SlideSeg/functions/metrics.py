@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import tempfile
+from threading import Lock
+from threading import local
+from contextlib import contextmanager
+
+try:
+  import resource
+except ImportError: # Windows
+  resource = None
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# collector of the current thread (see collect and bind)
+_ACTIVE = local()
+
+
+def peakrss ():
+  '''
+  Returns the peak resident set size of the process (in bytes, None if not available)
+  '''
+  if resource is None:
+    return None
+
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on MacOS and in kilobytes on Linux
+  return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class Metrics (object):
+
+  def __init__ (self, name=''):
+    '''
+    Collector of per-stage timers and counters
+
+    Parameters
+    ----------
+      name : str
+        Name of the measured job (e.g. the slide or the rule)
+
+    Notes
+    -----
+    The stage timers accumulate the time spent by all the threads in each
+    stage, so with many workers their sum can exceed the elapsed time.
+    Both timers and counters are thread-safe.
+    '''
+    self.name = name
+    self.stages = dict()
+    self.counters = dict()
+    self.start = time.perf_counter()
+    self.elapsed = None
+    self.rss = None
+
+    self._lock = Lock()
+
+  @contextmanager
+  def stage (self, name):
+    '''
+    Measures the time spent in a stage
+
+    Parameters
+    ----------
+      name : str
+        Name of the stage
+    '''
+    tic = time.perf_counter()
+    try:
+      yield
+    finally:
+      toc = time.perf_counter() - tic
+      with self._lock:
+        calls, seconds = self.stages.get(name, (0, 0.))
+        self.stages[name] = (calls + 1, seconds + toc)
+
+  def count (self, name, value=1):
+    '''
+    Increments a counter
+
+    Parameters
+    ----------
+      name : str
+        Name of the counter (e.g. chips or bytes)
+
+      value : int
+        Increment
+    '''
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def stop (self):
+    '''
+    Stops the clock and records the peak memory usage
+    '''
+    self.elapsed = time.perf_counter() - self.start
+    self.rss = peakrss()
+
+  def todict (self):
+    '''
+    Converts the metrics into a json-serializable dictionary
+    '''
+    elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.start
+
+    with self._lock:
+      stages = {name : {'calls' : calls, 'seconds' : seconds} for name, (calls, seconds) in sorted(self.stages.items())}
+      counters = dict(sorted(self.counters.items()))
+
+    rates = {'{0}_per_sec'.format(name) : value / elapsed for name, value in counters.items() if elapsed > 0}
+
+    return {
+             'name'     : self.name,
+             'elapsed'  : elapsed,
+             'peak_rss' : self.rss if self.rss is not None else peakrss(),
+             'stages'   : stages,
+             'counters' : counters,
+             'rates'    : rates,
+           }
+
+  def save (self, filename):
+    '''
+    Writes the metrics into a json file or, if the extension is .csv, into
+    a csv file with one (metric, value) row for each measure
+
+    Parameters
+    ----------
+      filename : str
+        Output filename
+
+    Returns
+    -------
+    None
+    '''
+    data = self.todict()
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+
+    with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+
+      if os.path.splitext(filename)[1].lower() == '.csv':
+        fp.write('name,metric,value\n')
+        fp.write('{0},elapsed,{1}\n'.format(self.name, data['elapsed']))
+        fp.write('{0},peak_rss,{1}\n'.format(self.name, data['peak_rss']))
+
+        for stage, values in data['stages'].items():
+          fp.write('{0},{1}.calls,{2}\n'.format(self.name, stage, values['calls']))
+          fp.write('{0},{1}.seconds,{2}\n'.format(self.name, stage, values['seconds']))
+
+        for key in ('counters', 'rates'):
+          for metric, value in data[key].items():
+            fp.write('{0},{1},{2}\n'.format(self.name, metric, value))
+
+      else:
+        json.dump(data, fp, indent=2)
+
+    os.replace(tmp, filename)
+
+  def summary (self):
+    '''
+    Returns a printable table of the stage timers
+    '''
+    data = self.todict()
+    rows = ['{0:<12} {1:>8} {2:>10}'.format('stage', 'calls', 'seconds')]
+    rows += ['{0:<12} {1:>8d} {2:>10.3f}'.format(stage, values['calls'], values['seconds']) for stage, values in data['stages'].items()]
+    rows += ['{0:<12} {1:>19}'.format(metric, '{0:.3f}'.format(value) if isinstance(value, float) else value)
+             for metric, value in list(data['counters'].items()) + list(data['rates'].items())]
+    return '\n'.join(rows)
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    return '<Metrics (name: {0}, stages: {1}, counters: {2})>'.format(self.name, len(self.stages), len(self.counters))
+
+
+def active ():
+  '''
+  Returns the collector of the current thread (None if the metrics are disabled)
+  '''
+  return getattr(_ACTIVE, 'metrics', None)
+
+
+@contextmanager
+def bind (metrics):
+  '''
+  Activates a collector in the current thread (e.g. in the workers of a thread pool)
+
+  Parameters
+  ----------
+    metrics : Metrics
+      The collector (None disables the metrics)
+  '''
+  previous = active()
+  _ACTIVE.metrics = metrics
+  try:
+    yield metrics
+  finally:
+    _ACTIVE.metrics = previous
+
+
+@contextmanager
+def _noop ():
+  yield
+
+
+def stage (name):
+  '''
+  Measures a stage with the collector of the current thread (no-op if disabled)
+
+  Parameters
+  ----------
+    name : str
+      Name of the stage
+
+  Example
+  -------
+  >>> with stage('rasterize'):
+  ...   mask = rastermask(contours, size)
+  '''
+  metrics = active()
+  return _noop() if metrics is None else metrics.stage(name)
+
+
+def count (name, value=1):
+  '''
+  Increments a counter of the collector of the current thread (no-op if disabled)
+  '''
+  metrics = active()
+  if metrics is not None:
+    metrics.count(name, value)
+
+
+@contextmanager
+def collect (metrics=None, filename=None, profile=None):
+  '''
+  Collects the metrics of a block of code
+
+  Parameters
+  ----------
+    metrics : Metrics or str
+      The collector or the name of a new one
+
+    filename : str
+      Output json (or csv) metrics file written at the end of the block (None does not save)
+
+    profile : str
+      Output cProfile stats file (None disables the profiler); it can be
+      inspected with pstats, snakeviz or gprof2dot
+
+  Returns
+  -------
+    metrics : Metrics
+      The active collector
+
+  Notes
+  -----
+  The profiler records only the calling thread. The stage functions are
+  plain python frames, so the output of sampling profilers (e.g.
+  py-spy record --pid) can be grouped by the same stages.
+  '''
+  if not isinstance(metrics, Metrics):
+    metrics = Metrics('' if metrics is None else metrics)
+
+  profiler = None
+  if profile is not None:
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+  try:
+    with bind(metrics):
+      yield metrics
+
+  finally:
+    if profiler is not None:
+      profiler.disable()
+      os.makedirs(os.path.dirname(os.path.abspath(profile)), exist_ok=True)
+      profiler.dump_stats(profile)
+
+    metrics.stop()
+
+    if filename is not None:
+      metrics.save(filename)
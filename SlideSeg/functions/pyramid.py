@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import cv2
+import numpy as np
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+DZI_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{fmt}" Overlap="{overlap:d}" TileSize="{tile_size:d}">
+  <Size Width="{width:d}" Height="{height:d}"/>
+</Image>
+'''
+
+
+def hexlut (colors):
+  '''
+  Builds the BGR lookup table of the encoded annotation labels
+
+  Parameters
+  ----------
+    colors : dict
+      Dictionary of encoded label (0-255) and its color code ('#rrggbb'),
+      as read from the colormap of the pipeline
+
+  Returns
+  -------
+    lut : array_like
+      (256, 3) uint8 array with the BGR color of each label (black for the
+      labels not in colors)
+  '''
+  lut = np.zeros(shape=(256, 3), dtype=np.uint8)
+
+  for encoded, color in colors.items():
+    color = color.lstrip('#')
+    lut[int(encoded)] = [int(color[i : i + 2], 16) for i in (4, 2, 0)]
+
+  return lut
+
+
+def overlaymask (image, labels, lut, alpha=.4):
+  '''
+  Blends the colors of the annotation labels over an image
+
+  Parameters
+  ----------
+    image : array_like
+      BGR image with shape (rows, cols, 3)
+
+    labels : array_like
+      Encoded labels with shape (rows, cols), 0 for the background
+
+    lut : array_like
+      BGR color of each label (see hexlut)
+
+    alpha : float
+      Opacity of the annotation colors
+
+  Returns
+  -------
+    overlay : array_like
+      BGR image with the annotated pixels blended with their label color
+  '''
+  overlay = np.array(image, dtype=np.uint8, copy=True)
+  annotated = np.asarray(labels) != 0
+
+  if not annotated.any():
+    return overlay
+
+  blend = cv2.addWeighted(overlay[annotated], 1. - alpha, lut[labels[annotated]], alpha, 0.)
+  overlay[annotated] = blend.reshape(-1, 3)
+
+  return overlay
+
+
+def halfsize (image):
+  '''
+  Downsamples an image by a factor 2 (area average), rounding its size up as the DeepZoom levels
+  '''
+  rows, cols = image.shape[:2]
+  return cv2.resize(image, dsize=(-(-cols // 2), -(-rows // 2)), interpolation=cv2.INTER_AREA)
+
+
+class DeepZoomWriter (object):
+
+  def __init__ (self, filename, tile_size=254, overlap=1, fmt='jpeg', quality=90):
+    '''
+    Writes an image as a DeepZoom tile pyramid
+
+    Parameters
+    ----------
+      filename : str
+        Path of the .dzi descriptor: the tiles are written into the
+        {name}_files/{level}/{col}_{row}.{fmt} files next to it
+
+      tile_size : int
+        Size of the tiles (without overlap)
+
+      overlap : int
+        Pixels shared by adjacent tiles
+
+      fmt : str
+        Format of the tiles ('jpeg' or 'png')
+
+      quality : int
+        Quality of the jpeg tiles
+
+    Notes
+    -----
+    The pyramid is built as a cascade: the full resolution level is tiled
+    from the image already in memory and each lower level is the 2x
+    downsampling of the previous one, so the data is never read again and
+    at most one level (plus its half) is in memory at the same time.
+    The descriptor follows the DeepZoom format, so the pyramid can be
+    browsed by any DeepZoom viewer (e.g. OpenSeadragon).
+    '''
+    if fmt not in ('jpeg', 'png'):
+      raise ValueError('Invalid tile format {}! Possible values are jpeg or png'.format(fmt))
+
+    self.filename = filename
+    self.tile_dir = '{}_files'.format(os.path.splitext(filename)[0])
+    self.tile_size = int(tile_size)
+    self.overlap = int(overlap)
+    self.fmt = fmt
+    self.params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)] if fmt == 'jpeg' else []
+
+  @staticmethod
+  def nlevels (size):
+    '''
+    Number of levels of the pyramid of an image of the given (width, height)
+    '''
+    return int(np.ceil(np.log2(max(max(size), 1)))) + 1
+
+  def tiles (self, size):
+    '''
+    Returns the (col, row, left, upper, right, lower) boxes of the tiles of a level with the given (width, height)
+    '''
+    width, height = size
+    step, overlap = self.tile_size, self.overlap
+
+    for row, upper in enumerate(range(0, height, step)):
+      for col, left in enumerate(range(0, width, step)):
+        yield (col, row, max(left - overlap, 0), max(upper - overlap, 0), min(left + step + overlap, width), min(upper + step + overlap, height))
+
+  def write (self, image):
+    '''
+    Writes the pyramid of an image
+
+    Parameters
+    ----------
+      image : array_like
+        BGR (rows, cols, 3) or gray (rows, cols) image
+
+    Returns
+    -------
+      (ntiles, nbytes) : tuple
+        Number of tiles and bytes written
+    '''
+    rows, cols = image.shape[:2]
+    ext = 'jpg' if self.fmt == 'jpeg' else 'png'
+    ntiles, nbytes = 0, 0
+
+    os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+
+    level = np.ascontiguousarray(image)
+
+    for depth in reversed(range(self.nlevels((cols, rows)))):
+      level_dir = os.path.join(self.tile_dir, str(depth))
+      os.makedirs(level_dir, exist_ok=True)
+
+      height, width = level.shape[:2]
+
+      for col, row, left, upper, right, lower in self.tiles((width, height)):
+        _, data = cv2.imencode('.{}'.format(ext), level[upper : lower, left : right], self.params)
+        data.tofile(os.path.join(level_dir, '{:d}_{:d}.{}'.format(col, row, ext)))
+
+        ntiles += 1
+        nbytes += data.nbytes
+
+      if depth:
+        level = halfsize(level)
+
+    with open(self.filename, 'w', encoding='utf-8') as out:
+      out.write(DZI_TEMPLATE.format(fmt=ext, overlap=self.overlap, tile_size=self.tile_size, width=cols, height=rows))
+
+    return (ntiles, nbytes)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import numpy as np
+from threading import Event
+from threading import Lock
+from threading import RLock
+from collections import OrderedDict
+
+from .slideseg import rawtiles
+from .slideseg import readregion
+from .slideseg import checkdecode
+from .slideseg import openwholeslide
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def parsechipname (chip_name):
+  '''
+  Extracts the slide coordinates from a chip filename
+
+  Parameters
+  ----------
+    chip_name : str
+      Chip filename in the splitter fmt ({slide}_{level}_{row}_{col}.{suffix})
+
+  Returns
+  -------
+    (name, level, row, col) : tuple
+      Slide name, level and coordinates of the chip
+  '''
+  name, _ = os.path.splitext(os.path.basename(chip_name))
+  name, level, row, col = name.rsplit('_', 3)
+
+  return (name, int(level), int(row), int(col))
+
+
+class PatchReader (object):
+
+  def __init__ (self, tile_size=512, max_bytes=1 << 30, max_slides=8):
+    '''
+    Random-access reader of slide patches with a LRU cache of decoded tiles
+
+    Parameters
+    ----------
+      tile_size : int
+        Size of the cached slide tiles
+
+      max_bytes : int
+        Memory budget (in bytes) of the tile cache and of the decoded slides
+
+      max_slides : int
+        Maximum number of slides kept open at the same time
+
+    Notes
+    -----
+    The patches are stitched from the cached tiles, so neighbouring or
+    overlapping patches decode each slide region only once.
+    Both caches are process-local and thread-safe: the tiles are decoded
+    outside the cache lock (the tiles of different slides in parallel) and
+    the threads which need a tile being decoded wait for it instead of
+    decoding it again.
+    The tiles of an uncompressed TIFF are read from the file as the ones
+    of OpenSlide (see readregion). A compressed slide opened with PIL is
+    decoded whole at its first tile, so its decoded pixels count in
+    max_bytes (with a warning if the slide alone exceeds it): when the
+    budget is exceeded the least recently used idle slides (but the
+    current one) are closed before the tiles are evicted. The tiles of
+    such a slide are decoded one at a time.
+    '''
+
+    self.tile_size = int(tile_size)
+    self.max_bytes = int(max_bytes)
+    self.max_slides = int(max_slides)
+
+    # slide : {'osr', 'lock' (slides decoded whole only), 'users', 'nbytes'}
+    self._slides = OrderedDict()
+    # slides decoded whole beyond the budget (already reported)
+    self._oversized = set()
+    self._tiles = OrderedDict()
+    # key : Event of the tiles being decoded
+    self._pending = dict()
+    self._lock = RLock()
+
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @property
+  def slide_bytes (self):
+    '''
+    Bytes of the decoded pooled slides
+    '''
+    return sum(entry['nbytes'] for entry in self._slides.values())
+
+  def _close (self, slide):
+    '''
+    Closes a pooled slide
+    '''
+    entry = self._slides.pop(slide)
+
+    if hasattr(entry['osr'], 'close'):
+      entry['osr'].close()
+
+  def _slide (self, slide):
+    '''
+    Returns the pooled slide entry, marked as in use (to call with the lock held)
+    '''
+    if slide in self._slides:
+      self._slides.move_to_end(slide)
+
+    else:
+      osr = openwholeslide(slide)
+      # OpenSlide (and PIL for an uncompressed TIFF) decodes each region, PIL the whole RGB(A) image otherwise
+      whole = not hasattr(osr, 'read_region') and rawtiles(osr) is None
+
+      if whole and slide not in self._oversized and not checkdecode(osr, self.max_bytes):
+        self._oversized.add(slide)
+
+      self._slides[slide] = {'osr' : osr, 'lock' : Lock() if whole else None, 'users' : 0,
+                             'nbytes' : osr.size[0] * osr.size[1] * len(osr.getbands()) if whole else 0}
+
+    entry = self._slides[slide]
+    entry['users'] += 1
+
+    # close the least recently used slides (the ones in use are closed later)
+    for old in [name for name, other in self._slides.items() if other['users'] == 0][: max(len(self._slides) - self.max_slides, 0)]:
+      self._close(old)
+
+    return entry
+
+  def _evict (self, current):
+    '''
+    Closes the idle slides and evicts the tiles exceeding the budget (to call with the lock held)
+    '''
+    # the current slide is kept, otherwise a slide larger than the budget would be decoded for each tile
+    idle = [name for name, entry in self._slides.items() if entry['users'] == 0 and entry['nbytes'] and name != current]
+
+    while self.nbytes + self.slide_bytes > self.max_bytes:
+
+      # the decoded slides first (least recently used)
+      if idle:
+        self._close(idle.pop(0))
+
+      # always keep the current tile
+      elif len(self._tiles) > 1:
+        _, old = self._tiles.popitem(last=False)
+        self.nbytes -= old.nbytes
+        self.evictions += 1
+
+      else:
+        break
+
+  def _tile (self, slide, tx, ty):
+    '''
+    Returns the decoded tile (tx, ty) of the slide
+    '''
+    key = (slide, tx, ty)
+
+    while True:
+
+      with self._lock:
+
+        if key in self._tiles:
+          self.hits += 1
+          self._tiles.move_to_end(key)
+          return self._tiles[key]
+
+        pending = self._pending.get(key)
+
+        if pending is None:
+          self.misses += 1
+          pending = self._pending[key] = Event()
+          entry = self._slide(slide)
+          break
+
+      # another thread is decoding the tile (if it fails this thread tries again)
+      pending.wait()
+
+    tile = None
+    left, upper = tx * self.tile_size, ty * self.tile_size
+
+    try:
+      if entry['lock'] is None:
+        tile = np.asarray(readregion(entry['osr'], (left, upper, left + self.tile_size, upper + self.tile_size)))
+      else:
+        with entry['lock']:
+          tile = np.asarray(readregion(entry['osr'], (left, upper, left + self.tile_size, upper + self.tile_size)))
+
+    finally:
+      with self._lock:
+        entry['users'] -= 1
+
+        if tile is not None:
+          self._tiles[key] = tile
+          self.nbytes += tile.nbytes
+
+        self._evict(slide)
+        del self._pending[key]
+        pending.set()
+
+    return tile
+
+  def get_patch (self, slide, x, y, size):
+    '''
+    Reads a square patch of the slide
+
+    Parameters
+    ----------
+      slide : str
+        Slide image path
+
+      x : int
+        Column of the top-left corner of the patch (slide coordinates)
+
+      y : int
+        Row of the top-left corner of the patch (slide coordinates)
+
+      size : int
+        The size of the patch
+
+    Returns
+    -------
+      patch : array_like
+        RGB uint8 patch with shape (size, size, 3), zero padded outside the slide
+        (same as the chips cropped by SlideSeg.run)
+    '''
+    x, y, size = int(x), int(y), int(size)
+    ts = self.tile_size
+
+    patch = np.zeros(shape=(size, size, 3), dtype=np.uint8)
+
+    for ty in range(y // ts, (y + size - 1) // ts + 1):
+      for tx in range(x // ts, (x + size - 1) // ts + 1):
+
+        tile = self._tile(slide, tx, ty)
+
+        # intersection between tile and patch (slide coordinates)
+        left, upper = max(x, tx * ts), max(y, ty * ts)
+        right, lower = min(x + size, (tx + 1) * ts), min(y + size, (ty + 1) * ts)
+
+        patch[upper - y : lower - y, left - x : right - x] = tile[upper - ty * ts : lower - ty * ts,
+                                                                  left - tx * ts  : right - tx * ts]
+
+    return patch
+
+  def get_chip (self, slide, chip_name, size):
+    '''
+    Re-extracts a chip saved by the splitter (e.g. listed in a counter file)
+
+    Parameters
+    ----------
+      slide : str
+        Slide image path
+
+      chip_name : str
+        Chip filename ({slide}_{level}_{row}_{col}.{suffix})
+
+      size : int
+        The size of the chip
+
+    Returns
+    -------
+      patch : array_like
+        RGB uint8 chip with shape (size, size, 3)
+    '''
+    _, _, row, col = parsechipname(chip_name)
+    return self.get_patch(slide, col, row, size)
+
+  def stats (self):
+    '''
+    Returns the cache statistics
+
+    Returns
+    -------
+      stats : dict
+        Number of hits, misses and evictions, hit rate, cached tiles and
+        bytes, open slides and bytes of the decoded slides
+    '''
+    with self._lock:
+      total = self.hits + self.misses
+
+      return {
+               'hits'        : self.hits,
+               'misses'      : self.misses,
+               'hit_rate'    : self.hits / total if total else 0.,
+               'evictions'   : self.evictions,
+               'tiles'       : len(self._tiles),
+               'bytes'       : self.nbytes,
+               'slides'      : len(self._slides),
+               'slide_bytes' : self.slide_bytes,
+             }
+
+  def clear (self):
+    '''
+    Empties the tile cache and closes the pooled slides
+    '''
+    with self._lock:
+      self._tiles.clear()
+      self.nbytes = 0
+
+      for slide in list(self._slides):
+        self._close(slide)
+
+  def close (self):
+    '''
+    Releases all the resources of the reader
+    '''
+    self.clear()
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    stats = self.stats()
+    return '<PatchReader (tile_size: {0}, cache: {1}/{2} bytes, hit rate: {3:.3f})>'.format(self.tile_size, stats['bytes'], self.max_bytes, stats['hit_rate'])
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+from collections import OrderedDict
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+SAMPLING_METHODS = ('stratified', 'reservoir')
+
+
+def parseratios (ratios):
+  '''
+  Parses the target class ratios
+
+  Parameters
+  ----------
+    ratios : dict or list
+      Dictionary of class names and ratios or list of 'name=ratio' strings
+      (e.g. ['MELANOMA-MALIGNO=0.5', 'NEVO-BENIGNO=0.3', 'NONE=0.2'])
+
+  Returns
+  -------
+    ratios : OrderedDict
+      Class names (uppercase, as the annotation keys) and ratios normalized
+      to sum to one (None if ratios is None)
+  '''
+  if ratios is None:
+    return None
+
+  if not isinstance(ratios, dict):
+    ratios = OrderedDict(item.rsplit('=', 1) for item in ratios)
+
+  # the annotation keys are stored uppercase (see loadcontours)
+  ratios = OrderedDict((str(name).strip().upper(), float(value)) for name, value in ratios.items())
+
+  if any(value < 0 for value in ratios.values()) or sum(ratios.values()) <= 0:
+    raise ValueError('Invalid class ratios {0}! Ratios must be non-negative with a positive sum'.format(dict(ratios)))
+
+  total = sum(ratios.values())
+  return OrderedDict((name, value / total) for name, value in ratios.items())
+
+
+def shardcap (max_chips, shard, nshards):
+  '''
+  Splits a per-slide cap among the shards of the slide (the shard caps sum to max_chips)
+  '''
+  if max_chips is None:
+    return None
+
+  return int(max_chips) * (shard + 1) // nshards - int(max_chips) * shard // nshards
+
+
+class ChipSampler (object):
+
+  def __init__ (self, ratios=None, max_chips=None, method='stratified', seed=None):
+    '''
+    Class-balanced sampling of the planned chips
+
+    Parameters
+    ----------
+      ratios : dict or list
+        Target class ratios (see parseratios). None keeps the class
+        proportions of the slide
+
+      max_chips : int
+        Maximum number of selected chips (None for no cap)
+
+      method : str
+        'stratified' (exact quotas from the class counts of the whole
+        plan) or 'reservoir' (streaming per-class reservoirs: only
+        max_chips names are kept in memory)
+
+      seed : int
+        Random seed
+
+    Notes
+    -----
+    The chips are added with their label set before any pixel of the slide
+    is read. A chip with more labels is assigned to the first of its labels
+    in the ratios order (list the rare classes first); chips with no label
+    in the ratios are dropped. The class names are case insensitive.
+    With the stratified method the classes without chips are ignored and the
+    number of selected chips is the largest one which keeps the ratios (and
+    the cap); with the reservoir method the quota of each class is its ratio
+    of max_chips, which is then required.
+    For a given seed the stratified selection is reproducible whatever the
+    planning order, while the reservoir one depends on it.
+    '''
+    if method not in SAMPLING_METHODS:
+      raise ValueError('Invalid sampling method {0}! Possible values are {1}'.format(method, ', '.join(SAMPLING_METHODS)))
+
+    if method == 'reservoir' and max_chips is None:
+      raise ValueError('The reservoir sampling requires max_chips')
+
+    self.ratios = parseratios(ratios)
+    self.max_chips = None if max_chips is None else int(max_chips)
+    self.method = method
+    self.seed = seed
+
+    self.classes = list(self.ratios) if self.ratios is not None else ['ALL']
+    self.available = {name : 0 for name in self.classes}
+    self.chips = {name : [] for name in self.classes}
+    self.quotas = None
+
+    self._rng = np.random.RandomState(seed)
+
+    if method == 'reservoir':
+      self.quotas = self._split(self.max_chips, {name : 1 for name in self.classes})
+
+  @property
+  def blank (self):
+    '''
+    True if the chips without annotations (NONE) have to be planned
+    '''
+    return self.ratios is not None and self.ratios.get('NONE', 0.) > 0
+
+  def stratum (self, labels):
+    '''
+    Returns the class of a chip from its labels (None if the chip is not sampled)
+    '''
+    if self.ratios is None:
+      return 'ALL'
+
+    labels = {str(label).upper() for label in labels}
+    for name, ratio in self.ratios.items():
+      if ratio > 0 and name in labels:
+        return name
+
+    return None
+
+  def validate (self, keys):
+    '''
+    Checks that every class of the ratios (but NONE) is an annotation key
+
+    Parameters
+    ----------
+      keys : iterable
+        Names of the annotation classes (e.g. the keys of the annotation dictionary)
+    '''
+    if self.ratios is None:
+      return
+
+    keys = {str(key).upper() for key in keys}
+    missing = [name for name in self.ratios if name != 'NONE' and name not in keys]
+
+    if missing:
+      raise ValueError('Invalid class ratios! {0} not found among the annotation keys ({1})'.format(', '.join(missing), ', '.join(sorted(keys))))
+
+  def add (self, name, labels):
+    '''
+    Adds a planned chip
+
+    Parameters
+    ----------
+      name : hashable
+        Identifier of the chip (e.g. its filename)
+
+      labels : list
+        Labels of the chip
+    '''
+    stratum = self.stratum(labels)
+    if stratum is None:
+      return
+
+    self.available[stratum] += 1
+
+    if self.method == 'stratified':
+      self.chips[stratum].append(name)
+      return
+
+    # reservoir sampling (algorithm R) of each class
+    reservoir, quota, seen = self.chips[stratum], self.quotas[stratum], self.available[stratum]
+
+    if len(reservoir) < quota:
+      reservoir.append(name)
+    else:
+      j = self._rng.randint(0, seen)
+      if j < quota:
+        reservoir[j] = name
+
+  def update (self, plan):
+    '''
+    Adds the chips planned by getchips
+
+    Parameters
+    ----------
+      plan : ChipPlan
+        The planned chips, identified by their (level, col, row)
+    '''
+    for level, col, row, labels in plan.chips.tolist():
+      self.add((level, col, row), plan.labelkeys(labels))
+
+  def _split (self, total, available):
+    '''
+    Splits total chips among the classes following the ratios (largest remainder)
+    '''
+    ratios = self.ratios if self.ratios is not None else {'ALL' : 1.}
+    ratios = {name : ratios[name] for name in self.classes if ratios[name] > 0 and available[name] > 0}
+
+    norm = sum(ratios.values())
+    exact = {name : total * ratio / norm for name, ratio in ratios.items()}
+    quotas = {name : int(value) for name, value in exact.items()}
+
+    for name in sorted(exact, key=lambda x : quotas[x] - exact[x])[: total - sum(quotas.values())]:
+      quotas[name] += 1
+
+    return {name : quotas.get(name, 0) for name in self.classes}
+
+  def select (self):
+    '''
+    Selects the chips to extract
+
+    Returns
+    -------
+      selected : set
+        Identifiers of the selected chips
+    '''
+    if self.method == 'reservoir':
+      return set(name for names in self.chips.values() for name in names)
+
+    ratios = self.ratios if self.ratios is not None else {'ALL' : 1.}
+    present = [name for name in self.classes if ratios[name] > 0 and self.available[name] > 0]
+
+    if not present:
+      self.quotas = {name : 0 for name in self.classes}
+      return set()
+
+    norm = sum(ratios[name] for name in present)
+    # largest number of chips which keeps the ratios of the present classes
+    total = int(min(self.available[name] * norm / ratios[name] + 1e-9 for name in present))
+    if self.max_chips is not None:
+      total = min(total, self.max_chips)
+
+    self.quotas = self._split(total, self.available)
+
+    selected = set()
+    for name in self.classes:
+      # the selection does not depend on the planning order (e.g. on the bands of the slide)
+      candidates = sorted(self.chips[name])
+      quota = min(self.quotas[name], len(candidates))
+      index = self._rng.choice(len(candidates), size=quota, replace=False) if quota else []
+      selected.update(candidates[i] for i in index)
+
+    return selected
+
+  def summary (self):
+    '''
+    Returns a printable table of the available and selected chips of each class
+    '''
+    quotas = self.quotas or {name : 0 for name in self.classes}
+    rows = ['{0:<20} {1:>10} {2:>10}'.format('class', 'available', 'selected')]
+    rows += ['{0:<20} {1:>10d} {2:>10d}'.format(name, self.available[name], min(quotas[name], self.available[name])) for name in self.classes]
+    return '\n'.join(rows)
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    return '<ChipSampler (method: {0}, classes: {1}, max_chips: {2}, seed: {3})>'.format(self.method, len(self.classes), self.max_chips, self.seed)
@@ -7,15 +7,48 @@ from __future__ import division
 # Import necessary packages
 import os
 import cv2
+import time
 import tqdm
+import socket
+import tempfile
 import numpy as np
+from io import BytesIO
 from PIL import Image
 # from openslide import OpenSlide
-import xml.etree.ElementTree as ET
-from collections import defaultdict
+from functools import partial
+from collections import OrderedDict
+from queue import Full
+from queue import Queue
+from multiprocessing import Pool
+from threading import Event
+from threading import Thread
+from threading import get_ident
+from multiprocessing.pool import ThreadPool
+
+from .contours import readcontours
+from .contours import itercontours
+from .contours import simplifytolerance
+from .statistics import packcolor
+from .statistics import packcolors
+from .statistics import ChipStatistics
+from .sampling import ChipSampler
+from .sampling import shardcap
+from .chipplan import ChipPlan
+from .chipplan import CHIP_DTYPE
+from .labelraster import LabelRaster
+from . import metrics
 
 Image.MAX_IMAGE_PIXELS = 42598083360
 
+# annotation keys loaded by the current process (see keyregistry)
+_KEY_REGISTRY = dict()
+
+# extensions of the annotation files (Seeden Viewer xml or old roi fmt)
+ANNOTATION_EXTENSIONS = ('.xml', '.roi')
+
+# modes (8 bits per band) of the uncompressed slides decoded in part (see rawtiles)
+RAW_MODES = ('L', 'RGB', 'RGBA', 'CMYK')
+
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
 
@@ -45,72 +78,334 @@ def load_parameters (parameters):
   return params
 
 
-def makemask (annotation_key, size, xml_path):
+def parsememory (memory):
   '''
-  Reads xml file and makes annotation mask for entire slide image
+  Converts a memory budget into number of bytes
 
   Parameters
   ----------
-    annotation_key : str
-      Name of the annotation key file
+    memory : str or int
+      Memory budget given as number of bytes or with a K, M, G, T suffix (e.g. '512M', '2G')
 
-    size : tuple
-      Size of the whole slide image
+  Returns
+  -------
+    nbytes : int
+      Number of bytes
+  '''
+  units = {'K' : 1 << 10, 'M' : 1 << 20, 'G' : 1 << 30, 'T' : 1 << 40}
+
+  memory = str(memory).strip().upper().rstrip('B')
+
+  if memory and memory[-1] in units:
+    return int(float(memory[:-1]) * units[memory[-1]])
+
+  return int(float(memory))
+
+
+def loadcontours (annotation_key, xml_path, cache_dir=None, tolerance=None):
+  '''
+  Reads xml file and loads the annotated contours with their color codes
+
+  Parameters
+  ----------
+    annotation_key : str or dict
+      Name of the annotation key file, or in-memory annotation key (see memorykey)
 
     xml_path : str
       Path to the xml file
 
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
+
+    tolerance : float
+      Douglas-Peucker tolerance of the contours (see simplifycontours, None
+      keeps every vertex)
+
   Returns
   -------
-    (mat, annotations) : tuple
-      numpy array with mask annotation and dictionary of annotation keys and color codes
+    (contours, annotations) : tuple
+      list of (color_code, contour) pairs and dictionary of annotation keys and color codes
   '''
 
-  # Import xml file and get root
-  tree = ET.parse(xml_path)
-  root = tree.getroot()
+  # Load the parsed xml file (from the cache if valid)
+  with metrics.stage('parse'):
+    cached = readcontours(xml_path, cache_dir=cache_dir, tolerance=tolerance)
+
+  metrics.count('vertices', len(cached['points']))
 
-  # Generate annotation array and key dictionary
-  mat = np.zeros(shape=(*size[::-1], 3), dtype='uint8')
+  # Generate contours list and key dictionary
+  contours = []
   annotations = dict()
-  # contours = []
 
   # Find data in xml file
-  if not os.path.isfile(annotation_key):
-    print('Could not find {0}, generating new file...'.format(annotation_key))
-    generatekey('{0}'.format(annotation_key), os.path.split(xml_path)[0])
-    print('{0} generated.'.format(annotation_key))
-
-  color_codes = loadkeys(annotation_key)
+  if isinstance(annotation_key, dict):
+    color_codes = annotation_key
+  else:
+    color_codes = keyregistry(annotation_key, os.path.split(xml_path)[0], cache_dir=cache_dir)
 
-  for reg in root.iter('contour'):
-    key = reg.get('name').upper()
+  for key, _, cnt in itercontours(cached):
     if key in color_codes:
       color_code = color_codes[key]
     else:
-      addkeys(annotation_key, key)
-      color_codes = loadkeys(annotation_key)
-      color_code  = color_codes[key]
+      color_code = addkeys(annotation_key, key)
 
-    points = []
-    for child in reg.iter('contour'):
-      for vert in child.iter('point'):
-        x, y = tuple(map(round, eval(vert.text)))
-        points.append((x, y))
-
-    cnt = np.array(points).reshape((-1, 1, 2)).astype(np.int32)
-    cv2.fillPoly(mat, [cnt], color_code)
-    # contours.append(cnt)
+    contours.append((color_code, cnt))
 
     # annotations and colors
     if key not in annotations:
       annotations['{0}'.format(key)] = color_code
   print('annotations loaded successfully')
+
+  return (contours, annotations)
+
+
+def rastermask (contours, size, offset=(0, 0)):
+  '''
+  Rasterizes the annotated contours into a mask
+
+  Parameters
+  ----------
+    contours : list
+      List of (color_code, contour) pairs as returned by loadcontours
+
+    size : tuple
+      Size (width, height) of the mask
+
+    offset : tuple
+      Offset (x, y) added to each contour point, i.e. minus the slide
+      coordinates of the top-left corner of the mask
+
+  Returns
+  -------
+    mat : array_like
+      numpy array with mask annotation
+  '''
+
+  with metrics.stage('rasterize'):
+    mat = np.zeros(shape=(*size[::-1], 3), dtype='uint8')
+
+    for color_code, cnt in contours:
+      cv2.fillPoly(mat, [cnt], color_code, offset=tuple(offset))
+
+  return mat
+
+
+def contouredges (contours):
+  '''
+  Computes the rows spanned by the slanted edges of the contours
+
+  Parameters
+  ----------
+    contours : list
+      List of (color_code, contour) pairs as returned by loadcontours
+
+  Returns
+  -------
+    edges : array_like
+      Array with shape (edges, 2) of the first and last row of each edge
+      which is neither horizontal nor vertical
+
+  Notes
+  -----
+  cv2.fillPoly draws the polygon edges with lines clipped to the buffer: the
+  pixels of a clipped slanted line can differ from the ones of the whole
+  line, while the horizontal and vertical lines are unchanged.
+  '''
+  edges = []
+
+  for _, cnt in contours:
+    points = cnt[:, 0, :].astype(np.int64)
+    # include the closing edge of the polygon
+    following = np.roll(points, -1, axis=0)
+    slanted = (points[:, 0] != following[:, 0]) & (points[:, 1] != following[:, 1])
+    edges.append(np.stack([np.minimum(points[slanted, 1], following[slanted, 1]),
+                           np.maximum(points[slanted, 1], following[slanted, 1])], axis=1))
+
+  return np.concatenate(edges) if edges else np.empty(shape=(0, 2), dtype=np.int64)
+
+
+def contourhalo (edges, upper, lower, height):
+  '''
+  Computes the slide rows to rasterize for a band of the annotation mask
+
+  Parameters
+  ----------
+    edges : array_like
+      Rows of the slanted contour edges as returned by contouredges
+
+    upper : int
+      First slide row of the band
+
+    lower : int
+      Last slide row (excluded) of the band
+
+    height : int
+      Height of the whole slide image
+
+  Returns
+  -------
+    (top, bottom) : tuple
+      Slide rows (bottom excluded) which include the band and the whole
+      rows of the slanted edges which cross it
+  '''
+  crossing = edges[(edges[:, 1] >= upper) & (edges[:, 0] < lower)]
+
+  top = max(min(upper, int(crossing[:, 0].min(initial=upper))), 0)
+  bottom = min(max(lower, int(crossing[:, 1].max(initial=lower - 1)) + 1), height)
+
+  return (top, bottom)
+
+
+def rasterband (contours, size, upper, lower, edges=None):
+  '''
+  Rasterizes a horizontal band of the annotation mask
+
+  Parameters
+  ----------
+    contours : list
+      List of (color_code, contour) pairs as returned by loadcontours
+
+    size : tuple
+      Size (width, height) of the whole slide image
+
+    upper : int
+      First slide row of the band
+
+    lower : int
+      Last slide row (excluded) of the band
+
+    edges : array_like
+      Rows of the slanted contour edges (default computed by contouredges)
+
+  Returns
+  -------
+    mat : array_like
+      numpy array with the mask annotation of the band
+
+  Notes
+  -----
+  The result is identical to rastermask(contours, size)[upper : lower].
+  cv2.fillPoly draws the polygon edges clipped to the buffer, so the band is
+  rasterized including the whole rows of the slanted edges which cross it
+  (see contourhalo).
+  '''
+  width, height = size
+
+  if edges is None:
+    edges = contouredges(contours)
+
+  top, bottom = contourhalo(edges, upper, lower, height)
+
+  mat = rastermask(contours, (width, bottom - top), offset=(0, -top))
+
+  return mat[upper - top : lower - top]
+
+
+def rasterlabels (contours, size, band_bytes=1 << 26):
+  '''
+  Rasterizes the annotated contours into a run-length encoded mask
+
+  Parameters
+  ----------
+    contours : list
+      List of (color_code, contour) pairs as returned by loadcontours
+
+    size : tuple
+      Size (width, height) of the mask
+
+    band_bytes : int
+      Size of the label buffer of each rasterized band
+
+  Returns
+  -------
+    raster : LabelRaster
+      Run-length encoded mask (raster[upper : lower, left : right] is
+      identical to rastermask(contours, size)[upper : lower, left : right])
+
+  Notes
+  -----
+  The contours are filled one band of rows at a time into a single channel
+  label buffer (one byte for each pixel, see rasterband for the rows of the
+  slanted edges which cross the band), whose rows are encoded before the
+  next band is rasterized: the dense mask of the whole slide is never
+  allocated. Only the contours which reach the rows of a band are filled
+  into it. Each band holds at least the rows of the longest slanted edge,
+  so the buffer can exceed band_bytes when the contours have slanted edges
+  longer than band_bytes / width rows (vertical edges are not counted).
+  '''
+  width, height = size
+
+  colors = []
+  for color_code, _ in contours:
+    if tuple(color_code) not in colors:
+      colors.append(tuple(color_code))
+
+  labels = {color : k + 1 for k, color in enumerate(colors)}
+  spans = [(int(cnt[:, 0, 1].min(initial=height)), int(cnt[:, 0, 1].max(initial=-1))) for _, cnt in contours]
+
+  edges = contouredges(contours)
+  longest = int((edges[:, 1] - edges[:, 0]).max(initial=0))
+  # long slanted edges enlarge the bands rather than being rasterized again for each small band
+  band_height = max(band_bytes // max(width, 1) - 2 * longest, longest, 1)
+
+  def bands ():
+
+    for upper in range(0, height, band_height):
+      lower = min(upper + band_height, height)
+      top, bottom = contourhalo(edges, upper, lower, height)
+
+      mat = np.zeros(shape=(bottom - top, width), dtype='uint8')
+
+      for (color_code, cnt), (first, last) in zip(contours, spans):
+        if last >= top and first < bottom:
+          cv2.fillPoly(mat, [cnt], labels[tuple(color_code)], offset=(0, -top))
+
+      yield mat[upper - top : lower - top]
+
+  with metrics.stage('rasterize'):
+    raster = LabelRaster.fromlabels(bands(), width, colors)
+
+  return raster
+
+
+def makemask (annotation_key, size, xml_path, cache_dir=None, rle=False, tolerance=None):
+  '''
+  Reads xml file and makes annotation mask for entire slide image
+
+  Parameters
+  ----------
+    annotation_key : str
+      Name of the annotation key file
+
+    size : tuple
+      Size of the whole slide image
+
+    xml_path : str
+      Path to the xml file
+
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
+
+    rle : bool
+      Whether to return the run-length encoded mask (see rasterlabels)
+
+    tolerance : float
+      Douglas-Peucker tolerance of the contours (see simplifycontours)
+
+  Returns
+  -------
+    (mat, annotations) : tuple
+      numpy array (or LabelRaster) with mask annotation and dictionary of annotation keys and color codes
+  '''
+
+  contours, annotations = loadcontours(annotation_key, xml_path, cache_dir, tolerance)
+  mat = rasterlabels(contours, size) if rle else rastermask(contours, size)
+
   # print(len(mat[mat!=0]))
   return (mat, annotations)
 
 
-def writekeys (filename, annotations):
+def writekeys (filename, annotations, dest='output/textfiles/'):
   '''
   Writes each annotation key to the output text file
 
@@ -122,6 +417,9 @@ def writekeys (filename, annotations):
     annotations : dict
       Dictionary of annotation keys
 
+    dest : str
+      Directory of the text file
+
   Returns
   -------
   None
@@ -131,9 +429,7 @@ def writekeys (filename, annotations):
   This function just updates text file (filename)
   '''
 
-  dest = 'output/textfiles/'
-  path = os.path.dirname(dest)
-  os.makedirs(path, exist_ok=True)
+  os.makedirs(dest, exist_ok=True)
 
   name = '{0}_{1}'.format(os.path.splitext(filename)[0], 'Details.txt')
 
@@ -145,7 +441,7 @@ def writekeys (filename, annotations):
       fp.write(('Mask_Color: {0}\n'.format(value).rjust(50 - len(keyline))))
 
 
-def writeimagelist (filename, image_dictionary):
+def writeimagelist (filename, image_dictionary, dest='output/textfiles/'):
   '''
   Writes list of images containing each annotation key
 
@@ -157,6 +453,9 @@ def writeimagelist (filename, image_dictionary):
     image_dictionary : dict
       Dictionary of images with each key
 
+    dest : str
+      Directory of the text file
+
   Returns
   -------
   None
@@ -165,7 +464,6 @@ def writeimagelist (filename, image_dictionary):
   -----
     Update the Details text file given by {$filename*_Details.txt}
   '''
-  dest = 'output/textfiles/'
   name = '{0}_{1}'.format(os.path.splitext(filename)[0], 'Details.txt')
 
   with open(os.path.join(dest, name), 'a') as fp:
@@ -207,536 +505,2325 @@ def loadkeys (annotation_key):
   return color_codes
 
 
-def addkeys (annotation_key, key):
+def lockfile (annotation_key, timeout=600., delay=.05, stale=600.):
   '''
-  Adds new key and color_code to annotation key
+  Acquires an exclusive lock on a file shared among processes
 
   Parameters
   ----------
-    annotation_key : dict
-      The filename of the annotation key
+    annotation_key : str
+      The filename to lock
 
-    key : str
-      The annotation to be added
+    timeout : float
+      Maximum waiting time (in seconds)
+
+    delay : float
+      Time between two attempts (in seconds)
+
+    stale : float
+      Age (in seconds) after which a lock of another host is considered
+      left behind by a crashed process
 
   Returns
   -------
-  None
+    lock : str
+      The filename of the lock to pass to unlockfile
 
   Notes
   -----
-    Updated annotation key file
+  The lock is the exclusive creation of {annotation_key}.lock, which is atomic
+  on every platform (and on network file systems). The lock stores the host
+  and the PID of its owner: a lock whose owner is no longer running (or older
+  than stale, when the owner can not be checked) is removed (see breaklock).
   '''
+  lock = '{0}.lock'.format(annotation_key)
+  start = time.time()
 
-  color_codes = loadkeys(annotation_key)
-  min_color = min(color_codes.items(), key = lambda x: x[1])[1]
-  new_color = int(min_color[0]) - 1
-  color_codes[key.upper()].append(new_color)
-  writeannotations(annotation_key, color_codes)
+  while True:
+    try:
+      fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+      with os.fdopen(fd, 'w') as fp:
+        fp.write('{0} {1:d}'.format(socket.gethostname(), os.getpid()))
+      return lock
 
+    except FileExistsError:
+      if breaklock(lock, stale):
+        print('Removed the stale lock {0}'.format(lock))
+        continue
 
-def writeannotations (annotation_key, annotations):
+      if time.time() - start > timeout:
+        raise TimeoutError('Could not acquire {0} (remove it if no other process is running)'.format(lock))
+      time.sleep(delay)
+
+
+def isstale (lock, stale=600.):
   '''
-  Writes annotation keys and color codes to annotation key text file
+  Checks if a lock was left behind by a crashed process
 
   Parameters
   ----------
-    annotation_key : str
-      Filename of annotation key
+    lock : str
+      The filename of the lock
 
-    annotations : dict
-      Dictionary of annotation keys and color codes
+    stale : float
+      Age (in seconds) after which a lock is stale if its owner can not be checked
 
   Returns
   -------
-  None
-
-  Notes
-  -----
-  Append to .txt file with annotation keys
+    stale : bool
+      True if the owner of the lock is not running anymore
   '''
-  with open(annotation_key, 'w+') as fp:
-
-    for key, value in sorted(annotations.items()):
-      keyline = 'Key: {0}'.format(key)
-      rgb_color = value.lstrip('#')
-      rgb_color = tuple(int(rgb_color[i : i + 2], 16) for i in (0, 2, 4))
-      fp.write(keyline)
-      fp.write(('Mask_Color: {0}\n'.format(rgb_color).rjust(65 - len(keyline))))
-
-
-def generatekey (annotation_key, path):
+  try:
+    age = time.time() - os.path.getmtime(lock)
+    with open(lock, 'r') as fp:
+      owner = fp.read().split()
+  except (FileNotFoundError, OSError):
+    return False
+
+  # os.kill(pid, 0) would terminate the process on Windows
+  if len(owner) == 2 and owner[0] == socket.gethostname() and os.name != 'nt':
+    try:
+      os.kill(int(owner[1]), 0)
+    except ProcessLookupError:
+      return True
+    except (PermissionError, ValueError):
+      pass
+    return False
+
+  # other hosts (or a lock still being written)
+  return age > stale
+
+
+def breaklock (lock, stale=600.):
   '''
-  Generates annotation_key from folder of xml files
+  Removes a stale lock, unless another process replaced it in the meantime
 
   Parameters
   ----------
-    annotation_key : str
-      The name of the annotation key file
+    lock : str
+      The filename of the lock
 
-    path : str
-      Directory containing xml (roi) files
+    stale : float
+      Age (in seconds) after which a lock is stale if its owner can not be checked
 
   Returns
   -------
-  None
+    removed : bool
+      True if the stale lock was removed by this call
 
   Notes
   -----
-  Write the annotation_key file
+  The lock is first renamed to a name unique to the caller (an atomic
+  operation, which only one of the processes racing on the same stale
+  lock can perform) and then compared with the lock found stale: a lock
+  created by another process between the check and the rename is moved
+  back in place instead of being removed.
   '''
+  try:
+    before = os.stat(lock)
+  except FileNotFoundError:
+    return False
 
-  annotations = dict()
-  for filename in os.listdir(path):
-    # Import xml file and get root
-    tree = ET.parse(os.path.join(path, filename))
-    root = tree.getroot()
-
-    # Find data in xml file
-    for reg in root.iter('contour'):
-      key = reg.get('name').upper()
-      annotations['{0}'.format(key)] = reg.get('color')
-      # if key in annotations:
-      #   continue
-      # else:
-      #   color -= 1
-      #   color_code = color
-      #
-      # if key not in annotations:
-      #   annotations['{0}'.format(key)].append(color_code)
+  if not isstale(lock, stale):
+    return False
 
-  # print annotations to text file
-  writeannotations(annotation_key, annotations)
+  broken = '{0}.{1}.{2:d}.{3:d}.stale'.format(lock, socket.gethostname(), os.getpid(), get_ident())
 
+  try:
+    os.rename(lock, broken)
+  except FileNotFoundError:
+    return False
 
-def attachtags (path, keys):
+  after = os.stat(broken)
+
+  if (after.st_ino, after.st_size, after.st_mtime_ns) == (before.st_ino, before.st_size, before.st_mtime_ns):
+    os.remove(broken)
+    return True
+
+  # (the link fails if a new lock was already created)
+  try:
+    os.link(broken, lock)
+  except FileExistsError:
+    pass
+
+  os.remove(broken)
+  return False
+
+
+def unlockfile (lock):
   '''
-  Attaches image tags to metadata of chips and masks
+  Releases a lock acquired by lockfile
 
   Parameters
   ----------
-    path: str
-      File to attach tags to.
-
-    keys : str
-      keys to attach as tags
+    lock : str
+      The filename of the lock
 
   Returns
   -------
   None
-
-  Notes
-  -----
-  JPG with metadata tags
   '''
-
-  if os.path.splitext(path)[1] == '.png':
+  # (a lock can be broken by another process if its owner hung longer than the stale time)
+  try:
+    os.remove(lock)
+  except FileNotFoundError:
     pass
-  else:
-    import pexif
-
-    metadata = pexif.JpegFile.fromFile(path)
-    str = ' '.join(keys)
-    metadata.exif.primary.ImageDescription = str
-
-    with open(path, 'wb') as out:
-      metadata.writeFd(out)
 
 
-def savechip (chip, path, quality, keys):
+def keyregistry (annotation_key, path=None, nprocs=None, cache_dir=None):
   '''
-  Saves the image chip
+  Returns the in-memory registry of annotation keys and color codes
 
   Parameters
   ----------
-    chip : array_like
-      The slide image chip to save
+    annotation_key : str
+      The filename of the annotation key
 
     path : str
-      The full path to the chip
+      Directory containing xml (roi) files, used to generate the annotation key if missing
 
-    quality : str
-      The output quality
+    nprocs : int
+      Number of processes used to parse the xml files (default all the available cpus)
 
-    keys : str
-      Keys associated with the chip
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
 
   Returns
   -------
-  None
+    color_codes : dict
+      Color codes for each region (region_key : color)
 
   Notes
   -----
-  Save the image chip
+  The annotation key file is loaded (or generated) only once per process:
+  the following calls return the same dictionary, which is kept up to date by addkeys.
   '''
+  filename = os.path.abspath(annotation_key)
 
-  # Ensure directories
-  directory, filename = os.path.split(path)
-  os.makedirs(directory, exist_ok=True)
-  format, suffix = formatcheck(os.path.splitext(filename)[1].strip('.'))
-
-  if suffix == 'jpg':
-    # Save image chip
-    chip.save(path, quality=quality)
+  if filename not in _KEY_REGISTRY:
 
-    # Attach image tags
-    attachtags(path, keys)
+    if not os.path.isfile(annotation_key):
+      lock = lockfile(annotation_key)
+      try:
+        # another process could have generated the file while waiting for the lock
+        if not os.path.isfile(annotation_key):
+          print('Could not find {0}, generating new file...'.format(annotation_key))
+          generatekey(annotation_key, path, nprocs, cache_dir)
+          print('{0} generated.'.format(annotation_key))
+      finally:
+        unlockfile(lock)
 
-  else:
-    # Save image chip
-    chip.save(path)
+    _KEY_REGISTRY[filename] = loadkeys(annotation_key)
 
-    # Attach image tags
-    attachtags(path, keys)
+  return _KEY_REGISTRY[filename]
 
 
-def savemask (mask, path, keys):
+def addkeys (annotation_key, key):
   '''
-  Saves the image masks
+  Adds new key and color_code to annotation key
 
   Parameters
   ----------
-    mask : array_like
-      The image mask to save
-
-    path : str
-      The complete path for the mask
+    annotation_key : str or dict
+      The filename of the annotation key, or in-memory annotation key (see memorykey)
 
-    keys : str
-      keys associated with the chip
+    key : str
+      The annotation to be added
 
   Returns
   -------
-  None
+    color_code : tuple
+      The color code associated to the key
+
+  Notes
+  -----
+    Updated annotation key file (and in-memory registry), or in-memory key.
+    The new color code decreases the minimum (first) color component already in use.
+    The file is re-read under lock, so keys added by other processes are preserved.
   '''
+  key = key.upper()
 
-  # Ensure directories
-  directory, filename = os.path.split(path)
-  os.makedirs(directory, exist_ok=True)
-  format, suffix = formatcheck(os.path.splitext(filename)[1].strip('.'))
+  if isinstance(annotation_key, dict):
+    if key not in annotation_key:
+      annotation_key[key] = nextcolor(annotation_key, key, 'the in-memory annotation key')
+    return annotation_key[key]
 
-  if suffix == 'jpg':
-    # Save the image mask
-    cv2.imwrite(path, mask, [cv2.IMWRITE_JPEG_QUALITY, 100])
+  color_codes = keyregistry(annotation_key)
 
-    # Attach image tags
-    attachtags(path, keys)
+  lock = lockfile(annotation_key)
+  try:
+    # merge the keys added by other processes sharing the same file
+    color_codes.update(loadkeys(annotation_key))
+
+    if key not in color_codes:
+      color_codes[key] = nextcolor(color_codes, key, annotation_key)
+      writeannotations(annotation_key, color_codes)
+
+  finally:
+    unlockfile(lock)
+
+  return color_codes[key]
+
+
+def nextcolor (color_codes, key, annotation_key):
+  '''
+  Returns the color code of a new annotation key
+
+  Parameters
+  ----------
+    color_codes : dict
+      Color codes already in use (region_key : color)
+
+    key : str
+      The annotation to be added
+
+    annotation_key : str
+      Name of the annotation key (for the error message)
+
+  Returns
+  -------
+    color_code : tuple
+      The gray color code below the minimum (first) color component in use
+      (or the largest free one)
+  '''
+  used = {int(color[0]) for color in color_codes.values()}
+  free = set(range(256)) - used
+
+  if not free:
+    raise ValueError('Too many annotation keys! All the 256 color codes of {0} are already used (adding {1})'.format(annotation_key, key))
+
+  min_color = min(used, default=256)
+  new_color = min_color - 1 if min_color > 0 else max(free)
+
+  return (new_color, new_color, new_color)
+
+
+def writeannotations (annotation_key, annotations):
+  '''
+  Writes annotation keys and color codes to annotation key text file
+
+  Parameters
+  ----------
+    annotation_key : str
+      Filename of annotation key
+
+    annotations : dict
+      Dictionary of annotation keys and color codes (hex string or rgb tuple)
+
+  Returns
+  -------
+  None
+
+  Notes
+  -----
+  The file is written in a temporary file and then moved to annotation_key,
+  so concurrent readers never see a partial file.
+  '''
+  directory = os.path.dirname(os.path.abspath(annotation_key))
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+
+  with os.fdopen(fd, 'w') as fp:
+
+    for key, value in sorted(annotations.items()):
+      keyline = 'Key: {0}'.format(key)
+      rgb_color = colortuple(value)
+      fp.write(keyline)
+      fp.write(('Mask_Color: {0}\n'.format(rgb_color).rjust(65 - len(keyline))))
+
+  os.replace(tmp, annotation_key)
+
+
+def colortuple (value):
+  '''
+  Converts a color code (hex string or rgb sequence) into a rgb tuple of int
+  '''
+  if isinstance(value, str):
+    value = value.lstrip('#')
+    return tuple(int(value[i : i + 2], 16) for i in (0, 2, 4))
+
+  return tuple(map(int, value))
+
+
+def parsekeys (filename, cache_dir=None):
+  '''
+  Reads the annotation keys and colors from a xml (roi) file
+
+  Parameters
+  ----------
+    filename : str
+      Path to the xml file
+
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
+
+  Returns
+  -------
+    annotations : list
+      List of (key, color) pairs in order of appearance
+  '''
+  contours = readcontours(filename, cache_dir=cache_dir)
+
+  return list(zip(map(str, contours['names']), map(str, contours['colors'])))
+
+
+def generatekey (annotation_key, path, nprocs=None, cache_dir=None):
+  '''
+  Generates annotation_key from folder of xml files
+
+  Parameters
+  ----------
+    annotation_key : str
+      The name of the annotation key file
+
+    path : str
+      Directory containing xml (roi) files
+
+    nprocs : int
+      Number of processes used to parse the xml files (default all the available cpus)
+
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
+
+  Returns
+  -------
+  None
+
+  Notes
+  -----
+  Write the annotation_key file
+  '''
+
+  # print annotations to text file
+  writeannotations(annotation_key, collectkeys(path, nprocs, cache_dir))
+
+
+def memorykey (path, nprocs=None, cache_dir=None):
+  '''
+  Generates the annotation key of a folder of xml files in memory
+
+  Parameters
+  ----------
+    path : str
+      Directory containing xml (roi) files
+
+    nprocs : int
+      Number of processes used to parse the xml files (default all the available cpus)
+
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
+
+  Returns
+  -------
+    color_codes : dict
+      Color codes for each region (region_key : color), the same loaded
+      from the file written by generatekey. New keys are added to the
+      dictionary (see addkeys), never to a file.
+  '''
+  annotations = collectkeys(path, nprocs, cache_dir)
+
+  return {key.strip() : colortuple(value) for key, value in sorted(annotations.items())}
+
+
+def collectkeys (path, nprocs=None, cache_dir=None):
+  '''
+  Reads the annotation keys and colors of a folder of xml files
+
+  Parameters
+  ----------
+    path : str
+      Directory containing xml (roi) files
+
+    nprocs : int
+      Number of processes used to parse the xml files (default all the available cpus)
+
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
+
+  Returns
+  -------
+    annotations : dict
+      Color of each key (the last one found, following the file order)
+  '''
+
+  files = [os.path.join(path, filename) for filename in os.listdir(path)]
+  # only the annotation files (skip e.g. the contour cache, key files and their locks)
+  files = [filename for filename in files if os.path.isfile(filename) and os.path.splitext(filename)[1].lower() in ANNOTATION_EXTENSIONS]
+  nprocs = min(nprocs or os.cpu_count() or 1, len(files))
+
+  annotations = dict()
+
+  if nprocs > 1:
+    with Pool(nprocs) as pool:
+      # imap keeps the file order, so the last color of a key wins as in the serial version
+      for pairs in pool.imap(partial(parsekeys, cache_dir=cache_dir), files):
+        annotations.update(pairs)
+
+  else:
+    for filename in files:
+      annotations.update(parsekeys(filename, cache_dir))
+
+  return annotations
+
+
+def attachtags (path, keys):
+  '''
+  Attaches image tags to metadata of chips and masks
+
+  Parameters
+  ----------
+    path: str
+      File to attach tags to.
+
+    keys : str
+      keys to attach as tags
+
+  Returns
+  -------
+  None
+
+  Notes
+  -----
+  JPG with metadata tags
+  '''
+
+  if os.path.splitext(path)[1] == '.png':
+    pass
+  else:
+    import pexif
+
+    metadata = pexif.JpegFile.fromFile(path)
+    str = ' '.join(keys)
+    metadata.exif.primary.ImageDescription = str
+
+    with open(path, 'wb') as out:
+      metadata.writeFd(out)
+
+
+def writefile (path, data):
+  '''
+  Writes the encoded bytes of an image
+
+  Parameters
+  ----------
+    path : str
+      Output filename
+
+    data : bytes
+      Encoded image
+
+  Returns
+  -------
+  None
+  '''
+  with metrics.stage('write'):
+    with open(path, 'wb') as fp:
+      fp.write(data)
+
+  metrics.count('bytes', len(data))
+
+
+def savechip (chip, path, quality, keys):
+  '''
+  Saves the image chip
+
+  Parameters
+  ----------
+    chip : array_like
+      The slide image chip to save
+
+    path : str
+      The full path to the chip
+
+    quality : str
+      The output quality
+
+    keys : str
+      Keys associated with the chip
+
+  Returns
+  -------
+  None
+
+  Notes
+  -----
+  Save the image chip
+  '''
+
+  # Ensure directories
+  directory, filename = os.path.split(path)
+  os.makedirs(directory, exist_ok=True)
+  format, suffix = formatcheck(os.path.splitext(filename)[1].strip('.'))
+
+  # the chip is encoded in memory, so the encoding and the filesystem writes are measured separately
+  with metrics.stage('encode'):
+    buffer = BytesIO()
+
+    if suffix == 'jpg':
+      chip.save(buffer, format=format, quality=quality)
+    else:
+      chip.save(buffer, format=format)
+
+  writefile(path, buffer.getvalue())
+
+  # Attach image tags
+  attachtags(path, keys)
+
+
+def savemask (mask, path, keys):
+  '''
+  Saves the image masks
+
+  Parameters
+  ----------
+    mask : array_like
+      The image mask to save
+
+    path : str
+      The complete path for the mask
+
+    keys : str
+      keys associated with the chip
+
+  Returns
+  -------
+  None
+  '''
+
+  # Ensure directories
+  directory, filename = os.path.split(path)
+  os.makedirs(directory, exist_ok=True)
+  format, suffix = formatcheck(os.path.splitext(filename)[1].strip('.'))
+
+  with metrics.stage('encode'):
+    if suffix == 'jpg':
+      _, buffer = cv2.imencode('.jpg', mask, [cv2.IMWRITE_JPEG_QUALITY, 100])
+    else:
+      _, buffer = cv2.imencode('.{0}'.format(suffix), mask)
+
+  # Save the image mask
+  writefile(path, buffer.tobytes())
+
+  # Attach image tags
+  attachtags(path, keys)
+
+
+def checksave (save_all, pix_list, save_ratio, save_count_annotated, save_count_blank):
+  '''
+  Checks whether or not an image chip should be saved
+
+  Parameters
+  ----------
+    save_all : bool
+      saves all chips if true
+
+    pix_list : list
+      list of pixel values in image mask
+
+    save_ratio : float
+      Ratio of annotated chips to unannotated chips
+
+    save_count_annotated : int
+      Total annotated chips saved
+
+    save_count_blank : int
+      Total blank chips saved
+
+  Returns
+  -------
+    save : bool
+      True if the current image has to be saved
+  '''
+
+  if save_all and len(list(filter(lambda x: x > 0, pix_list))) > 0:
+    save = True
+  elif save_count_annotated / save_count_blank > save_ratio:
+    save = True
+  elif len(list(filter(lambda x: x > 0, pix_list))) > 0:
+    save = True
+  else:
+    save = False
+
+  return save
+
+
+def formatcheck (format):
+  '''
+  Assures correct format parameter was defined correctly
+
+  Parameters
+  ----------
+    format: str
+      The output format parameter
+
+  Returns
+  -------
+    format : str
+      image fmt
+
+    suffix : str
+      image suffix (e.g 'jpg')
+  '''
+  if format.lower() == 'jpg':
+    suffix = format
+    format = 'JPEG'
+
+  elif format.lower() == 'jpeg':
+    format = format.upper()
+    suffix = 'jpg'
+
+  else:
+    format = format.upper()
+    suffix = format.lower()
+
+  return (format, suffix)
+
+
+def openwholeslide (path):
+  '''
+  Opens a whole slide image
+
+  Parameters
+  ----------
+    path : str
+      Slide image path.
+
+  Returns
+  -------
+    osr : OpenSlide
+      openslide obj
+  '''
+
+  directory, filename = os.path.split(path)
+  print('loading {0} ...'.format(filename), end='')
+
+  # Open Slide Image
+  # osr = OpenSlide(path)
+  osr = Image.open(path)
+
+  print('[done]')
+  return osr
+
+
+def readregion (osr, box):
+  '''
+  Reads a rectangular region of the slide at its maximum resolution
+
+  Parameters
+  ----------
+    osr : OpenSlide or PIL.Image
+      Slide obj as returned by openwholeslide
+
+    box : tuple
+      Region (left, upper, right, lower) in slide coordinates
+
+  Returns
+  -------
+    region : PIL.Image
+      RGB image of the region (zero padded outside the slide)
+
+  Notes
+  -----
+  OpenSlide decodes only the tiles of the region, and so does PIL for an
+  uncompressed TIFF (see rawtiles). Otherwise PIL cannot decode a part of
+  the image: the first crop decodes the whole slide, which is kept by the
+  slide obj for the following regions (see checkdecode).
+  '''
+  left, upper, right, lower = map(int, box)
+
+  with metrics.stage('read'):
+    if hasattr(osr, 'read_region'):
+      region = osr.read_region((left, upper), 0, (right - left, lower - upper))
+    else:
+      tiles = rawtiles(osr)
+      region = osr.crop(box=(left, upper, right, lower)) if tiles is None else readraw(osr, tiles, (left, upper, right, lower))
+
+    return region.convert('RGB')
+
+
+def rawtiles (osr):
+  '''
+  Returns the uncompressed tiles (or strips) of a PIL slide, which can be decoded in part
+
+  Parameters
+  ----------
+    osr : OpenSlide or PIL.Image
+      Slide obj as returned by openwholeslide
+
+  Returns
+  -------
+    tiles : list
+      (extents, offset, stride, ystep) of each tile of the file, None if the
+      slide is compressed (or already decoded) and must be cropped from the
+      whole image
+  '''
+  tiles = getattr(osr, 'tile', None)
+
+  # (the orientation of a TIFF is applied to the whole image)
+  if not tiles or not getattr(osr, 'filename', None) or osr.mode not in RAW_MODES or getattr(osr, '_tile_orientation', None):
+    return None
+
+  bpp = len(osr.getbands())
+  raw = []
+
+  for decoder, extents, offset, args in tiles:
+    rawmode, stride, ystep = (tuple(args) + (0, 1))[:3] if isinstance(args, tuple) else (args, 0, 1)
+
+    if decoder != 'raw' or rawmode != osr.mode:
+      return None
+
+    x0, y0, x1, y1 = extents
+    raw.append(((x0, y0, x1, y1), offset, stride or (x1 - x0) * bpp, ystep))
+
+  return raw
+
+
+def readraw (osr, tiles, box):
+  '''
+  Decodes a region of an uncompressed slide from its file
+
+  Parameters
+  ----------
+    osr : PIL.Image
+      Slide obj as returned by openwholeslide
+
+    tiles : list
+      Raw tiles of the slide (see rawtiles)
+
+    box : tuple
+      Region (left, upper, right, lower) in slide coordinates
+
+  Returns
+  -------
+    region : PIL.Image
+      Image of the region (zero padded outside the slide), in the mode of the slide
+
+  Notes
+  -----
+  Only the rows (and columns) of the region are read from each tile: the
+  file is opened again, so the slide obj is never decoded and different
+  regions can be read in parallel.
+  '''
+  left, upper, right, lower = box
+  bpp = len(osr.getbands())
+
+  region = None
+
+  with open(osr.filename, 'rb') as fp:
+
+    for (x0, y0, x1, y1), offset, stride, ystep in tiles:
+      l, u, r, d = max(x0, left), max(y0, upper), min(x1, right), min(y1, lower)
+
+      if l >= r or u >= d:
+        continue
+
+      # (the rows of a bottom-up tile are stored from the last one)
+      row = u - y0 if ystep > 0 else y1 - d
+      fp.seek(offset + row * stride + (l - x0) * bpp)
+      data = fp.read((d - u - 1) * stride + (r - l) * bpp)
+
+      part = Image.frombytes(osr.mode, (r - l, d - u), data, 'raw', osr.mode, stride, ystep)
+
+      if (l, u, r, d) == (left, upper, right, lower):
+        return part
+
+      if region is None:
+        region = Image.new(osr.mode, (right - left, lower - upper))
+      region.paste(part, (l - left, u - upper))
+
+  return Image.new(osr.mode, (right - left, lower - upper)) if region is None else region
+
+
+def checkdecode (osr, max_memory):
+  '''
+  Warns if the whole slide is decoded by the first region read, beyond the memory budget
+
+  Parameters
+  ----------
+    osr : OpenSlide or PIL.Image
+      Slide obj as returned by openwholeslide
+
+    max_memory : int
+      Memory budget (in bytes)
+
+  Returns
+  -------
+    fits : bool
+      False if the decoded slide exceeds the budget
+  '''
+  if hasattr(osr, 'read_region') or rawtiles(osr) is not None:
+    return True
+
+  width, height = osr.size
+  nbytes = width * height * len(osr.getbands())
+
+  if nbytes <= max_memory:
+    return True
+
+  print('Warning: {0} is compressed (or not a TIFF) and it is decoded whole at the first read: {1} bytes exceed the memory budget of {2} bytes'.format(
+        os.path.basename(getattr(osr, 'filename', '') or 'the slide'), nbytes, max_memory))
+
+  return False
+
+
+def curatemask (mask, scale_width, scale_height, chip_size):
+  '''
+  Resize and pad annotation mask if necessary
+
+  Parameters
+  ----------
+    mask : array_like
+      An image mask
+
+    scale_width : int
+      Scaling for higher magnification levels
+
+    scale_height : int
+      Scaling for higher magnification levels
+
+  Returns
+  -------
+    mask : array_like
+      The resized mask (annotated) matrix
+  '''
+  # Resize and pad annotation mask if necessary
+  mask = cv2.resize(mask, dsize=None, fx=1. / scale_width, fy=1. / scale_height,
+                    interpolation=cv2.INTER_CUBIC)
+
+  mask_width, mask_height, mask_color = mask.shape
+  if mask_height < chip_size or mask_width < chip_size:
+    mask = np.pad(mask, ((0, chip_size - mask_width),
+                         (0, chip_size - mask_height),
+                         (0, 0)), 'constant')
+
+  if mask_height > chip_size or mask_width > chip_size:
+    mask = mask[:chip_size, :chip_size, ...]
+
+  return mask
+
+
+def shardrange (positions, shard, nshards):
+  '''
+  Extracts the contiguous band of positions assigned to a shard
+
+  Parameters
+  ----------
+    positions : range
+      Full series of chip positions along one axis
+
+    shard : int
+      Index of the required band (0 <= shard < nshards)
+
+    nshards : int
+      Number of bands in which positions are split
+
+  Returns
+  -------
+    band : range
+      Positions belonging to the given shard
+
+  Notes
+  -----
+  The bands are balanced (their lengths differ at most by one) and their
+  concatenation in shard order gives back the original positions.
+  '''
+  if not 0 <= shard < nshards:
+    raise ValueError('Invalid shard {0} for {1} shards'.format(shard, nshards))
+
+  num = len(positions)
+  return positions[shard * num // nshards : (shard + 1) * num // nshards]
+
+
+def getchips (levels, dims, chip_size, overlap, mask, annotations, filename, suffix, save_all, save_ratio, shard=0, nshards=1, rows=None, origin=(0, 0),
+              blank=False, selected=None):
+  '''
+  Finds chip locations that should be loaded and saved
+
+  Parameters
+  ----------
+    levels : int
+      Levels in whole slide image
+
+    dims : tuple
+      Dimension of whole slide image
+
+    chip_size : int
+      The size of the image chips
+
+    overlap : int
+      Overlap between image chips (stride)
+
+    mask : array_like or LabelRaster
+      Annotation mask for slide image
+
+    annotations : dict
+      Dictionary of annotations in image
+
+    filename : str
+      Slide image filename
+
+    suffix : str
+      Output format for saving.
+
+    save_all : bool
+      Whether or not to save every image chip
+
+    save_ratio : float
+      Ratio of annotated to unannotated chips
+
+    shard : int
+      Index of the band of columns to scan (0 <= shard < nshards)
+
+    nshards : int
+      Number of contiguous column bands in which each level is split
+
+    rows : range
+      Row positions to scan (default all the rows of the level)
+
+    origin : tuple
+      Slide coordinates (x, y) of the top-left corner of the mask, used when
+      the mask covers only a band of the slide
+
+    blank : bool
+      Whether or not to include also the chips without annotated pixels (keys NONE)
+
+    selected : set
+      (level, col, row) of the chips to keep (e.g. as sampled by ChipSampler, None keeps all the chips)
+
+  Returns
+  -------
+    plan : ChipPlan
+      Level, col, row and annotation keys of the chips (the chip names and
+      the lists of chips of each annotation key are generated by the plan)
+  '''
+
+  # bit of each annotation key in the chip labels
+  keys = list(annotations)
+  colors = [packcolor(annotations[key]) for key in keys]
+  chips = []
+
+  rle = isinstance(mask, LabelRaster)
+
+  for i in range(levels):
+    width, height = dims[i]
+    scale_factor_width = dims[0][0] / width
+    scale_factor_height = dims[0][1] / height
+    print('Scanning slide level {0} of {1}'.format(i + 1, levels))
+
+    level_rows = range(0, height, chip_size - overlap) if rows is None else rows
+    level_cols = shardrange(range(0, width, chip_size - overlap), shard, nshards)
+    x0, y0 = origin
+
+    level_chips = np.empty(shape=(len(level_cols) * len(level_rows), ), dtype=CHIP_DTYPE)
+    n = 0
+
+    # Generate the image chip coordinates and save information
+    for col in tqdm.tqdm(level_cols):
+      for row in level_rows:
+
+        # Skip the chips discarded by the sampling
+        if selected is not None and (i, col, row) not in selected:
+          continue
+
+        upper, lower = int(row * scale_factor_height) - y0, int((row + chip_size) * scale_factor_height) - y0
+        left, right = int(col * scale_factor_width) - x0, int((col + chip_size) * scale_factor_width) - x0
+
+        if rle:
+          # the label raster answers from the runs of the chip rows
+          labels = mask.colorset(upper, lower, left, right)
+          annotated = any(labels)
+        else:
+          img_mask = mask[upper : lower, left : right]
+          labels = None
+          annotated = img_mask.any()
+
+        # Check whether or not to save the region
+        if save_all and annotated:
+          save = True
+        else:
+          save = blank
+        #save = checksave(save_all, pix_list, save_ratio, save_count_annotated, save_count_blank)
+
+        # Save chip location and keys.
+        if save is True:
+          if labels is None:
+            # compare whole colors: the single channel values are shared by different colors
+            labels = set(np.unique(packcolors(img_mask)).tolist())
+
+          level_chips[n] = (i, col, row, sum(1 << k for k, color in enumerate(colors) if color in labels))
+          n += 1
+
+    chips.append(level_chips[:n].copy())
+
+  return ChipPlan(np.concatenate(chips), keys, dims[:levels], filename.rstrip('.svs'), suffix)
+
+
+def bandbytes (size, upper, lower, edges=None):
+  '''
+  Computes the memory of the buffers of a band of slide rows
+
+  Parameters
+  ----------
+    size : tuple
+      Size (width, height) of the whole slide image
+
+    upper : int
+      First slide row of the band
+
+    lower : int
+      Last slide row (excluded) of the band
+
+    edges : array_like
+      Rows of the slanted contour edges as returned by contouredges (None
+      if the mask is not rasterized by rasterband)
+
+  Returns
+  -------
+    nbytes : int
+      Bytes of the RGB slide region and RGBA decoding buffer of the band
+      and of the RGB annotation mask of its rasterized rows
+  '''
+  width, height = size
+  top, bottom = (upper, lower) if edges is None else contourhalo(edges, upper, lower, height)
+
+  return width * ((lower - upper) * (3 + 4) + (bottom - top) * 3)
+
+
+def rowbands (size, chip_size, overlap, max_memory, edges=None):
+  '''
+  Splits the chip rows of a slide into horizontal bands fitting a memory budget
+
+  Parameters
+  ----------
+    size : tuple
+      Size (width, height) of the whole slide image
+
+    chip_size : int
+      The size of the image chips
+
+    overlap : int
+      Overlap between image chips (stride)
+
+    max_memory : int
+      Memory budget (in bytes) for the band buffers
+
+    edges : array_like
+      Rows of the slanted contour edges rasterized with each band (see
+      contourhalo), or None
+
+  Returns
+  -------
+    bands : list
+      List of ranges of chip row positions, one for each band
+
+  Notes
+  -----
+  Each band holds the rows of its chips plus the chip_size halo required by
+  the chips which straddle the band edge, i.e. (len(band) - 1) * stride + chip_size
+  slide rows of RGB image, RGB mask and decoding buffer; the bands crossed by
+  long slanted edges are shrunk to fit the budget (see bandbytes).
+  A ValueError is raised if a single row of chips does not fit the budget.
+  '''
+  width, height = size
+  step = chip_size - overlap
+  rows = range(0, height, step)
+
+  # RGB slide region + RGB annotation mask + RGBA decoding buffer
+  row_bytes = width * (3 + 3 + 4)
+  nrows = max((max_memory // row_bytes - chip_size) // step + 1, 1)
+
+  bands, first = [], 0
+
+  while first < len(rows):
+    n = min(nrows, len(rows) - first)
+
+    while bandbytes(size, rows[first], min(rows[first + n - 1] + chip_size, height), edges) > max_memory:
+      if n == 1:
+        raise ValueError('Invalid memory budget! {0} bytes required for the row of chips at {1} (given {2})'.format(
+                         bandbytes(size, rows[first], min(rows[first] + chip_size, height), edges), rows[first], max_memory))
+      n //= 2
+
+    bands.append(rows[first : first + n])
+    first += n
+
+  return bands
+
+
+def slidebands (osr, contours, chip_size, overlap, max_memory=None, margin=0, read=True, rle=False):
+  '''
+  Iterates over the horizontal bands of a slide with their annotation masks
+
+  Parameters
+  ----------
+    osr : OpenSlide or PIL.Image
+      Slide obj as returned by openwholeslide
+
+    contours : list
+      List of (color_code, contour) pairs as returned by loadcontours
+
+    chip_size : int
+      The size of the image chips
+
+    overlap : int
+      Overlap between image chips (stride)
+
+    max_memory : str or int
+      Memory budget of each band (None processes the whole slide at once)
+
+    margin : int
+      Extra slide rows loaded on both sides of each band (e.g. the context of the chips)
+
+    read : bool
+      Whether or not to read the slide (False yields only the masks, e.g. for planning)
+
+    rle : bool
+      Whether or not to encode the mask as a LabelRaster (see rasterlabels)
+
+  Returns
+  -------
+    iterator : generator
+      (rows, region, mask, origin) of each band: the chip row positions
+      (None for all the rows), the slide (or band) image (None if read is
+      False), its annotation mask and the slide coordinates (x, y) of their
+      top-left corner
+
+  Notes
+  -----
+  With rle the mask of the whole slide is encoded once and each band gets a
+  view of its rows.
+  The budget bounds the band buffers (see rowbands): a compressed slide
+  opened with PIL is decoded whole, with a warning if it does not fit the
+  budget (see readregion and checkdecode).
+  '''
+  size = osr.size
+  width, height = size
+
+  raster = None
+  if rle:
+    # the label buffer, its padded copy and the run boundaries of each encoded band fit the budget too (see encoderows)
+    raster = rasterlabels(contours, size) if max_memory is None else rasterlabels(contours, size, min(parsememory(max_memory) // 3, 1 << 26))
+
+  if max_memory is None:
+    yield (None, osr if read else None, raster if rle else rastermask(contours, size), (0, 0))
+    return
+
+  if read:
+    checkdecode(osr, parsememory(max_memory))
+
+  edges = None if rle else contouredges(contours)
+  # the margin rows are loaded for each band
+  max_memory = parsememory(max_memory) - 2 * margin * width * (3 + 3 + 4)
+  bands = rowbands(size, chip_size, overlap, max_memory, edges)
+  print('Processing the slide in {0} bands'.format(len(bands)))
+
+  for band in bands:
+    # the band includes the halo of the chips which straddle its lower edge
+    upper = max(band[0] - margin, 0)
+    lower = min(band[-1] + chip_size + margin, height)
+    if read:
+      print('Loading slide rows {0}-{1} of {2}'.format(upper, lower, height))
+
+    # no reference to the band buffers is kept here, so they are released by the caller
+    region = readregion(osr, (0, upper, width, lower)) if read else None
+    yield (band, region, raster.band(upper, lower) if rle else rasterband(contours, size, upper, lower, edges), (0, upper))
+
+
+def sweepbands (osr, contours, configs, max_memory=None, margin=0, read=True, rle=False):
+  '''
+  Iterates over the horizontal bands of a slide shared by several chip grids
+
+  Parameters
+  ----------
+    osr : OpenSlide or PIL.Image
+      Slide obj as returned by openwholeslide
+
+    contours : list
+      List of (color_code, contour) pairs as returned by loadcontours
+
+    configs : list
+      List of (chip_size, overlap) pairs (see parsesweep)
+
+    max_memory : str or int
+      Memory budget of each band (None processes the whole slide at once)
+
+    margin : int
+      Extra slide rows loaded on both sides of each band (e.g. the context of the chips)
+
+    read : bool
+      Whether or not to read the slide (False yields only the masks, e.g. for planning)
+
+    rle : bool
+      Whether or not to encode the mask as a LabelRaster (see rasterlabels)
+
+  Returns
+  -------
+    iterator : generator
+      (rows, region, mask, origin) of each band as slidebands, with rows
+      the list of the chip row positions of each configuration
+
+  Notes
+  -----
+  Each band is read and rasterized once for all the configurations: the
+  chips of a configuration whose row starts inside the band are planned on
+  it, so the band includes the halo of the largest chip size.
+  '''
+  size = osr.size
+  width, height = size
+
+  raster = None
+  if rle:
+    # the label buffer, its padded copy and the run boundaries of each encoded band fit the budget too (see encoderows)
+    raster = rasterlabels(contours, size) if max_memory is None else rasterlabels(contours, size, min(parsememory(max_memory) // 3, 1 << 26))
+
+  if max_memory is None:
+    yield ([None] * len(configs), osr if read else None, raster if rle else rastermask(contours, size), (0, 0))
+    return
+
+  if read:
+    checkdecode(osr, parsememory(max_memory))
+
+  edges = None if rle else contouredges(contours)
+  largest = max(chip_size for chip_size, _ in configs)
+
+  # the margin rows are loaded for each band
+  max_memory = parsememory(max_memory) - 2 * margin * width * (3 + 3 + 4)
+
+  # RGB slide region + RGB annotation mask + RGBA decoding buffer (as rowbands)
+  row_bytes = width * (3 + 3 + 4)
+  band_height = max(max_memory // row_bytes - largest + 1, 1)
+
+  # the bands crossed by long slanted edges are shrunk to fit the budget
+  bands, first = [], 0
+  while first < height:
+    last = min(first + band_height, height)
+
+    while bandbytes(size, first, min(last - 1 + largest, height), edges) > max_memory:
+      if last - first == 1:
+        raise ValueError('Invalid memory budget! {0} bytes required for the chips at row {1} (given {2})'.format(
+                         bandbytes(size, first, min(first + largest, height), edges), first, max_memory))
+      last = first + (last - first) // 2
+
+    bands.append((first, last))
+    first = last
+
+  grids = [range(0, height, chip_size - overlap) for chip_size, overlap in configs]
+  print('Processing the slide in {0} bands'.format(len(bands)))
+
+  for first, last in bands:
+
+    # chip rows starting in [first, last) for each grid
+    rows = [grid[-(-first // grid.step) : -(-last // grid.step)] for grid in grids]
+
+    if not any(len(band) for band in rows):
+      continue
+
+    upper = max(first - margin, 0)
+    lower = min(max(band[-1] + chip_size for band, (chip_size, _) in zip(rows, configs) if len(band)) + margin, height)
+    if read:
+      print('Loading slide rows {0}-{1} of {2}'.format(upper, lower, height))
+
+    region = readregion(osr, (0, upper, width, lower)) if read else None
+    yield (rows, region, raster.band(upper, lower) if rle else rasterband(contours, size, upper, lower, edges), (0, upper))
+
+
+def cropchip (region, mask, origin, chip, chip_size):
+  '''
+  Crops an image chip and its mask
+
+  Parameters
+  ----------
+    region : OpenSlide or PIL.Image
+      Slide obj or slide region which contains the chip
+
+    mask : array_like
+      Annotation mask of the same region
+
+    origin : tuple
+      Slide coordinates (x, y) of the top-left corner of region and mask
+
+    chip : list
+      Chip keys, level, col, row and scale factors (as stored by getchips)
+
+    chip_size : int
+      The size of the image chips
+
+  Returns
+  -------
+    (img, img_mask) : tuple
+      RGB image chip and curated chip mask
+  '''
+  x0, y0 = origin
+  keys, i, col, row, scale_factor_width, scale_factor_height = chip
+
+  left  = int(col * scale_factor_width)  - x0
+  upper = int(row * scale_factor_height) - y0
+
+  # load chip region from slide image
+  # img = osr.read_region([int(col * scale_factor_width), int(row * scale_factor_height)], i,
+  #                       [int(parameters['size']), int(parameters['size'])]).convert('RGB')
+  img = region.crop(box=(left, upper, left + chip_size, upper + chip_size)).convert('RGB')
+
+  # load image mask and curate
+  img_mask = mask[upper : int((row + chip_size) * scale_factor_height) - y0,
+                  left  : int((col + chip_size) * scale_factor_width)  - x0]
+
+  img_mask = curatemask(img_mask, scale_factor_width, scale_factor_height, chip_size)
+
+  return (img, img_mask)
+
+
+def parsescales (context):
+  '''
+  Converts the context scales into a sorted list of integer downsampling factors
+
+  Parameters
+  ----------
+    context : list or str
+      Context scales (e.g. [1, 2, 4] or '1,2,4'); the base scale 1 is always included
+
+  Returns
+  -------
+    scales : list
+      Sorted list of unique scales
+  '''
+  if context is None:
+    return [1]
+
+  if isinstance(context, str):
+    context = context.replace(',', ' ').split()
+
+  scales = sorted(set(int(s) for s in context) | {1})
+
+  if scales[0] < 1:
+    raise ValueError('Invalid context scales {0}: scales must be positive integers'.format(context))
+
+  return scales
+
+
+def contextmargin (chip_size, scales):
+  '''
+  Computes the slide margin around a chip required by its largest context
+
+  Parameters
+  ----------
+    chip_size : int
+      The size of the image chips
+
+    scales : list
+      Context scales as returned by parsescales
+
+  Returns
+  -------
+    margin : int
+      Number of slide pixels of the largest context outside the chip on each side
+  '''
+  return -(-(max(scales) - 1) * chip_size // 2)
+
+
+def padcrop (array, left, upper, width, height):
+  '''
+  Crops a rectangle of an array, zero padded outside its bounds
+
+  Parameters
+  ----------
+    array : array_like
+      Image or mask with shape (rows, cols, ...)
+
+    left : int
+      First column of the rectangle
+
+    upper : int
+      First row of the rectangle
+
+    width : int
+      Width of the rectangle
+
+    height : int
+      Height of the rectangle
+
+  Returns
+  -------
+    crop : array_like
+      Array with shape (height, width, ...)
+  '''
+  crop = np.zeros(shape=(height, width, *array.shape[2:]), dtype=array.dtype)
+
+  top, bottom = max(upper, 0), min(upper + height, array.shape[0])
+  first, last = max(left, 0), min(left + width, array.shape[1])
+
+  if bottom > top and last > first:
+    crop[top - upper : bottom - upper, first - left : last - left] = array[top : bottom, first : last]
+
+  return crop
+
+
+def cropcontext (region, mask, origin, chip, chip_size, scales):
+  '''
+  Crops the concentric multi-scale context of an image chip and its mask
+
+  Parameters
+  ----------
+    region : OpenSlide or PIL.Image
+      Slide obj or slide region which contains the chip context
+
+    mask : array_like
+      Annotation mask of the same region
+
+    origin : tuple
+      Slide coordinates (x, y) of the top-left corner of region and mask
+
+    chip : list
+      Chip keys, level, col, row and scale factors (as stored by getchips)
+
+    chip_size : int
+      The size of the image chips
+
+    scales : list
+      Context scales as returned by parsescales
+
+  Returns
+  -------
+    (imgs, img_masks) : tuple
+      Lists of RGB image chips and chip masks (one for each scale), all with
+      size chip_size and centered on the chip
+
+  Notes
+  -----
+  The window of the largest scale is read once. Each scale is obtained
+  downsampling the previous one of the cascade (area interpolation for the
+  images and nearest neighbour for the masks, so labels are never blended)
+  and cropping its central chip_size window.
+  The scale 1 chip and mask are identical to the ones returned by cropchip.
+  '''
+  x0, y0 = origin
+  keys, i, col, row, scale_factor_width, scale_factor_height = chip
+
+  window = chip_size * scales[-1]
+  margin = (window - chip_size) // 2
+
+  left  = int(col * scale_factor_width)  - x0 - margin
+  upper = int(row * scale_factor_height) - y0 - margin
+
+  img = np.asarray(region.crop(box=(left, upper, left + window, upper + window)).convert('RGB'))
+  img_mask = padcrop(mask, left, upper, window, window)
+
+  imgs, img_masks = [], []
+  previous = 1
+
+  for scale in scales:
+
+    if scale != previous:
+      size = window // scale
+      img = cv2.resize(img, dsize=(size, size), interpolation=cv2.INTER_AREA)
+      img_mask = cv2.resize(img_mask, dsize=(size, size), interpolation=cv2.INTER_NEAREST)
+      previous = scale
+
+    start = (img.shape[0] - chip_size) // 2
+    imgs.append(Image.fromarray(img[start : start + chip_size, start : start + chip_size]))
+    img_masks.append(np.ascontiguousarray(img_mask[start : start + chip_size, start : start + chip_size]))
+
+  return (imgs, img_masks)
+
+
+def samplechips (osr, contours, annotations, filename, suffix, chip_size, overlap, save_all, sampler,
+                 shard=0, nshards=1, max_memory=None, rle=False):
+  '''
+  Plans the chips of a slide and selects the ones to extract
+
+  Parameters
+  ----------
+    osr : OpenSlide or PIL.Image
+      Slide obj as returned by openwholeslide
+
+    contours : list
+      List of (color_code, contour) pairs as returned by loadcontours
+
+    annotations : dict
+      Dictionary of annotations in image
+
+    filename : str
+      Slide image filename
+
+    suffix : str
+      Output format of the chips
+
+    chip_size : int
+      The size of the image chips
+
+    overlap : int
+      Overlap between image chips (stride)
+
+    save_all : bool
+      Whether or not to plan every annotated chip
+
+    sampler : ChipSampler
+      The sampling planner
+
+    shard : int
+      Index of the band of columns to scan (0 <= shard < nshards)
+
+    nshards : int
+      Number of contiguous column bands in which each level is split
+
+    max_memory : str or int
+      Memory budget of each band (None processes the whole slide at once)
+
+    rle : bool
+      Whether or not to plan on the run-length encoded mask (see rasterlabels)
+
+  Returns
+  -------
+    selected : set
+      (level, col, row) of the selected chips (to pass to getchips)
+
+  Notes
+  -----
+  Only the annotation masks are rasterized: no pixel of the slide is read.
+  '''
+  size = osr.size
+  sampler.validate(annotations)
+
+  for band, _, mask, origin in slidebands(osr, contours, chip_size, overlap, max_memory, read=False, rle=rle):
+
+    with metrics.stage('plan'):
+      plan = getchips(1, [size], chip_size, overlap, mask, annotations, filename, suffix, save_all, 0.,
+                      shard=shard, nshards=nshards, rows=band, origin=origin, blank=sampler.blank)
+      sampler.update(plan)
+
+    del mask
+
+  with metrics.stage('plan'):
+    selected = sampler.select()
+
+  metrics.count('planned', sum(sampler.available.values()))
+  print('Sampled {0} of {1} chips'.format(len(selected), sum(sampler.available.values())))
+  print(sampler.summary())
+
+  return selected
+
+
+def savechips (plan, region, mask, origin, parameters, nthreads=1, statistics=None):
+  '''
+  Crops and saves the image chips and masks
+
+  Parameters
+  ----------
+    plan : ChipPlan
+      Plan of the chips (as returned by getchips)
+
+    region : OpenSlide or PIL.Image
+      Slide obj or slide region which contains the chips
+
+    mask : array_like
+      Annotation mask of the same region
+
+    origin : tuple
+      Slide coordinates (x, y) of the top-left corner of region and mask
+
+    parameters : dict
+      Processing parameters
+
+    nthreads : int
+      Number of threads used to crop and save the chips
+
+    statistics : ChipStatistics
+      Streaming statistics updated with each (base scale) chip and mask
+
+  Returns
+  -------
+  None
+  '''
+
+  chip_size = int(parameters['size'])
+  scales = parsescales(parameters.get('context', None))
+
+  # Define output directory (one for each context scale)
+  output_directory_chip = ['{0}/image_chips{1}/'.format(parameters['output_dir'], '' if scale == 1 else '_x{0}'.format(scale)) for scale in scales]
+  output_directory_mask = ['{0}/image_mask{1}/'.format(parameters['output_dir'], '' if scale == 1 else '_x{0}'.format(scale)) for scale in scales]
+
+  # the workers report to the collector of the caller
+  collector = metrics.active()
+
+  def save (item):
+    with metrics.bind(collector):
+      cropsave(item)
+
+  def cropsave (item):
+
+    filename, chip = item
+    keys = chip[0]
+
+    with metrics.stage('crop'):
+      if len(scales) > 1:
+        imgs, img_masks = cropcontext(region, mask, origin, chip, chip_size, scales)
+      else:
+        img, img_mask = cropchip(region, mask, origin, chip, chip_size)
+        imgs, img_masks = [img], [img_mask]
+
+    if statistics is not None:
+      # the chip is still in memory: no extra pass over the dataset
+      with metrics.stage('statistics'):
+        statistics.update(np.asarray(imgs[0]), packcolors(img_masks[0]))
+
+    # save the image chips and image masks of each scale
+    for img, img_mask, directory_chip, directory_mask in zip(imgs, img_masks, output_directory_chip, output_directory_mask):
+      path_chip = directory_chip + filename
+      path_mask = directory_mask + filename
+
+      savechip(img, path_chip, int(parameters['quality']), keys)
+      savemask(img_mask, path_mask, keys)
+
+    metrics.count('chips')
+
+  if nthreads > 1 and hasattr(region, 'load'):
+    # decode the slide once before sharing it among the workers
+    region.load()
+
+    with ThreadPool(nthreads) as pool:
+      for _ in tqdm.tqdm(pool.imap_unordered(save, plan.items()), total=len(plan)):
+        pass
 
   else:
-    # Save the image mask
-    cv2.imwrite(path, mask)
+    for item in tqdm.tqdm(plan.items(), total=len(plan)):
+      save(item)
+
+
+def run (parameters, filename):
+  '''
+  Runs SlideSeg: Generates image chips from a whole slide image.
+
+  Parameters
+  ----------
+    parameters : dict
+      Processing parameters
+
+    filename : str
+      Filename of whole slide image
+
+  Returns
+  -------
+  None
+
+  Notes
+  -----
+  Create and save image chips and masks.
+  If the parameters include 'shard' and 'nshards' only the corresponding band
+  of columns is processed and the Details text file is written as a fragment
+  named after the shard index.
+  The 'threads' parameter sets the number of workers used to crop and save the chips.
+  If the 'max_memory' parameter is given the slide is processed in horizontal
+  bands fitting the budget: the mask of each band is rasterized, its chips are
+  planned and saved before the next band is loaded.
+  The output is identical to the one obtained processing the whole slide at once.
+  If the 'rle' parameter is True the annotation mask is kept run-length
+  encoded (see rasterlabels and LabelRaster): no dense mask of the slide (or
+  of the bands) is allocated and the chips are planned from the runs, with
+  identical output.
+  The 'cache' parameter sets the directory of the parsed contour cache.
+  If the 'simplify' parameter is given (accuracy in pixels, e.g. 0.5) the
+  contours are simplified with the Douglas-Peucker algorithm before the
+  rasterization, keeping them within that distance from the original ones
+  (see simplifycontours): the simplified contours are cached and the masks
+  can differ from the original ones only on the contour pixels.
+  The 'context' parameter (list of integer scales, e.g. [1, 2, 4]) saves for
+  each chip the concentric chips covering scale times its size, downsampled
+  to the chip size, in the image_chips_x{scale} and image_mask_x{scale}
+  directories with the same filename of the base chip (see cropcontext).
+  If the 'statistics' parameter is True the per-channel mean and variance,
+  the color histograms and the pixel count of each class of the saved chips
+  are accumulated while saving and written in {output_dir}/{slide}_statistics.json
+  (see ChipStatistics).
+  If the 'metrics' parameter is True (or a json/csv filename) the time spent
+  in each stage (parse, rasterize, plan, read, crop, encode, write), the
+  number of chips, the bytes written, their rates and the peak memory are
+  written in {output_dir}/{slide}_metrics.json (see metrics.Metrics).
+  If the 'profile' parameter is True (or a filename) the run is profiled
+  with cProfile and the stats are written in {output_dir}/{slide}.prof.
+  If the 'plan' parameter is True the chip plan is written in
+  {output_dir}/{slide}_plan.npy (see ChipPlan.load).
+  If the 'sampling' parameter is given ('stratified' or 'reservoir') only the
+  chips selected by a ChipSampler are extracted: the target class ratios
+  ('ratios', e.g. {'MELANOMA-MALIGNO' : .5, 'NEVO-BENIGNO' : .3, 'NONE' : .2}),
+  the cap of chips of the slide ('max_chips', split among the shards) and
+  the random 'seed' are applied to the planned chips before the slide is read.
+  If the 'sweep' parameter is given (list of (size, overlap) pairs, e.g.
+  [(64, 1), (128, 1), (256, 16)]) the chips of every configuration are
+  extracted from a single parse, rasterization and read of the slide, each
+  one in its own {output_dir}/size{size}_overlap{overlap} tree (see sweepslide).
+  '''
+
+  name, _ = os.path.splitext(filename.replace('svs', 'roi'))
 
-    # Attach image tags
-    attachtags(path, keys)
+  if int(parameters.get('nshards', 1)) > 1:
+    name = '{0}_shard{1}'.format(name, int(parameters.get('shard', 0)))
 
+  metrics_file = parameters.get('metrics', False)
+  if metrics_file is True:
+    metrics_file = os.path.join(parameters['output_dir'], '{0}_metrics.json'.format(name))
 
-def checksave (save_all, pix_list, save_ratio, save_count_annotated, save_count_blank):
-  '''
-  Checks whether or not an image chip should be saved
+  profile_file = parameters.get('profile', False)
+  if profile_file is True:
+    profile_file = os.path.join(parameters['output_dir'], '{0}.prof'.format(name))
 
-  Parameters
-  ----------
-    save_all : bool
-      saves all chips if true
+  with metrics.collect(name, metrics_file or None, profile_file or None) as collector:
+    if parameters.get('sweep', None):
+      sweepslide(parameters, filename)
+    else:
+      splitslide(parameters, filename)
 
-    pix_list : list
-      list of pixel values in image mask
+  if metrics_file:
+    print(collector.summary())
+    print('metrics saved in {0}'.format(metrics_file))
 
-    save_ratio : float
-      Ratio of annotated chips to unannotated chips
 
-    save_count_annotated : int
-      Total annotated chips saved
+def splitslide (parameters, filename):
+  '''
+  Generates and saves the image chips of a whole slide image (see run)
 
-    save_count_blank : int
-      Total blank chips saved
+  Parameters
+  ----------
+    parameters : dict
+      Processing parameters
+
+    filename : str
+      Filename of whole slide image
 
   Returns
   -------
-    save : bool
-      True if the current image has to be saved
+  None
   '''
 
-  if save_all and len(list(filter(lambda x: x > 0, pix_list))) > 0:
-    save = True
-  elif save_count_annotated / save_count_blank > save_ratio:
-    save = True
-  elif len(list(filter(lambda x: x > 0, pix_list))) > 0:
-    save = True
-  else:
-    save = False
 
-  return save
+  shard = int(parameters.get('shard', 0))
+  nshards = int(parameters.get('nshards', 1))
+  nthreads = max(int(parameters.get('threads', 1)), 1)
+  max_memory = parameters.get('max_memory', None)
+  rle = parameters.get('rle', False)
 
+  chip_size = int(parameters['size'])
+  overlap = int(parameters['overlap'])
+  margin = contextmargin(chip_size, parsescales(parameters.get('context', None)))
 
-def formatcheck (format):
+  # Open slide
+  osr = openwholeslide(parameters['slide_path'])
+  # size = osr.level_dimensions[0] # max size
+  size = osr.size # max size
+
+  # Annotation Mask
+  xml_file = filename.replace('svs', 'roi') # .roi become .xml in the new version of Seeden Viewer
+
+  print('loading annotation data from {0}{1}'.format(parameters['xml_path'], xml_file))
+  # the masks are rasterized at level 0
+  simplify = parameters.get('simplify', None)
+  tolerance = simplifytolerance(1., simplify) if simplify else None
+
+  contours, annotations = loadcontours(parameters['key'], os.path.join(parameters['xml_path'], xml_file), parameters.get('cache', None), tolerance)
+
+  # Output formatting check
+  format, suffix = formatcheck(parameters['format'])
+
+  plans = []
+
+  statistics = None
+  if parameters.get('statistics', False):
+    names = {packcolor(color) : key for key, color in annotations.items()}
+    names.setdefault(0, 'NONE')
+    statistics = ChipStatistics(channels=3, names=names, order='RGB')
+
+  selected = None
+  if parameters.get('sampling', None):
+    sampler = ChipSampler(ratios=parameters.get('ratios', None), max_chips=shardcap(parameters.get('max_chips', None), shard, nshards),
+                          method=parameters['sampling'], seed=parameters.get('seed', None))
+    selected = samplechips(osr, contours, annotations, filename, suffix, chip_size, overlap, parameters['save_all'], sampler,
+                           shard=shard, nshards=nshards, max_memory=max_memory, rle=rle)
+
+  for band, region, mask, origin in slidebands(osr, contours, chip_size, overlap, max_memory, margin, rle=rle):
+
+    # Find chip data/locations to be saved
+    # chip_dictionary, image_dict = getchips(osr.level_count, osr.level_dimensions, int(parameters['size']), int(parameters['overlap']),
+    #                                        mask, annotations, filename, suffix, parameters['save_all'], float(parameters['save_ratio']))
+    with metrics.stage('plan'):
+      plan = getchips(1, [size], chip_size, overlap,
+                      mask, annotations, filename, suffix, parameters['save_all'], float(parameters['save_ratio']),
+                      shard=shard, nshards=nshards, rows=band, origin=origin,
+                      blank=selected is not None and sampler.blank, selected=selected)
+
+    # Save chips and masks
+    print('Saving chips... {0} total chips'.format(len(plan)))
+
+    savechips(plan, region, mask, origin, parameters, nthreads, statistics)
+    plans.append(plan)
+
+    # release the band buffers before loading the next one
+    del region, mask
+
+  writedetails(plans, xml_file, annotations, parameters, statistics)
+
+
+def parsesweep (sweep):
   '''
-  Assures correct format parameter was defined correctly
+  Parses the chip configurations of a sweep
 
   Parameters
   ----------
-    format: str
-      The output format parameter
+    sweep : list
+      List of (size, overlap) pairs or of 'size:overlap' strings (e.g. ['64:1', '128:1', '256:16'])
 
   Returns
   -------
-    format : str
-      image fmt
-
-    suffix : str
-      image suffix (e.g 'jpg')
+    configs : list
+      List of unique (size, overlap) integer pairs, in the given order
   '''
-  if format.lower() == 'jpg':
-    suffix = format
-    format = 'JPEG'
+  configs = []
 
-  elif format.lower() == 'jpeg':
-    format = format.upper()
-    suffix = 'jpg'
+  for config in sweep:
+    chip_size, overlap = map(int, config.split(':') if isinstance(config, str) else config)
 
-  else:
-    format = format.upper()
-    suffix = format.lower()
+    if chip_size <= 0 or not 0 <= overlap < chip_size:
+      raise ValueError('Invalid sweep configuration {0}! The overlap must be smaller than the chip size'.format(config))
 
-  return (format, suffix)
+    if (chip_size, overlap) not in configs:
+      configs.append((chip_size, overlap))
 
+  return configs
 
-def openwholeslide (path):
+
+def sweepdir (output_dir, chip_size, overlap):
   '''
-  Opens a whole slide image
+  Returns the output directory of a sweep configuration
+  '''
+  return os.path.join(output_dir, 'size{0}_overlap{1}'.format(chip_size, overlap))
+
+
+def sweepslide (parameters, filename):
+  '''
+  Generates and saves the image chips of a whole slide image for several
+  chip configurations (see run)
 
   Parameters
   ----------
-    path : str
-      Slide image path.
+    parameters : dict
+      Processing parameters, with the 'sweep' configurations instead of size and overlap
+
+    filename : str
+      Filename of whole slide image
 
   Returns
   -------
-    osr : OpenSlide
-      openslide obj
+  None
+
+  Notes
+  -----
+  The annotations are parsed once and each band of the slide is read and
+  rasterized once (see sweepbands): the chips of each configuration are
+  planned and saved from the same buffers in the
+  {output_dir}/size{size}_overlap{overlap} directory, with their Details
+  text file in its textfiles sub-directory.
+  The output of each configuration is identical to the one of a single run
+  with the same size and overlap.
   '''
 
-  directory, filename = os.path.split(path)
-  print('loading {0} ...'.format(filename), end='')
+  shard = int(parameters.get('shard', 0))
+  nshards = int(parameters.get('nshards', 1))
+  nthreads = max(int(parameters.get('threads', 1)), 1)
+  max_memory = parameters.get('max_memory', None)
+  rle = parameters.get('rle', False)
 
-  # Open Slide Image
-  # osr = OpenSlide(path)
-  osr = Image.open(path)
+  configs = parsesweep(parameters['sweep'])
+  margin = contextmargin(max(chip_size for chip_size, _ in configs), parsescales(parameters.get('context', None)))
 
-  print('[done]')
-  return osr
+  # Open slide
+  osr = openwholeslide(parameters['slide_path'])
+  size = osr.size # max size
 
+  # Annotation Mask
+  xml_file = filename.replace('svs', 'roi') # .roi become .xml in the new version of Seeden Viewer
 
-def curatemask (mask, scale_width, scale_height, chip_size):
+  print('loading annotation data from {0}{1}'.format(parameters['xml_path'], xml_file))
+  # the masks are rasterized at level 0
+  simplify = parameters.get('simplify', None)
+  tolerance = simplifytolerance(1., simplify) if simplify else None
+
+  contours, annotations = loadcontours(parameters['key'], os.path.join(parameters['xml_path'], xml_file), parameters.get('cache', None), tolerance)
+
+  # Output formatting check
+  format, suffix = formatcheck(parameters['format'])
+
+  sweeps = []
+
+  for chip_size, overlap in configs:
+    output_dir = sweepdir(parameters['output_dir'], chip_size, overlap)
+
+    statistics = None
+    if parameters.get('statistics', False):
+      names = {packcolor(color) : key for key, color in annotations.items()}
+      names.setdefault(0, 'NONE')
+      statistics = ChipStatistics(channels=3, names=names, order='RGB')
+
+    sampler = None
+    if parameters.get('sampling', None):
+      sampler = ChipSampler(ratios=parameters.get('ratios', None), max_chips=shardcap(parameters.get('max_chips', None), shard, nshards),
+                            method=parameters['sampling'], seed=parameters.get('seed', None))
+      sampler.validate(annotations)
+
+    sweeps.append({
+                    'parameters' : dict(parameters, size=chip_size, overlap=overlap, output_dir=output_dir),
+                    'statistics' : statistics,
+                    'sampler'    : sampler,
+                    'selected'   : None,
+                    'plans'      : [],
+                  })
+
+  if parameters.get('sampling', None):
+    # a single planning pass over the masks for all the configurations
+    for rows, _, mask, origin in sweepbands(osr, contours, configs, max_memory, read=False, rle=rle):
+      for (chip_size, overlap), band, config in zip(configs, rows, sweeps):
+        with metrics.stage('plan'):
+          config['sampler'].update(getchips(1, [size], chip_size, overlap, mask, annotations, filename, suffix, parameters['save_all'], 0.,
+                                            shard=shard, nshards=nshards, rows=band, origin=origin, blank=config['sampler'].blank))
+
+      del mask
+
+    for (chip_size, overlap), config in zip(configs, sweeps):
+      sampler = config['sampler']
+
+      with metrics.stage('plan'):
+        config['selected'] = sampler.select()
+
+      metrics.count('planned', sum(sampler.available.values()))
+      print('Sampled {0} of {1} chips of size {2} and overlap {3}'.format(len(config['selected']), sum(sampler.available.values()), chip_size, overlap))
+      print(sampler.summary())
+
+  for rows, region, mask, origin in sweepbands(osr, contours, configs, max_memory, margin, rle=rle):
+
+    if nthreads > 1 and hasattr(region, 'load'):
+      # decode the slide once before sharing it among the configurations
+      region.load()
+
+    for (chip_size, overlap), band, config in zip(configs, rows, sweeps):
+      sampler = config['sampler']
+
+      with metrics.stage('plan'):
+        plan = getchips(1, [size], chip_size, overlap,
+                        mask, annotations, filename, suffix, parameters['save_all'], float(parameters['save_ratio']),
+                        shard=shard, nshards=nshards, rows=band, origin=origin,
+                        blank=sampler is not None and sampler.blank, selected=config['selected'])
+
+      # Save chips and masks
+      print('Saving chips of size {0} and overlap {1}... {2} total chips'.format(chip_size, overlap, len(plan)))
+
+      savechips(plan, region, mask, origin, config['parameters'], nthreads, config['statistics'])
+      config['plans'].append(plan)
+
+    # release the band buffers before loading the next one
+    del region, mask
+
+  for config in sweeps:
+    output_dir = config['parameters']['output_dir']
+    writedetails(config['plans'], xml_file, annotations, config['parameters'], config['statistics'], dest=os.path.join(output_dir, 'textfiles'))
+
+
+def writedetails (plans, xml_file, annotations, parameters, statistics=None, dest='output/textfiles/'):
   '''
-  Resize and pad annotation mask if necessary
+  Writes the Details text file, the chip plan and the statistics of a slide
 
   Parameters
   ----------
-    mask : array_like
-      An image mask
+    plans : list
+      Chip plans of the bands of the slide (as returned by getchips)
 
-    scale_width : int
-      Scaling for higher magnification levels
+    xml_file : str
+      Filename of the annotations of the slide
 
-    scale_height : int
-      Scaling for higher magnification levels
+    annotations : dict
+      Dictionary of annotations in image
+
+    parameters : dict
+      Processing parameters
+
+    statistics : ChipStatistics
+      Statistics of the saved chips (None if not computed)
+
+    dest : str
+      Directory of the Details text file
 
   Returns
   -------
-    mask : array_like
-      The resized mask (annotated) matrix
+  None
   '''
-  # Resize and pad annotation mask if necessary
-  mask = cv2.resize(mask, dsize=None, fx=1. / scale_width, fy=1. / scale_height,
-                    interpolation=cv2.INTER_CUBIC)
-
-  mask_width, mask_height, mask_color = mask.shape
-  if mask_height < chip_size or mask_width < chip_size:
-    mask = np.pad(mask, ((0, chip_size - mask_width),
-                         (0, chip_size - mask_height),
-                         (0, 0)), 'constant')
+  shard = int(parameters.get('shard', 0))
+  nshards = int(parameters.get('nshards', 1))
 
-  if mask_height > chip_size or mask_width > chip_size:
-    mask = mask[:chip_size, :chip_size, ...]
+  plan = ChipPlan.concatenate(plans)
 
-  return mask
+  if len(plans) > 1:
+    # follow the scanning order of the whole slide
+    plan = plan.sort()
 
+  # Make text output of Annotation Data
+  print('Updating txt file details...')
 
-def getchips (levels, dims, chip_size, overlap, mask, annotations, filename, suffix, save_all, save_ratio):
-  '''
-  Finds chip locations that should be loaded and saved
+  if nshards > 1:
+    name, ext = os.path.splitext(xml_file)
+    xml_file = '{0}_shard{1}{2}'.format(name, shard, ext)
 
-  Parameters
-  ----------
-    levels : int
-      Levels in whole slide image
+  writekeys(xml_file, annotations, dest)
+  writeimagelist(xml_file, plan.imagelist(), dest)
 
-    dims : tuple
-      Dimension of whole slide image
+  if parameters.get('plan', False):
+    name, _ = os.path.splitext(xml_file)
+    plan.save(os.path.join(parameters['output_dir'], '{0}_plan.npy'.format(name)))
 
-    chip_size : int
-      The size of the image chips
+  if statistics is not None:
+    name, _ = os.path.splitext(xml_file)
+    statistics.save(os.path.join(parameters['output_dir'], '{0}_statistics.json'.format(name)))
+    print('statistics of {0} chips saved'.format(statistics.nchips))
 
-    overlap : int
-      Overlap between image chips (stride)
+  print('txt file details updated')
 
-    mask : array_like
-      Annotation mask for slide image
 
-    annotations : dict
-      Dictionary of annotations in image
+def mergedetails (filename, nshards, dest='output/textfiles/'):
+  '''
+  Merges the Details text files of the shards of a slide into the Details text file of the slide
 
+  Parameters
+  ----------
     filename : str
       Slide image filename
 
-    suffix : str
-      Output format for saving.
-
-    save_all : bool
-      Whether or not to save every image chip
+    nshards : int
+      Number of shards of the slide
 
-    save_ratio : float
-      Ratio of annotated to unannotated chips
+    dest : str
+      Directory of the Details text files
 
   Returns
   -------
-    chip_dict : dict
-      Dictionary of chip names, level, col, row, and scale
+    details : str
+      Path of the merged Details text file
 
-    image_dict : dict
-      Dictionary of annotations and chips with those annotations
+  Notes
+  -----
+  The chips of each key are sorted by level, col and row (parsed from their
+  name), i.e. in the scanning order of the whole slide, so the merged file
+  does not depend on the order in which the shards were run and it is the
+  same written by an unsharded run.
   '''
+  xml_file = filename.replace('svs', 'roi')
+  name, ext = os.path.splitext(xml_file)
 
-  # Image dictionary of keys and save variables
-  image_dict = defaultdict(list)
-  chip_dict = defaultdict(list)
-  save_count_blank = 1.
-  save_count_annotated = 1.
+  annotations = OrderedDict()
+  images = dict()
 
-  for i in range(levels):
-    width, height = dims[i]
-    scale_factor_width = dims[0][0] / width
-    scale_factor_height = dims[0][1] / height
-    print('Scanning slide level {0} of {1}'.format(i + 1, levels))
+  for shard in range(int(nshards)):
+    fragment = os.path.join(dest, '{0}_shard{1}_Details.txt'.format(name, shard))
 
-    # Generate the image chip coordinates and save information
-    for col in tqdm.tqdm(range(0, width, chip_size - overlap)):
-      for row in range(0, height, chip_size - overlap):
-        img_mask = mask[int(row * scale_factor_height) : int((row + chip_size) * scale_factor_height),
-                        int(col * scale_factor_width)  : int((col + chip_size) * scale_factor_width)]
-        pix_list = np.unique(img_mask)
+    if not os.path.isfile(fragment):
+      raise FileNotFoundError('Details text file of the shard {0} of {1} not found: {2}'.format(shard, filename, fragment))
 
-        # Check whether or not to save the region
-        if save_all and len(list(filter(lambda x: x != 0, pix_list))) > 0:
-          save = True
-        else:
-          save = False
-        #save = checksave(save_all, pix_list, save_ratio, save_count_annotated, save_count_blank)
+    key = None
+    with open(fragment, 'r') as fp:
+      for line in fp.read().splitlines():
 
-        # Save image and assign keys.
-        if save is True:
-          chip_name = '{0}_{1}_{2}_{3}.{4}'.format(filename.rstrip('.svs'), i, row, col, suffix)
-          keys = []
+        if line.startswith('Key:') and 'Mask_Color:' in line:
+          region_key, color = line[len('Key:'):].split('Mask_Color:')
+          annotations.setdefault(region_key.strip(), eval(color))
 
-          # Make sure annotation key contains value
-          for key, value in annotations.items():
-            for pixel in pix_list:
-              if int(pixel) == int(value[0]):
-                keys.append(key)
-                image_dict[key].append(chip_name)
+        elif line.startswith('Key:'):
+          key = line[len('Key:'):].strip()
+          images.setdefault(key, [])
 
-          if len(keys) == 0:
-            save_count_blank += 1.
-            keys.append('NONE')
-          else:
-            save_count_annotated += 1.
+        elif line.strip():
+          images[key].append(line.strip())
 
-          chip_dict[chip_name] = [keys]
-          chip_dict[chip_name].append(i)
-          chip_dict[chip_name].append(col)
-          chip_dict[chip_name].append(row)
-          chip_dict[chip_name].append(scale_factor_width)
-          chip_dict[chip_name].append(scale_factor_height)
+  def scanorder (chip_name):
+    # {slide}_{level}_{row}_{col}.{suffix}
+    _, level, row, col = os.path.splitext(chip_name)[0].rsplit('_', 3)
+    return (int(level), int(col), int(row))
 
-  return chip_dict, image_dict
+  writekeys(xml_file, annotations, dest)
+  writeimagelist(xml_file, OrderedDict((key, sorted(images[key], key=scanorder)) for key in annotations if images.get(key)), dest)
 
+  return os.path.join(dest, '{0}_Details.txt'.format(name))
 
-def run (parameters, filename):
+
+def prefetch (iterator, size):
   '''
-  Runs SlideSeg: Generates image chips from a whole slide image.
+  Consumes an iterator in a background thread keeping a bounded queue of items
 
   Parameters
   ----------
-    parameters : dict
-      Processing parameters
+    iterator : iterable
+      The items to produce
 
-    filename : str
-      Filename of whole slide image
+    size : int
+      Maximum number of items produced in advance
 
   Returns
   -------
-  None
+    iterator : generator
+      The same items of the input iterator
 
   Notes
   -----
-  Create and save image chips and masks
+  Exceptions raised by the producer are re-raised in the consumer.
+  If the consumer stops early the producer is stopped at its next item.
+  '''
+  items = Queue(maxsize=size)
+  stop = Event()
+  end = object()
+
+  def produce ():
+    try:
+      for item in iterator:
+        while not stop.is_set():
+          try:
+            items.put((item, None), timeout=.1)
+            break
+          except Full:
+            pass
+        if stop.is_set():
+          return
+      items.put((end, None))
+
+    except Exception as e:
+      items.put((end, e))
+
+  producer = Thread(target=produce, daemon=True)
+  producer.start()
+
+  try:
+    while True:
+      item, error = items.get()
+      if error is not None:
+        raise error
+      if item is end:
+        break
+      yield item
+
+  finally:
+    stop.set()
+
+
+def iter_chips (slide, annotations, size, overlap=1, key=None, batch_size=32, prefetch_batches=0, workers=1,
+                save_all=True, max_memory=None, cache_dir=None, context=None, sampling=None, rle=False, simplify=None):
   '''
+  Streams the image chips and masks of a whole slide image without saving them
 
-  # Open slide
-  osr = openwholeslide(parameters['slide_path'])
-  # size = osr.level_dimensions[0] # max size
-  size = osr.size # max size
+  Parameters
+  ----------
+    slide : str
+      Slide image path
 
-  # Annotation Mask
-  xml_file = filename.replace('svs', 'roi') # .roi become .xml in the new version of Seeden Viewer
+    annotations : str
+      Path to the xml (roi) annotation file of the slide
 
-  print('loading annotation data from {0}{1}'.format(parameters['xml_path'], xml_file))
-  mask, annotations = makemask(parameters['key'], size, os.path.join(parameters['xml_path'], xml_file))
+    size : int
+      The size of the image chips
+
+    overlap : int
+      Overlap between image chips (stride)
 
-  # Define output directory
-  output_directory_chip = '{0}/image_chips/'.format(parameters['output_dir'])
-  output_directory_mask = '{0}/image_mask/'.format(parameters['output_dir'])
+    key : str
+      Name of the annotation key file (default the key of all the annotations
+      of the directory is generated in memory by each call, see memorykey)
 
-  # Output formatting check
-  format, suffix = formatcheck(parameters['format'])
+    batch_size : int
+      Number of chips in each batch
 
-  # Find chip data/locations to be saved
-  # chip_dictionary, image_dict = getchips(osr.level_count, osr.level_dimensions, int(parameters['size']), int(parameters['overlap']),
-  #                                        mask, annotations, filename, suffix, parameters['save_all'], float(parameters['save_ratio']))
-  chip_dictionary, image_dict = getchips([0], [size], int(parameters['size']), int(parameters['overlap']),
-                                         mask, annotations, filename, suffix, parameters['save_all'], float(parameters['save_ratio']))
+    prefetch_batches : int
+      Number of batches prepared in advance by a background thread (0 disables the prefetching)
 
+    workers : int
+      Number of threads used to crop the chips of each batch
 
-  # Save chips and masks
-  print('Saving chips... {0} total chips'.format(len(chip_dictionary)))
+    save_all : bool
+      Whether or not to produce every annotated chip (as the save_all parameter of run)
 
-  for filename, (keys, i, col, row, scale_factor_width, scale_factor_height) in tqdm.tqdm(chip_dictionary.items()):
+    max_memory : str or int
+      Memory budget for processing the slide in horizontal bands (None processes the whole slide at once)
 
-    # load chip region from slide image
-    # img = osr.read_region([int(col * scale_factor_width), int(row * scale_factor_height)], i,
-    #                       [int(parameters['size']), int(parameters['size'])]).convert('RGB')
-    img = osr.crop(box=(int(col * scale_factor_width), int(row * scale_factor_height),
-                        int(col * scale_factor_width) + int(parameters['size']),
-                        int(row * scale_factor_height) + int(parameters['size']))).convert('RGB')
+    cache_dir : str
+      Directory of the parsed contour cache (None disables the cache)
 
-    # load image mask and curate
-    img_mask = mask[int(row * scale_factor_height) : int((row + int(parameters['size'])) * scale_factor_height),
-                    int(col * scale_factor_width)  : int((col + int(parameters['size'])) * scale_factor_width)]
+    context : list
+      Context scales of the multi-scale chip stacks (e.g. [1, 2, 4], see cropcontext)
 
-    img_mask = curatemask(img_mask, scale_factor_width, scale_factor_height, int(parameters['size']))
+    sampling : dict
+      Arguments of the ChipSampler (ratios, max_chips, method and seed) which
+      selects the chips to produce (None produces all the chips)
 
-    # save the image chip and image mask
-    path_chip = output_directory_chip + filename
-    path_mask = output_directory_mask + filename
+    rle : bool
+      Whether or not to keep the annotation mask run-length encoded (see rasterlabels)
 
-    savechip(img, path_chip, int(parameters['quality']), keys)
-    savemask(img_mask, path_mask, keys)
+    simplify : float
+      Accuracy (in pixels) of the Douglas-Peucker simplification of the contours (None keeps every vertex)
 
-  # Make text output of Annotation Data
-  print('Updating txt file details...')
+  Returns
+  -------
+    iterator : generator
+      (chips, masks, metadata) for each batch: chips is a (batch, size, size, 3) RGB
+      uint8 array, masks the corresponding (batch, size, size, 3) annotation masks and
+      metadata a list of dictionaries with the name, keys, level, col and row of each chip.
+      If context is given chips and masks have shape (batch, scales, size, size, 3).
+      The last batch (of each band) can be smaller than batch_size.
+
+  Example
+  -------
+  >>> for chips, masks, metadata in SlideSeg.iter_chips('slide.svs', 'slide.roi', 128, prefetch_batches=4, workers=4):
+  ...   model.train_on_batch(chips, masks)
+  '''
 
-  writekeys(xml_file, annotations)
-  writeimagelist(xml_file, image_dict)
+  filename = os.path.basename(slide)
+  _, suffix = formatcheck('png')
 
-  print('txt file details updated')
+  scales = parsescales(context)
+  margin = contextmargin(size, scales)
+
+  if context is None:
+    crop = lambda region, mask, origin, chip : cropchip(region, mask, origin, chip, size)
+  else:
+    crop = lambda region, mask, origin, chip : tuple(map(np.stack, cropcontext(region, mask, origin, chip, size, scales)))
+
+  def batches ():
+
+    osr = openwholeslide(slide)
+
+    # the key of all the annotations of the directory (which can be read-only), not shared with other calls
+    annotation_key = memorykey(os.path.dirname(os.path.abspath(annotations)), cache_dir=cache_dir) if key is None else key
+    contours, annotation_keys = loadcontours(annotation_key, annotations, cache_dir, simplifytolerance(1., simplify) if simplify else None)
+
+    selected, blank = None, False
+    if sampling is not None:
+      sampler = ChipSampler(**sampling)
+      selected = samplechips(osr, contours, annotation_keys, filename, suffix, size, overlap, save_all, sampler, max_memory=max_memory, rle=rle)
+      blank = sampler.blank
+
+    with ThreadPool(max(workers, 1)) as pool:
+
+      for band, region, mask, origin in slidebands(osr, contours, size, overlap, max_memory, margin, rle=rle):
+
+        if workers > 1 and hasattr(region, 'load'):
+          # decode the slide once before sharing it among the workers
+          region.load()
+
+        with metrics.stage('plan'):
+          plan = getchips(1, [osr.size], size, overlap, mask, annotation_keys, filename, suffix,
+                          save_all, 0., rows=band, origin=origin, blank=blank, selected=selected)
+
+        for start in range(0, len(plan), batch_size):
+          batch = list(plan[start : start + batch_size].items())
+          crops = pool.map(lambda item : crop(region, mask, origin, item[1]), batch)
+
+          metadata = [{'name' : name, 'keys' : keys, 'level' : i, 'col' : col, 'row' : row}
+                      for name, (keys, i, col, row, *_) in batch]
+
+          yield (np.stack([np.asarray(img) for img, _ in crops]),
+                 np.stack([img_mask for _, img_mask in crops]),
+                 metadata)
+
+        del region, mask
+
+  if prefetch_batches > 0:
+    return prefetch(batches(), prefetch_batches)
+
+  return batches()
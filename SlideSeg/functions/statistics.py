@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import json
+import tempfile
+import numpy as np
+from threading import Lock
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def packcolors (mask):
+  '''
+  Packs the 3 channels of a color mask into integer labels
+
+  Parameters
+  ----------
+    mask : array_like
+      uint8 mask with shape (rows, cols, 3)
+
+  Returns
+  -------
+    labels : array_like
+      int32 labels with shape (rows, cols)
+  '''
+  mask = np.asarray(mask, dtype=np.int32)
+  return (mask[..., 0] << 16) | (mask[..., 1] << 8) | mask[..., 2]
+
+
+def packcolor (color):
+  '''
+  Packs a color tuple into the integer label computed by packcolors
+  '''
+  return (int(color[0]) << 16) | (int(color[1]) << 8) | int(color[2])
+
+
+class ChipStatistics (object):
+
+  def __init__ (self, channels=3, bins=256, names=None, order='RGB'):
+    '''
+    Streaming statistics of image chips and masks
+
+    Parameters
+    ----------
+      channels : int
+        Number of channels of the image chips
+
+      bins : int
+        Number of bins of the (uint8) color histograms
+
+      names : dict
+        Names of the integer mask labels (labels not included are reported by value)
+
+      order : str
+        Channel order of the image chips (e.g. RGB or BGR)
+
+    Notes
+    -----
+    The per-channel mean and variance are updated with the parallel
+    Welford (Chan) formula, so each chip is visited once and partial
+    results (e.g. of different threads, shards or slides) can be merged
+    without loss of precision.
+    '''
+    self.channels = int(channels)
+    self.bins = int(bins)
+    self.names = dict() if names is None else dict(names)
+    self.order = order
+
+    self.nchips = 0
+    self.count = 0
+    self.mean = np.zeros(shape=(self.channels, ), dtype=np.float64)
+    self.m2 = np.zeros(shape=(self.channels, ), dtype=np.float64)
+    self.histogram = np.zeros(shape=(self.channels, self.bins), dtype=np.int64)
+    self.classes = dict()
+
+    self._lock = Lock()
+
+  def partial (self, image, labels=None):
+    '''
+    Computes the statistics of a single chip
+
+    Parameters
+    ----------
+      image : array_like
+        Image chip with shape (rows, cols, channels)
+
+      labels : array_like
+        Integer labels of the chip mask with shape (rows, cols)
+
+    Returns
+    -------
+      stats : ChipStatistics
+        Statistics of the chip (to merge)
+    '''
+    stats = ChipStatistics(self.channels, self.bins, self.names, self.order)
+
+    pixels = np.asarray(image).reshape(-1, self.channels)
+
+    if len(pixels):
+      stats.nchips = 1
+      stats.count = len(pixels)
+      stats.mean = pixels.mean(axis=0, dtype=np.float64)
+      stats.m2 = ((pixels - stats.mean)**2).sum(axis=0)
+
+      for c in range(self.channels):
+        stats.histogram[c] = np.bincount(pixels[:, c], minlength=self.bins)[:self.bins]
+
+    if labels is not None:
+      values, counts = np.unique(labels, return_counts=True)
+      # the classes are accumulated by name, so statistics of different slides can be merged
+      stats.classes = {self.names.get(int(v), str(int(v))) : int(n) for v, n in zip(values, counts)}
+
+    return stats
+
+  def update (self, image, labels=None):
+    '''
+    Adds a chip to the statistics (thread-safe)
+
+    Parameters
+    ----------
+      image : array_like
+        Image chip with shape (rows, cols, channels)
+
+      labels : array_like
+        Integer labels of the chip mask with shape (rows, cols)
+
+    Returns
+    -------
+      self
+    '''
+    return self.merge(self.partial(image, labels))
+
+  def merge (self, other):
+    '''
+    Merges the statistics of another set of chips
+
+    Parameters
+    ----------
+      other : ChipStatistics
+        Partial statistics with the same channels and bins
+
+    Returns
+    -------
+      self
+    '''
+    if (other.channels, other.bins, other.order) != (self.channels, self.bins, self.order):
+      raise ValueError('Incompatible statistics: {0} and {1}'.format(self, other))
+
+    with self._lock:
+      count = self.count + other.count
+
+      if other.count:
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+
+      self.count = count
+      self.nchips += other.nchips
+      self.histogram += other.histogram
+
+      for label, n in other.classes.items():
+        self.classes[label] = self.classes.get(label, 0) + n
+
+    return self
+
+  @property
+  def var (self):
+    '''
+    Population variance of each channel
+    '''
+    return self.m2 / self.count if self.count else np.zeros_like(self.m2)
+
+  @property
+  def std (self):
+    '''
+    Standard deviation of each channel
+    '''
+    return np.sqrt(self.var)
+
+  def todict (self):
+    '''
+    Converts the statistics into a json-serializable dictionary
+    '''
+    return {
+             'order'     : self.order,
+             'chips'     : self.nchips,
+             'pixels'    : self.count,
+             'mean'      : self.mean.tolist(),
+             'var'       : self.var.tolist(),
+             'std'       : self.std.tolist(),
+             'histogram' : self.histogram.tolist(),
+             'classes'   : dict(sorted(self.classes.items())),
+           }
+
+  @classmethod
+  def fromdict (cls, data):
+    '''
+    Builds the statistics from a dictionary written by todict
+    '''
+    histogram = np.asarray(data['histogram'], dtype=np.int64)
+    stats = cls(channels=histogram.shape[0], bins=histogram.shape[1], order=data['order'])
+
+    stats.nchips = int(data['chips'])
+    stats.count = int(data['pixels'])
+    stats.mean = np.asarray(data['mean'], dtype=np.float64)
+    stats.m2 = np.asarray(data['var'], dtype=np.float64) * stats.count
+    stats.histogram = histogram
+    stats.classes = {label : int(n) for label, n in data['classes'].items()}
+
+    return stats
+
+  def save (self, filename):
+    '''
+    Writes the statistics into a json file (atomically)
+
+    Parameters
+    ----------
+      filename : str
+        Output json filename
+
+    Returns
+    -------
+    None
+    '''
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+
+    with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+      json.dump(self.todict(), fp, indent=2)
+
+    os.replace(tmp, filename)
+
+  @classmethod
+  def load (cls, filename):
+    '''
+    Reads the statistics from a json file written by save
+
+    Parameters
+    ----------
+      filename : str
+        Input json filename
+
+    Returns
+    -------
+      stats : ChipStatistics
+        The loaded statistics
+    '''
+    with open(filename, 'r', encoding='utf-8') as fp:
+      return cls.fromdict(json.load(fp))
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    return '<ChipStatistics (order: {0}, chips: {1}, pixels: {2}, classes: {3})>'.format(self.order, self.nchips, self.count, len(self.classes))
+
+
+def mergestatistics (filenames, output=None):
+  '''
+  Merges the statistics files of different shards or slides
+
+  Parameters
+  ----------
+    filenames : list
+      Statistics json files written by ChipStatistics.save
+
+    output : str
+      Output json filename (None does not save the result)
+
+  Returns
+  -------
+    stats : ChipStatistics
+      The merged statistics
+  '''
+  stats = None
+
+  for filename in filenames:
+    partial = ChipStatistics.load(filename)
+    stats = partial if stats is None else stats.merge(partial)
+
+  if stats is None:
+    stats = ChipStatistics()
+
+  if output is not None:
+    stats.save(output)
+
+  return stats
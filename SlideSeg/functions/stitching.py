@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import cv2
+import shutil
+import tempfile
+import numpy as np
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def loadregions (filename):
+  '''
+  Loads the list of annotated regions written by the make_annotation rule
+
+  Parameters
+  ----------
+    filename : str
+      Path of the regions_{svs}.csv file
+
+  Returns
+  -------
+    regions : dict
+      Dictionary of region index and its bounding box (minx, miny, maxx, maxy, pad_top, pad_left, rows, cols)
+  '''
+  regions = dict()
+
+  with open(filename, 'r', encoding='utf-8') as fp:
+    header = fp.readline().strip().split(',')
+
+    for row in fp:
+      values = dict(zip(header, map(int, row.split(','))))
+      regions[values.pop('region')] = values
+
+  return regions
+
+
+def patchcoords (patch_name, regions):
+  '''
+  Converts the name of a pipeline patch into slide coordinates
+
+  Parameters
+  ----------
+    patch_name : str
+      Patch filename in the make_patches fmt (roi_{svs}_{region}_{col}_{row}.png)
+
+    regions : dict
+      Regions of the slide as returned by loadregions
+
+  Returns
+  -------
+    (x, y) : tuple
+      Slide coordinates of the top-left corner of the patch
+  '''
+  name, _ = os.path.splitext(os.path.basename(patch_name))
+  _, region, col, row = name.rsplit('_', 3)
+  region = regions[int(region)]
+
+  return (region['minx'] - region['pad_left'] + int(col), region['miny'] - region['pad_top'] + int(row))
+
+
+class HeatmapStitcher (object):
+
+  def __init__ (self, slide_size, downsample=32, channels=1, directory=None):
+    '''
+    Accumulates per-patch predictions into a downsampled slide-level heatmap
+
+    Parameters
+    ----------
+      slide_size : tuple
+        Size (width, height) of the whole slide image
+
+      downsample : int
+        Downsampling factor of the heatmap with respect to the slide
+
+      channels : int
+        Number of values (e.g. class scores) of each heatmap pixel
+
+      directory : str
+        Directory of the memory-mapped accumulators (default a temporary directory removed by close)
+
+    Notes
+    -----
+    The sums of the values and the number of contributions of each heatmap
+    pixel are stored in memory-mapped files, so the memory usage depends
+    neither on the slide size nor on the number of patches: overlapping
+    patches are averaged.
+    '''
+
+    width, height = slide_size
+
+    self.downsample = int(downsample)
+    self.channels = int(channels)
+    self.slide_size = (int(width), int(height))
+    self.shape = (-(-int(height) // self.downsample), -(-int(width) // self.downsample))
+
+    self._tmp = directory is None
+    self.directory = tempfile.mkdtemp(prefix='heatmap_') if directory is None else directory
+    os.makedirs(self.directory, exist_ok=True)
+
+    self.values = np.lib.format.open_memmap(os.path.join(self.directory, 'values.npy'), mode='w+',
+                                            dtype=np.float32, shape=(*self.shape, self.channels))
+    self.counts = np.lib.format.open_memmap(os.path.join(self.directory, 'counts.npy'), mode='w+',
+                                            dtype=np.float32, shape=self.shape)
+    self.npatches = 0
+
+  def add (self, coords, values):
+    '''
+    Adds the prediction of a patch
+
+    Parameters
+    ----------
+      coords : tuple
+        Slide coordinates of the patch as (x, y, size) or (x, y, width, height)
+
+      values : float or array_like
+        Patch score (scalar or one value per channel) or patch mask
+        (2D array, or 3D with channels as last axis) at any resolution
+
+    Returns
+    -------
+      self
+    '''
+    if len(coords) == 3:
+      x, y, w = coords
+      h = w
+    else:
+      x, y, w, h = coords
+
+    ds = self.downsample
+    rows, cols = self.shape
+
+    # footprint of the patch on the heatmap grid
+    r0, c0 = int(y) // ds, int(x) // ds
+    r1, c1 = -(-int(y + h) // ds), -(-int(x + w) // ds)
+
+    values = np.asarray(values, dtype=np.float32)
+
+    if values.ndim >= 2:
+      values = cv2.resize(values, dsize=(c1 - c0, r1 - r0), interpolation=cv2.INTER_AREA)
+    values = values.reshape(*values.shape[:2], -1) if values.ndim >= 2 else values.reshape(1, 1, -1)
+
+    # clip the footprint to the heatmap
+    top, left = max(r0, 0), max(c0, 0)
+    bottom, right = min(r1, rows), min(c1, cols)
+
+    if bottom <= top or right <= left:
+      return self
+
+    if values.shape[:2] != (1, 1):
+      values = values[top - r0 : bottom - r0, left - c0 : right - c0]
+
+    self.values[top : bottom, left : right] += values
+    self.counts[top : bottom, left : right] += 1.
+    self.npatches += 1
+
+    return self
+
+  def update (self, stream):
+    '''
+    Adds a stream of patch predictions
+
+    Parameters
+    ----------
+      stream : iterable
+        (coords, values) pairs (see add)
+
+    Returns
+    -------
+      self
+    '''
+    for coords, values in stream:
+      self.add(coords, values)
+
+    return self
+
+  def heatmap (self, filename=None, band=1024):
+    '''
+    Computes the averaged heatmap
+
+    Parameters
+    ----------
+      filename : str
+        Path of the .npy output file (default heatmap.npy in the accumulator directory)
+
+      band : int
+        Number of heatmap rows processed at once
+
+    Returns
+    -------
+      heatmap : array_like
+        Memory-mapped (rows, cols, channels) float32 heatmap, NaN where no patch contributes
+    '''
+    filename = os.path.join(self.directory, 'heatmap.npy') if filename is None else filename
+    heatmap = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=self.values.shape)
+
+    for start in range(0, self.shape[0], band):
+      counts = self.counts[start : start + band, :, None]
+
+      with np.errstate(invalid='ignore', divide='ignore'):
+        heatmap[start : start + band] = np.where(counts > 0, self.values[start : start + band] / counts, np.nan)
+
+    heatmap.flush()
+    return heatmap
+
+  @staticmethod
+  def colorize (heatmap, vmin=0., vmax=1., channel=0, colormap=cv2.COLORMAP_JET):
+    '''
+    Converts a heatmap channel into a BGR image (black where no patch contributes)
+    '''
+    values = np.asarray(heatmap[..., channel], dtype=np.float32)
+    missing = np.isnan(values)
+
+    values = np.clip((np.nan_to_num(values) - vmin) / (vmax - vmin), 0., 1.)
+    image = cv2.applyColorMap((values * 255).astype(np.uint8), colormap)
+    image[missing] = 0
+
+    return image
+
+  def save_thumbnail (self, filename, max_size=2048, **kwargs):
+    '''
+    Saves a colorized thumbnail of the heatmap
+
+    Parameters
+    ----------
+      filename : str
+        Output image filename
+
+      max_size : int
+        Maximum size of the longest thumbnail side
+
+      kwargs : dict
+        Arguments of colorize (vmin, vmax, channel, colormap)
+
+    Returns
+    -------
+    None
+    '''
+    level = self.heatmap()
+
+    # the heatmap is downsampled in bands (pyramid cascade) until it fits the required size
+    for level in self._cascade(level, max_size):
+      pass
+
+    cv2.imwrite(filename, self.colorize(level, **kwargs))
+
+  def save_pyramid (self, directory, min_size=256, fmt='png', **kwargs):
+    '''
+    Saves the heatmap as a pyramid of colorized images (level_0 is the full heatmap)
+
+    Parameters
+    ----------
+      directory : str
+        Output directory
+
+      min_size : int
+        Size of the longest side under which the downsampling stops
+
+      fmt : str
+        Output image fmt
+
+      kwargs : dict
+        Arguments of colorize (vmin, vmax, channel, colormap)
+
+    Returns
+    -------
+      levels : list
+        Filenames of the pyramid levels
+    '''
+    os.makedirs(directory, exist_ok=True)
+
+    heatmap = self.heatmap()
+    levels = []
+
+    for i, level in enumerate([heatmap] + list(self._cascade(heatmap, min_size))):
+      filename = os.path.join(directory, 'level_{0}.{1}'.format(i, fmt))
+      cv2.imwrite(filename, self.colorize(level, **kwargs))
+      levels.append(filename)
+
+    return levels
+
+  def _cascade (self, heatmap, min_size=1, band=1024):
+    '''
+    Halves the heatmap resolution until min_size, averaging only the covered pixels
+
+    Each level is computed in bands of rows from the previous one and stored
+    as memory-mapped file in the accumulator directory.
+    '''
+    level, i = heatmap, 0
+
+    while max(level.shape[:2]) > min_size:
+      i += 1
+      rows, cols = -(-level.shape[0] // 2), -(-level.shape[1] // 2)
+      filename = os.path.join(self.directory, 'level_{0}.npy'.format(i))
+      half = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(rows, cols, level.shape[2]))
+
+      for start in range(0, rows, band):
+        block = np.asarray(level[2 * start : 2 * (start + band)])
+        # pad to even size with missing values
+        block = np.pad(block, ((0, block.shape[0] % 2), (0, block.shape[1] % 2), (0, 0)), constant_values=np.nan)
+        block = block.reshape(block.shape[0] // 2, 2, block.shape[1] // 2, 2, -1)
+
+        with np.errstate(invalid='ignore'):
+          valid = (~np.isnan(block)).sum(axis=(1, 3))
+          half[start : start + band] = np.where(valid > 0, np.nansum(block, axis=(1, 3)) / np.maximum(valid, 1), np.nan)
+
+      half.flush()
+      level = half
+      yield level
+
+  def close (self):
+    '''
+    Releases the accumulators (and removes the temporary directory)
+    '''
+    del self.values
+    del self.counts
+
+    if self._tmp:
+      shutil.rmtree(self.directory, ignore_errors=True)
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __repr__ (self):
+    '''
+    Printer
+    '''
+    return '<HeatmapStitcher (slide: {0}, heatmap: {1}, channels: {2}, patches: {3})>'.format(self.slide_size, self.shape, self.channels, self.npatches)
@@ -0,0 +1,588 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import time
+import heapq
+import shutil
+import argparse
+import tempfile
+import traceback
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+
+from SlideSeg import pipeline
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+PRIORITIES = ('fifo', 'smallest', 'largest')
+
+
+def parse_args ():
+
+  description = 'Watch-folder ingestion service of the SlideSeg pipeline'
+
+  parser = argparse.ArgumentParser(description=description)
+
+  parser.add_argument('--config',   required=False, type=str,   action='store', default='config.yaml', help='Pipeline configuration (the one of the Snakemake pipeline, paths relative to the working directory)')
+  parser.add_argument('--workers',  required=False, type=int,   action='store', default=2,      help='Number of slides processed in parallel')
+  parser.add_argument('--threads',  required=False, type=int,   action='store', default=None,   help='Threads of each slide job (default NTH_PATCHES of the config)')
+  parser.add_argument('--queue',    required=False, type=int,   action='store', default=64,     help='Maximum number of slides waiting in the queue')
+  parser.add_argument('--interval', required=False, type=float, action='store', default=10.,    help='Seconds between two scans of the input folders')
+  parser.add_argument('--settle',   required=False, type=float, action='store', default=60.,    help='Seconds a slide/annotation pair must stay unchanged before being queued')
+  parser.add_argument('--priority', required=False, type=str,   action='store', default='fifo', choices=PRIORITIES, help='Order of the queued slides: first detected, smallest or largest slide file first')
+  parser.add_argument('--once',     required=False, action='store_true', default=False,        help='Process the slides currently in the input folders and exit')
+
+  args = parser.parse_args()
+
+  return args
+
+
+def readconfig (filename):
+  '''
+  Reads the pipeline configuration (yaml)
+  '''
+  import yaml
+
+  with open(filename, 'r', encoding='utf-8') as fp:
+    return yaml.safe_load(fp)
+
+
+def isfresh (output, inputs):
+  '''
+  Checks if the output file exists and is not older than its inputs (as Snakemake does)
+  '''
+  if not os.path.exists(output):
+    return False
+
+  mtime = os.stat(output).st_mtime_ns
+  return all(os.stat(filename).st_mtime_ns <= mtime for filename in inputs)
+
+
+def writeatomic (func, output, *args):
+  '''
+  Calls func(*args, tmp) and moves the temporary output in place, so readers never see a partial file
+  '''
+  directory = os.path.dirname(os.path.abspath(output))
+  fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix=os.path.splitext(output)[1])
+  os.close(fd)
+
+  try:
+    func(*args, tmp)
+    os.replace(tmp, output)
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+
+class Watcher (object):
+
+  def __init__ (self, svs_dir, svs_ext, xml_dir, xml_ext, settle=60.):
+    '''
+    Polls the input folders for complete and stable slide/annotation pairs
+
+    Parameters
+    ----------
+      svs_dir : str
+        Directory of the slides
+
+      svs_ext : str
+        Extension of the slides (without dot)
+
+      xml_dir : str
+        Directory of the annotation files
+
+      xml_ext : str
+        Extension of the annotation files (without dot)
+
+      settle : float
+        Seconds a pair must stay unchanged (size and mtime of both files)
+        before being reported as stable (and a file without its slide or
+        annotation before being reported as unpaired)
+
+    Notes
+    -----
+    The folders are only listed (one scandir and one stat for each file):
+    files still being copied change size or mtime between the scans, so
+    they are reported only once the copy is over. Hidden files (e.g. the
+    temporary files of rsync) are ignored.
+    '''
+    self.svs_dir, self.svs_ext = svs_dir, svs_ext
+    self.xml_dir, self.xml_ext = xml_dir, xml_ext
+    self.settle = settle
+
+    # name : (signature, time of the first scan with that signature)
+    self.seen = dict()
+
+  def _list (self, directory, extension):
+    '''
+    Returns the (size, mtime) of the files of a directory with the given extension
+    '''
+    suffix = '.{}'.format(extension)
+    files = dict()
+
+    with os.scandir(directory) as it:
+      for entry in it:
+        if entry.name.endswith(suffix) and not entry.name.startswith('.') and entry.is_file():
+          stat = entry.stat()
+          files[entry.name[:-len(suffix)]] = (stat.st_size, stat.st_mtime_ns)
+
+    return files
+
+  def scan (self, now=None):
+    '''
+    Lists the slide/annotation pairs of the input folders
+
+    Parameters
+    ----------
+      now : float
+        Time of the scan (default time.time())
+
+    Returns
+    -------
+      (stable, waiting, unpaired) : tuple
+        Dictionary of the stable pairs (name : (signature, first seen time)),
+        set of the names of the pairs still changing (or incomplete) and set
+        of the names of the files unchanged for the settle time whose slide
+        or annotation is still missing
+    '''
+    now = time.time() if now is None else now
+
+    slides = self._list(self.svs_dir, self.svs_ext)
+    annotations = self._list(self.xml_dir, self.xml_ext)
+
+    stable, waiting, unpaired = dict(), set(), set()
+    seen = dict()
+
+    for name in sorted(set(slides) | set(annotations)):
+      signature = slides.get(name, (0, 0)) + annotations.get(name, (0, 0))
+      previous, first = self.seen.get(name, (None, now))
+
+      # (files older than the settle time, e.g. at the start of the service, are already stable)
+      if previous is None:
+        first = min(now, max(signature[1], signature[3]) * 1e-9)
+
+      # a copy can keep the mtime of the source: a file which changes restarts the settle time
+      elif previous != signature:
+        first = now
+
+      seen[name] = (signature, first)
+
+      # (the missing file of the pair may be still arriving)
+      if name not in slides or name not in annotations:
+        (unpaired if now - first >= self.settle else waiting).add(name)
+
+      # empty files are still being created
+      elif now - first >= self.settle and slides[name][0] > 0 and annotations[name][0] > 0:
+        stable[name] = (signature, first)
+      else:
+        waiting.add(name)
+
+    self.seen = seen
+
+    return (stable, waiting, unpaired)
+
+
+def ingest_slide (name, config, local, threads=None):
+  '''
+  Runs the annotation, patch and counter stages of a single slide
+
+  Parameters
+  ----------
+    name : str
+      Name of the slide (without extension)
+
+    config : dict
+      Pipeline configuration
+
+    local : str
+      Working directory of the pipeline
+
+    threads : int
+      Number of threads of the patch extraction (default NTH_PATCHES)
+
+  Returns
+  -------
+    nlines : int
+      Number of patches written in the counter of the slide
+
+  Notes
+  -----
+  The outputs are the ones of the Snakemake rules of the slide (regions,
+  patches, counter and statistics shards and their merge). The counter of
+  the slide is written last and atomically: its presence marks the slide
+  as ingested.
+  '''
+  paths = pipeline.layout(config, local)
+  svs_ext = config['SVS']['extension']
+  ann_fmt = config['ANNOTATION']['format']
+  nshards = int(config['PATCH']['shards'])
+  threads = int(config['NTH_PATCHES']) if threads is None else threads
+
+  metrics_dir = paths['metrics_dir'] if bool(config['METRICS']['enabled']) else None
+  profile = bool(config['METRICS']['profile'])
+
+  svs_filename = os.path.join(paths['svs_dir'], '{}.{}'.format(name, svs_ext))
+  contours = os.path.join(paths['contour_dir'], '{}.npz'.format(name))
+  color_map = os.path.join(local, 'cmap.dat')
+  region_dir = os.path.join(paths['ann_dir'], name)
+  regions = os.path.join(paths['ann_dir'], 'regions_{}.csv'.format(name))
+
+  preview_dir = os.path.join(paths['preview_dir'], name) if bool(config['ANNOTATION']['preview']) else None
+
+  # the directory outputs are removed before the job (as Snakemake does)
+  for directory in (region_dir, preview_dir):
+    if directory is not None:
+      shutil.rmtree(directory, ignore_errors=True)
+
+  with pipeline.rule_metrics('make_annotation', name, metrics_dir, profile):
+    pipeline.make_annotation(svs_filename, contours, color_map, region_dir, regions,
+                             name=name, patch_size=int(config['PATCH']['size']), region_gap=int(config['ANNOTATION']['region_gap']), fmt=ann_fmt,
+                             preview_dir=preview_dir)
+
+  counters, statistics = [], []
+
+  for shard in range(nshards):
+    counters.append(os.path.join(paths['shard_dir'], 'ann_{}_counter_{}.dat'.format(name, shard)))
+    statistics.append(os.path.join(paths['shard_dir'], 'ann_{}_statistics_{}.json'.format(name, shard)))
+
+    with pipeline.rule_metrics('make_patches', '{}_{}'.format(name, shard), metrics_dir, profile):
+      pipeline.make_patches(region_dir, regions, color_map, counters[-1], statistics[-1],
+                            name=name, patch_svs=paths['patch_svs'], patch_ann=paths['patch_ann'],
+                            patch_size=int(config['PATCH']['size']), patch_stride=int(config['PATCH']['stride']),
+                            shard=shard, nshards=nshards, fmt=ann_fmt, threads=threads,
+                            sampling=pipeline.sampling_arguments(config))
+
+  pipeline.merge_statistics(statistics, os.path.join(paths['ann_dir'], 'ann_{}_statistics.json'.format(name)))
+
+  counter = os.path.join(paths['ann_dir'], 'ann_{}_counter.dat'.format(name))
+  writeatomic(pipeline.merge_slide_counters, counter, counters)
+
+  with open(counter, 'r', encoding='utf-8') as fp:
+    return sum(1 for _ in fp) - 1
+
+
+class IngestionService (object):
+
+  def __init__ (self, config, local=None, workers=2, threads=None, queue_size=64, interval=10., settle=60., priority='fifo'):
+    '''
+    Long-running ingestion of the slides which arrive in the input folders
+
+    Parameters
+    ----------
+      config : dict
+        Pipeline configuration (config.yaml of the Snakemake pipeline)
+
+      local : str
+        Working directory of the pipeline (default the current one)
+
+      workers : int
+        Number of slides processed in parallel (worker processes)
+
+      threads : int
+        Threads of each slide job (default NTH_PATCHES)
+
+      queue_size : int
+        Maximum number of slides waiting for a worker
+
+      interval : float
+        Seconds between two scans of the input folders
+
+      settle : float
+        Seconds a slide/annotation pair must stay unchanged before being queued
+
+      priority : str
+        Order of the queued slides: 'fifo' (first detected), 'smallest' or
+        'largest' (size of the slide file)
+
+    Notes
+    -----
+    Each stable pair whose counter is missing or older than the slide or
+    the annotation file is queued (the outputs of a previous batch run are
+    reused). The contours are parsed and checked against the colormap of
+    the dataset by the service; the regions, patches and counters of the
+    slide are produced by a worker (see ingest_slide) and, as soon as a
+    slide is done, the patches db (ann_db.dat) and the dataset statistics
+    (patch_statistics.json) are updated concatenating the counters of the
+    ingested slides, in the same order of the Snakemake pipeline.
+    The colormap (cmap.dat) encodes the patch labels of every slide: if it
+    is missing it is built from the annotations found at the first scan,
+    and slides with colors outside the colormap are rejected (the encoding
+    of the whole dataset changes, so the batch pipeline must be rerun).
+    Failed slides are retried only when their files change.
+    '''
+    if priority not in PRIORITIES:
+      raise ValueError('Invalid priority {0}! Possible values are {1}'.format(priority, ', '.join(PRIORITIES)))
+
+    self.config = config
+    self.local = os.getcwd() if local is None else os.path.abspath(local)
+    self.paths = pipeline.layout(config, self.local)
+    self.workers = max(int(workers), 1)
+    self.threads = threads
+    self.queue_size = max(int(queue_size), 1)
+    self.interval = interval
+    self.priority = priority
+
+    self.svs_ext = config['SVS']['extension']
+    self.xml_ext = config['XML']['extension']
+
+    self.watcher = Watcher(self.paths['svs_dir'], self.svs_ext, self.paths['xml_dir'], self.xml_ext, settle)
+
+    self.color_map = os.path.join(self.local, 'cmap.dat')
+    self.patches_db = os.path.join(self.local, 'ann_db.dat')
+    self.statistics = os.path.join(self.local, 'patch_statistics.json')
+
+    # heap of (priority, sequence, name, signature, stable time) and the names in it
+    self.queue = []
+    self.queued = set()
+    # future : (name, signature, stable time, start time)
+    self.running = dict()
+    # name : signature of the failed slides
+    self.failed = dict()
+    # names of the files without their slide or annotation (already reported)
+    self.unpaired = set()
+    self._sequence = 0
+    # (names, counter mtimes, outputs signature) of the last update of the patches db
+    self._merged = None
+
+    for directory in (self.paths['ann_dir'], self.paths['shard_dir'], self.paths['contour_dir'], self.paths['patch_svs'], self.paths['patch_ann']):
+      os.makedirs(directory, exist_ok=True)
+
+  def filename (self, name, kind):
+    '''
+    Returns the slide ('svs'), annotation ('xml'), contours or counter filename of a slide
+    '''
+    if kind == 'svs':
+      return os.path.join(self.paths['svs_dir'], '{}.{}'.format(name, self.svs_ext))
+    if kind == 'xml':
+      return os.path.join(self.paths['xml_dir'], '{}.{}'.format(name, self.xml_ext))
+    if kind == 'contours':
+      return os.path.join(self.paths['contour_dir'], '{}.npz'.format(name))
+    return os.path.join(self.paths['ann_dir'], 'ann_{}_counter.dat'.format(name))
+
+  def isdone (self, name):
+    '''
+    Checks if the counter of a slide is up to date
+    '''
+    return isfresh(self.filename(name, 'counter'), (self.filename(name, 'svs'), self.filename(name, 'xml')))
+
+  def prepare (self, names):
+    '''
+    Parses the contours of the slides and checks their colors against the colormap
+
+    Returns
+    -------
+      rejected : dict
+        Names and error messages of the slides which can not be ingested
+    '''
+    import numpy as np
+
+    for name in names:
+      contours = self.filename(name, 'contours')
+      if not isfresh(contours, (self.filename(name, 'xml'), )):
+        pipeline.cache_contours(self.filename(name, 'xml'), contours, self.config['ANNOTATION']['simplify'])
+
+    if not os.path.isfile(self.color_map):
+      pipeline.make_colormap([self.filename(name, 'contours') for name in names], self.color_map)
+      print('Colormap built from {0} annotation files'.format(len(names)), flush=True)
+
+    known = set(color for color, _ in pipeline.readcolormap(self.color_map))
+    rejected = dict()
+
+    for name in names:
+      with np.load(self.filename(name, 'contours')) as data:
+        colors = set(map(str, data['colors'])) - known
+
+      if colors:
+        rejected[name] = 'colors {0} are not in the colormap {1}: rerun the batch pipeline'.format(', '.join(sorted(colors)), self.color_map)
+
+    return rejected
+
+  def schedule (self, stable):
+    '''
+    Queues the stable slides which are not ingested yet (at most queue_size waiting slides)
+    '''
+    running = set(name for name, *_ in self.running.values())
+    candidates = []
+
+    for name, (signature, first) in stable.items():
+      if name in self.queued or name in running or self.failed.get(name) == signature or self.isdone(name):
+        continue
+
+      if self.priority == 'fifo':
+        key = first
+      elif self.priority == 'smallest':
+        key = signature[0]
+      else:
+        key = -signature[0]
+
+      candidates.append((key, name, signature, first))
+
+    candidates.sort()
+    # the slides beyond the queue bound are queued by the next scans
+    candidates = candidates[: max(self.queue_size - len(self.queue), 0)]
+
+    rejected = self.prepare([name for _, name, _, _ in candidates]) if candidates else dict()
+
+    for key, name, signature, first in candidates:
+      if name in rejected:
+        print('Rejected {0}: {1}'.format(name, rejected[name]), flush=True)
+        self.failed[name] = signature
+        continue
+
+      heapq.heappush(self.queue, (key, self._sequence, name, signature, first))
+      self.queued.add(name)
+      self._sequence += 1
+
+    return len(candidates)
+
+  def update_database (self):
+    '''
+    Updates the patches db and the dataset statistics if they are older than the counters of the ingested slides
+
+    Notes
+    -----
+    When the slides ingested since the last update follow (in name order)
+    the ones already merged, and neither the merged counters nor the
+    outputs changed in the meantime, their rows are appended to the db
+    (with a single write) and their statistics are merged into the dataset
+    ones. Otherwise both files are rewritten (atomically) from all the
+    counters, in the same order of the Snakemake pipeline.
+    '''
+    names = [name for name in sorted(self.watcher.seen) if os.path.isfile(self.filename(name, 'counter'))]
+
+    if not names:
+      return
+
+    counters = [self.filename(name, 'counter') for name in names]
+    statistics = [os.path.join(self.paths['ann_dir'], 'ann_{}_statistics.json'.format(name)) for name in names]
+
+    if isfresh(self.patches_db, counters) and isfresh(self.statistics, statistics):
+      return
+
+    signatures = [os.stat(counter).st_mtime_ns for counter in counters]
+    merged = len(self._merged[0]) if self._merged is not None else 0
+
+    if 0 < merged < len(names) and self._merged == (names[:merged], signatures[:merged], self._outputs()):
+      rows = []
+      for counter in counters[merged:]:
+        with open(counter, 'r', encoding='utf-8') as fp:
+          fp.readline()
+          rows.append(fp.read())
+
+      with open(self.patches_db, 'a', encoding='utf-8') as fp:
+        fp.write(''.join(rows))
+
+      writeatomic(pipeline.merge_statistics, self.statistics, [self.statistics] + statistics[merged:])
+      print('Patches db updated: {0} slides ({1} appended)'.format(len(names), len(names) - merged), flush=True)
+
+    else:
+      writeatomic(pipeline.merge_patch_counters, self.patches_db, counters)
+      writeatomic(pipeline.merge_statistics, self.statistics, statistics)
+      print('Patches db updated: {0} slides'.format(len(names)), flush=True)
+
+    self._merged = (names, signatures, self._outputs())
+
+  def _outputs (self):
+    '''
+    Returns the (size, mtime) of the patches db and of the dataset statistics
+    '''
+    return tuple((stat.st_size, stat.st_mtime_ns) for stat in map(os.stat, (self.patches_db, self.statistics)))
+
+  def step (self, pool):
+    '''
+    Scans the input folders, submits the queued slides and collects the finished ones
+
+    Returns
+    -------
+      busy : bool
+        True if some slide is queued, running or waiting to become stable
+        (the unpaired files are reported once and ignored)
+    '''
+    stable, waiting, unpaired = self.watcher.scan()
+
+    for name in sorted(unpaired - self.unpaired):
+      missing = self.filename(name, 'xml' if os.path.isfile(self.filename(name, 'svs')) else 'svs')
+      print('Skipping {0}: {1} not found'.format(name, missing), flush=True)
+    self.unpaired = unpaired
+
+    self.schedule(stable)
+
+    while self.queue and len(self.running) < self.workers:
+      _, _, name, signature, first = heapq.heappop(self.queue)
+      self.queued.discard(name)
+      print('Ingesting {0}...'.format(name), flush=True)
+      self.running[pool.submit(ingest_slide, name, self.config, self.local, self.threads)] = (name, signature, first, time.time())
+
+    if self.running:
+      done, _ = wait(list(self.running), timeout=self.interval, return_when=FIRST_COMPLETED)
+    else:
+      done = []
+      time.sleep(self.interval)
+
+    for future in done:
+      name, signature, first, start = self.running.pop(future)
+
+      try:
+        npatches = future.result()
+      except Exception:
+        self.failed[name] = signature
+        print('Failed {0}:\n{1}'.format(name, traceback.format_exc()), flush=True)
+        continue
+
+      now = time.time()
+      print('Ingested {0}: {1} patches in {2:.1f} s ({3:.1f} s after the files were complete)'.format(name, npatches, now - start, now - first), flush=True)
+
+    # (also the counters of a previous run not merged yet)
+    self.update_database()
+
+    pending = [name for name, (signature, _) in stable.items() if self.failed.get(name) != signature and not self.isdone(name)]
+
+    return bool(self.queue or self.running or waiting or pending)
+
+  def serve (self, once=False):
+    '''
+    Runs the service (until interrupted, or until the slides found are ingested if once)
+    '''
+    print('Watching {0} and {1} ({2} workers, queue of {3} slides)'.format(self.paths['svs_dir'], self.paths['xml_dir'], self.workers, self.queue_size), flush=True)
+
+    with ProcessPoolExecutor(max_workers=self.workers) as pool:
+      try:
+        while self.step(pool) or not once:
+          pass
+
+      except KeyboardInterrupt:
+        print('Stopping: waiting for the running slides...', flush=True)
+        wait(list(self.running))
+        self.update_database()
+
+
+def main ():
+  '''
+  Runs the ingestion service with the parameters specified in command line
+  '''
+
+  args = parse_args()
+  config = readconfig(args.config)
+
+  print('running SlideSeg ingestion with parameters:')
+  print('  Configuration        : {}'.format(args.config))
+  print('  Workers              : {}'.format(args.workers))
+  print('  Queue size           : {}'.format(args.queue))
+  print('  Scan interval        : {} s'.format(args.interval))
+  print('  Settle time          : {} s'.format(args.settle))
+  print('  Priority             : {}'.format(args.priority))
+
+  service = IngestionService(config, workers=args.workers, threads=args.threads, queue_size=args.queue,
+                             interval=args.interval, settle=args.settle, priority=args.priority)
+  service.serve(once=args.once)
+
+
+if __name__ == '__main__':
+
+  main()
@@ -0,0 +1,748 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Bodies of the Snakefile rules.
+# Only the standard library is imported at module level: the heavy dependencies
+# (cv2, PIL, pandas, sklearn, ...) are imported by the rules which use them,
+# so the DAG construction (e.g. snakemake -n) does not pay for them.
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import json
+import shutil
+import tempfile
+from functools import reduce
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+MAX_IMAGE_PIXELS = 425980833600 # 100 times the default maximum size of PIL
+
+# listings already read by this process
+_LISTINGS = dict()
+
+
+def listnames (directory, extension, cache_file=None):
+  '''
+  Lists the names (without extension) of the files of a directory with the given extension
+
+  Parameters
+  ----------
+    directory : str
+      Directory to list
+
+    extension : str
+      Extension of the files (without dot)
+
+    cache_file : str
+      Json file of the cached listings (None disables the cache)
+
+  Returns
+  -------
+    names : list
+      Sorted list of names
+
+  Notes
+  -----
+  The directory is read with a single scandir (no stat of each file). The
+  cached listing is reused while the modification time of the directory
+  is unchanged (it changes whenever a file is added, removed or renamed),
+  so on large network filesystems the listing costs a single stat.
+  '''
+  directory = os.path.abspath(directory)
+  mtime = os.stat(directory).st_mtime_ns
+  key = '{0}:{1}'.format(directory, extension)
+
+  if _LISTINGS.get(key, (None, ))[0] == mtime:
+    return list(_LISTINGS[key][1])
+
+  cache = dict()
+  if cache_file is not None and os.path.isfile(cache_file):
+    try:
+      with open(cache_file, 'r', encoding='utf-8') as fp:
+        cache = json.load(fp)
+    except ValueError: # corrupted cache
+      cache = dict()
+
+  if cache.get(key, dict()).get('mtime') == mtime:
+    names = cache[key]['names']
+
+  else:
+    suffix = '.{}'.format(extension)
+    with os.scandir(directory) as it:
+      names = sorted(entry.name[:-len(suffix)] for entry in it if entry.name.endswith(suffix) and not entry.name.startswith('.'))
+
+    if cache_file is not None:
+      cache[key] = {'mtime' : mtime, 'names' : names}
+
+      fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)), prefix='.', suffix='.tmp')
+      with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+        json.dump(cache, fp)
+      os.replace(tmp, cache_file)
+
+  _LISTINGS[key] = (mtime, names)
+
+  return list(names)
+
+
+def matchnames (slides, annotations):
+  '''
+  Checks that each slide has its annotation file (and vice versa)
+
+  Parameters
+  ----------
+    slides : list
+      Names of the slides
+
+    annotations : list
+      Names of the annotation files
+
+  Returns
+  -------
+    names : list
+      Sorted list of names
+  '''
+  slides, annotations = set(slides), set(annotations)
+
+  if slides != annotations:
+    show = lambda names : ', '.join(sorted(names)[:10]) + (', ...' if len(names) > 10 else '')
+    raise ValueError('Slides and annotations do not match! '
+                     'Slides without annotation ({0:d}): {1}. '
+                     'Annotations without slide ({2:d}): {3}'.format(len(slides - annotations), show(slides - annotations),
+                                                                      len(annotations - slides), show(annotations - slides)))
+
+  return sorted(slides)
+
+
+def layout (config, local=None):
+  '''
+  Returns the directories of the pipeline defined by the config (paths relative to local)
+
+  Parameters
+  ----------
+    config : dict
+      Pipeline configuration (config.yaml)
+
+    local : str
+      Working directory of the pipeline (default the current one)
+
+  Returns
+  -------
+    paths : dict
+      Absolute paths of the slide (svs_dir) and annotation (xml_dir)
+      directories, of the intermediate contours, regions and counters
+      (contour_dir, ann_dir, shard_dir, preview_dir), of the patches
+      (patch_svs, patch_ann) and of the metrics (metrics_dir)
+  '''
+  local = os.getcwd() if local is None else local
+  path = lambda x : os.path.abspath(os.path.join(local, x))
+
+  svs_dir = path(config['SVS']['slide_dir'])
+  xml_dir = path(config['XML']['xml_dir'])
+  patch_dir = path(config['PATCH']['patch_dir'])
+  ann_dir = os.path.join(os.path.dirname(svs_dir), 'annotation')
+
+  return {
+           'svs_dir'     : svs_dir,
+           'xml_dir'     : xml_dir,
+           'ann_dir'     : ann_dir,
+           'contour_dir' : os.path.join(os.path.dirname(xml_dir), 'contours'),
+           'shard_dir'   : os.path.join(ann_dir, 'shards'),
+           'preview_dir' : os.path.join(ann_dir, 'preview'),
+           'patch_svs'   : '_'.join([patch_dir, config['SVS']['slide_dir']]),
+           'patch_ann'   : '_'.join([patch_dir, config['XML']['xml_dir']]),
+           'metrics_dir' : path(config['METRICS']['metrics_dir']),
+         }
+
+
+def sampling_arguments (config):
+  '''
+  Returns the arguments of the ChipSampler of the patches (None if the sampling is disabled)
+  '''
+  if not bool(config['SAMPLING']['enabled']):
+    return None
+
+  return {'ratios'    : config['SAMPLING']['ratios'],
+          'max_chips' : config['SAMPLING']['max_chips'],
+          'method'    : config['SAMPLING']['method'],
+          'seed'      : config['SAMPLING']['seed'],
+         }
+
+
+def rule_metrics (rule_name, job_name=None, metrics_dir=None, profile=False):
+  '''
+  Collects the per-stage timers, counters and peak memory of a job into metrics_dir/{rule}_{job}.json
+  (and its cProfile stats into metrics_dir/{rule}_{job}.prof).
+  It does nothing if metrics_dir is None.
+  '''
+  from .functions.metrics import bind
+  from .functions.metrics import collect
+
+  if metrics_dir is None:
+    return bind(None)
+
+  name = rule_name if job_name is None else '{}_{}'.format(rule_name, job_name)
+  profile = os.path.join(metrics_dir, '{}.prof'.format(name)) if profile else None
+
+  return collect(name, os.path.join(metrics_dir, '{}.json'.format(name)), profile)
+
+
+def readcolormap (filename):
+  '''
+  Reads the (color, encoded) pairs of the colormap file
+  '''
+  with open(filename, 'r', encoding='utf-8') as fp:
+    rows = fp.read().splitlines()
+
+  # check right fmt
+  if len(rows[0].split(',')) != 2:
+    raise ValueError('Invalid colormap file {0}! Expected header color,encoded. Given {1}'.format(filename, rows[0]))
+
+  return [(color, int(encoded)) for color, encoded in (row.split(',') for row in rows[1:])]
+
+
+def cluster_contours (contours, gap):
+  '''
+  Groups the contours whose bounding boxes are closer than gap pixels.
+  A negative gap gives a single group with all the contours.
+  Return the list of (contour indexes, bounding box (minx, miny, maxx, maxy)) of each group.
+  '''
+  groups = [([i], (cnt[..., 0].min(), cnt[..., 1].min(), cnt[..., 0].max(), cnt[..., 1].max())) for i, cnt in enumerate(contours)]
+
+  union = lambda a, b : (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+  if gap < 0:
+    return [(list(range(len(groups))), reduce(union, (box for _, box in groups)))] if groups else []
+
+  merged = True
+  # merging two groups enlarges the bounding box, so repeat until no more groups are merged
+  while merged:
+    merged = False
+    # sweep along x: the groups ending (plus gap) before the start of the current one can not be close to it, nor to the next ones
+    active, swept = [], []
+
+    for group in sorted(map(list, groups), key=lambda group : group[1][0]):
+      members, box = group
+      active = [other for other in active if other[1][2] + gap >= box[0]]
+
+      for other in active:
+        if other[1][1] - gap <= box[3] and box[1] - gap <= other[1][3]:
+          other[0].extend(members)
+          other[1] = union(other[1], box)
+          merged = True
+          break
+
+      else:
+        active.append(group)
+        swept.append(group)
+
+    groups = swept
+
+  # keep the order of the contours for the painting (and the groups in order of their first contour)
+  return sorted(((sorted(members), box) for members, box in groups), key=lambda group : group[0][0])
+
+
+def cache_contours (xml_filename, contours, simplify=None):
+  '''
+  Parses the xml file once: the other rules load the compact contour arrays
+  (simplified within simplify pixels of the original ones if given, see
+  SlideSeg.functions.contours.simplifycontours)
+  '''
+  from .functions.contours import readcontours
+  from .functions.contours import savecontours
+  from .functions.contours import simplifycontours
+  from .functions.contours import simplifytolerance
+  from .functions.metrics import count
+  from .functions.metrics import stage
+
+  with stage('parse'):
+    data = readcontours(xml_filename, cache_file=contours)
+
+    if simplify:
+      # the annotations are rasterized at level 0
+      count('vertices_original', len(data['points']))
+      data = simplifycontours(data, simplifytolerance(1., simplify))
+      savecontours(contours, data, xml_filename)
+
+  count('vertices', len(data['points']))
+
+
+def make_colormap (contours, color_map):
+  '''
+  Builds the global colormap of the annotations
+  '''
+  import numpy as np
+
+  colors = set()
+
+  for filename in contours:
+
+    with np.load(filename) as data:
+      colors.update(map(str, data['colors']))
+
+  # black (background) first so that it is encoded as 0, the other colors in a deterministic order
+  colors.discard('#000000')
+  colors = ['#000000'] + sorted(colors)
+  range_color = np.linspace(0, 255, len(colors)).astype(int)
+
+  with open(color_map, 'w', encoding='utf-8') as out:
+    # write header
+    out.write('color,encoded\n')
+    for i, c in zip(range_color, colors):
+      out.write('{},{:d}\n'.format(c, i))
+
+
+def make_annotation (svs_filename, contours, color_map, region_dir, regions, name, patch_size, region_gap=256, fmt='npy', preview_dir=None):
+  '''
+  Rasterizes the annotations of a slide and extracts the padded regions
+  (ann_{name}_{k} and roi_{name}_{k} files) listed in the regions csv file.
+  If preview_dir is given, the DeepZoom pyramid of each region with the
+  annotations blended over it (roi_{name}_{k}.dzi) is written there, from
+  the region images already in memory.
+  '''
+  import cv2
+  import numpy as np
+  from PIL import Image
+  # from openslide import OpenSlide
+  from .functions.contours import itercontours
+  from .functions.metrics import count
+  from .functions.metrics import stage
+  from .functions.pyramid import DeepZoomWriter
+  from .functions.pyramid import hexlut
+  from .functions.pyramid import overlaymask
+
+  Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+  # load colormap
+  cmap = dict(readcolormap(color_map))
+  lut = hexlut({encoded : color for color, encoded in cmap.items()})
+
+  if preview_dir is not None:
+    os.makedirs(preview_dir, exist_ok=True)
+
+  # Import full SVS large-image
+  # osr = OpenSlide(svs_filename)
+  osr = Image.open(svs_filename)
+
+  # compute max dimension of the image
+  # w, h = osr.level_dimensions[0] # max size
+  w, h = osr.size
+
+  # Load the parsed contours
+  with stage('parse'), np.load(contours) as data:
+    contours = [(cmap[color_code], cnt) for _, color_code, cnt in itercontours(data)]
+
+  os.makedirs(region_dir, exist_ok=True)
+
+  with open(regions, 'w', encoding='utf-8') as out:
+    # write header
+    out.write('region,minx,miny,maxx,maxy,pad_top,pad_left,rows,cols\n')
+
+    # each group of close contours is processed in its own region
+    for k, (group, (minx, miny, maxx, maxy)) in enumerate(cluster_contours([cnt for _, cnt in contours], region_gap)):
+
+      # seeden viewer allows to create rois outside the image boundaries!!
+      maxx = np.clip(maxx, 0, w)
+      maxy = np.clip(maxy, 0, h)
+
+      minx = np.clip(minx, 0, w)
+      miny = np.clip(miny, 0, h)
+
+      if maxx <= minx or maxy <= miny:
+        continue
+
+      # rasterize the group in its own canvas: it includes the last row/column of the points,
+      # so that the contours are clipped only by the image boundaries (as in the whole slide)
+      with stage('rasterize'):
+        mat = np.zeros(shape=(min(maxy + 1, h) - miny, min(maxx + 1, w) - minx), dtype='uint8')
+
+        for i in group:
+          color_code, cnt = contours[i]
+          cv2.fillPoly(img=mat, pts=[cnt], color=color_code, lineType=8, shift=0, offset=(-minx, -miny))
+
+      # extract the annotated ROI
+      roi = mat[: maxy - miny, : maxx - minx]
+      # evaluate paddding for the ROI according to the desired size
+      rw, rh = roi.shape
+      pad_w = max(patch_size - (rw % patch_size), 0)
+      pad_h = max(patch_size - (rh % patch_size), 0)
+
+      # Number of raws/columns to be added for every directons
+      pad_top    = pad_w >> 1 # bit shift, integer division by two
+      pad_bottom = pad_w - pad_top
+      pad_left   = pad_h >> 1
+      pad_right  = pad_h - pad_left
+
+      # extract the corresponding ROI in the original image
+      # mat = osr.read_region(location=(miny, minx), level=0, size=(maxy - miny, maxx - minx)).convert('RGB')
+      with stage('read'):
+        roi_original = osr.crop(box=(minx, miny, maxx, maxy)).convert('RGB')
+
+      ann_filename = os.path.join(region_dir, 'ann_{}_{:d}.{}'.format(name, k, fmt))
+      svs_filename = os.path.join(region_dir, 'roi_{}_{:d}.{}'.format(name, k, fmt))
+
+      with stage('write'):
+        if fmt == 'npy':
+          # write the padded images directly into raw memory-mapped files (no encoding and no padded copy)
+          padded = np.lib.format.open_memmap(ann_filename, mode='w+', dtype=np.uint8, shape=(rw + pad_w, rh + pad_h))
+          padded[pad_top : pad_top + rw, pad_left : pad_left + rh] = roi
+          padded.flush()
+          del padded
+
+          # the original image is stored in BGR order, as decoded by make_patches from the png file
+          padded = np.lib.format.open_memmap(svs_filename, mode='w+', dtype=np.uint8, shape=(rw + pad_w, rh + pad_h, 3))
+          padded[pad_top : pad_top + rw, pad_left : pad_left + rh] = np.asarray(roi_original)[..., ::-1]
+          padded.flush()
+          del padded
+
+        else:
+          # pad the annotated image
+          padded = np.pad(roi, ((pad_top, pad_bottom), (pad_left, pad_right)), mode='constant', constant_values=(0, 0))
+          # save it
+          cv2.imwrite(ann_filename, padded)
+
+          # pad the original image
+          padded = np.pad(roi_original, ((pad_top, pad_bottom), (pad_left, pad_right), (0, 0)), mode='constant', constant_values=(0, 0))
+          # save it
+          cv2.imwrite(svs_filename, padded)
+
+      count('regions')
+      count('bytes', os.path.getsize(ann_filename) + os.path.getsize(svs_filename))
+
+      if preview_dir is not None:
+        with stage('preview'):
+          overlay = overlaymask(np.asarray(roi_original)[..., ::-1], roi, lut)
+          ntiles, nbytes = DeepZoomWriter(os.path.join(preview_dir, 'roi_{}_{:d}.dzi'.format(name, k))).write(overlay)
+          del overlay
+
+        count('tiles', ntiles)
+        count('preview_bytes', nbytes)
+
+      # bounding box of the region and its padding (slide coordinates)
+      out.write('{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:d},{:d}\n'.format(k, minx, miny, maxx, maxy, pad_top, pad_left, rw + pad_w, rh + pad_h))
+
+
+def make_patches (region_dir, regions, color_map, counter, statistics, name, patch_svs, patch_ann,
+                  patch_size, patch_stride, shard=0, nshards=1, fmt='npy', threads=1, sampling=None):
+  '''
+  Splits a contiguous band of columns of the regions of a slide into patches,
+  writing the counter fragment and the statistics of the band.
+  If sampling (arguments of ChipSampler, with the colors of the colormap as
+  class names) is given only the sampled patches are written: the patches are
+  planned from the annotations before any patch of the slide is read.
+  '''
+  import cv2
+  import tqdm
+  import numpy as np
+  from PIL import Image
+  from multiprocessing.pool import ThreadPool
+  from .functions.statistics import ChipStatistics
+  from .functions.sampling import ChipSampler
+  from .functions.sampling import shardcap
+  from .functions.metrics import active
+  from .functions.metrics import bind
+  from .functions.metrics import count
+  from .functions.metrics import stage
+
+  Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+  collector = active()
+
+  # load the list of annotated regions
+  with open(regions, 'r', encoding='utf-8') as fp:
+    regions = [row.split(',') for row in fp.read().splitlines()[1:]]
+
+  # load colormap
+  cmap = {encoded : color for color, encoded in readcolormap(color_map)}
+
+  images = {}
+
+  for region in regions:
+    k = int(region[0])
+    roi_name = 'roi_{}_{:d}'.format(name, k)
+    svs_filename = os.path.join(region_dir, '{}.{}'.format(roi_name, fmt))
+    ann_filename = os.path.join(region_dir, 'ann_{}_{:d}.{}'.format(name, k, fmt))
+
+    with stage('read'):
+      if fmt == 'npy':
+        # memory-map the raw images: each patch is a zero-copy view
+        osr = np.load(svs_filename, mmap_mode='r')
+        ann = np.load(ann_filename, mmap_mode='r')
+
+      else:
+        # Import full SVS large-image
+        osr = Image.open(svs_filename)
+        osr = np.asarray(osr, dtype=np.uint8)
+        # Import full Annotated large-image
+        ann = Image.open(ann_filename)
+        ann = np.asarray(ann, dtype=np.uint8)
+
+    images[k] = (roi_name, osr, ann)
+
+  # contiguous band of (region, column) pairs assigned to this shard
+  cols = [(k, col) for k, (_, osr, _) in sorted(images.items()) for col in range(0, osr.shape[1], patch_size - patch_stride)]
+  band = cols[shard * len(cols) // nshards : (shard + 1) * len(cols) // nshards]
+
+  # streaming statistics of the patches (BGR order, as decoded by cv2)
+  stats = ChipStatistics(channels=3, names=cmap, order='BGR')
+
+  step = patch_size - patch_stride
+  selected = None
+
+  def plan_column (item):
+    # labels (colors) of the annotated patches of a single column
+    with bind(collector), stage('plan'):
+      region, col = item
+      _, _, ann = images[region]
+      labels = [((region, col, row), set(np.unique(ann[row : row + patch_size, col : col + patch_size]))) for row in range(0, ann.shape[0], step)]
+      return [(key, [cmap[v] for v in unique_ann if v != 0]) for key, unique_ann in labels if any(v != 0 for v in unique_ann)]
+
+  if sampling is not None:
+    sampling = dict(sampling)
+    sampling['max_chips'] = shardcap(sampling.get('max_chips', None), shard, nshards)
+    sampler = ChipSampler(**sampling)
+    sampler.validate(cmap.values())
+
+    with ThreadPool(threads) as pool:
+      for planned in pool.imap(plan_column, band):
+        for key, labels in planned:
+          sampler.add(key, labels)
+
+    selected = sampler.select()
+    count('planned', sum(sampler.available.values()))
+    print('Sampled {0} of {1} patches'.format(len(selected), sum(sampler.available.values())))
+    print(sampler.summary())
+
+  def make_column (item):
+    # generate the patches of a single column and return the corresponding counter rows and statistics
+    # (the workers report to the collector of the job)
+    with bind(collector):
+      region, col = item
+      roi_name, osr, ann = images[region]
+      lines = []
+      column_stats = ChipStatistics(channels=3, names=cmap, order='BGR')
+
+      for row in range(0, osr.shape[0], step):
+
+        # skip the patches discarded by the sampling
+        if selected is not None and (region, col, row) not in selected:
+          continue
+
+        svs_patch = osr[row : row + patch_size, col : col + patch_size]
+        ann_patch = ann[row : row + patch_size, col : col + patch_size]
+
+        with stage('plan'):
+          unique_ann = set(np.unique(ann_patch))
+
+        # save only if there is a signal
+        if all(v == 0 for v in unique_ann):
+          continue
+
+        outfile = '{}_{:d}_{:d}.png'.format(roi_name, col, row)
+
+        # the patches are encoded in memory, so the encoding and the filesystem writes are measured separately
+        with stage('encode'):
+          _, svs_data = cv2.imencode('.png', svs_patch)
+          _, ann_data = cv2.imencode('.png', ann_patch)
+
+        with stage('write'):
+          svs_data.tofile(os.path.join(patch_svs, outfile))
+          ann_data.tofile(os.path.join(patch_ann, outfile))
+
+        count('chips')
+        count('bytes', svs_data.nbytes + ann_data.nbytes)
+
+        # save counter of labels
+        # print on file the corresponding areas as boolean mask
+        tags = ','.join([str(int(k in unique_ann)) for k, _ in cmap.items()])
+
+        assert len(tags) == 7
+
+        lines.append('{},{}\n'.format(outfile, tags))
+
+        # the patch is still in memory: no extra pass over the dataset
+        with stage('statistics'):
+          column_stats.update(svs_patch, ann_patch)
+
+      return lines, column_stats
+
+  # start to generate patches
+
+  with open(counter, 'w', encoding='utf-8') as out, ThreadPool(threads) as pool:
+    # write header
+    out.write('Filename,{}\n'.format(','.join([v for _, v in cmap.items()])))
+
+    # imap preserves the column order, so the fragment is deterministic
+    for lines, column_stats in tqdm.tqdm(pool.imap(make_column, band), total=len(band)):
+      out.writelines(lines)
+      stats.merge(column_stats)
+
+  stats.save(statistics)
+
+
+def merge_slide_counters (counters, output):
+  '''
+  Concatenates the counter shards of a slide following their index, keeping only the first header
+  '''
+  with open(output, 'w', encoding='utf-8') as out:
+    for i, input_file in enumerate(counters):
+      with open(input_file, 'r', encoding='utf-8') as fp:
+        header = fp.readline()
+        if i == 0:
+          out.write(header)
+        shutil.copyfileobj(fp, out)
+
+
+def merge_statistics (statistics, output):
+  '''
+  Merges the statistics files of different shards or slides
+  '''
+  from .functions.statistics import mergestatistics
+
+  mergestatistics(statistics, output)
+
+
+def merge_patch_counters (counters, output):
+  '''
+  Concatenates the counter files of all the slides into a single db
+  '''
+  # copy the first file just to include the header
+  shutil.copyfile(counters[0], output)
+
+  # append all the other files without header
+  with open(output, 'a', encoding='utf-8') as out:
+    for input_file in counters[1:]:
+      with open(input_file, 'r', encoding='utf-8') as fp:
+        fp.readline()
+        shutil.copyfileobj(fp, out)
+
+
+def features (patches_db, patch_dir, feature_dir, feature_set=None, batch_size=256, nprocs=None, cache_dir=None):
+  '''
+  Computes the feature matrix of the patches, aligned with the patches db.
+  The incremental cache lives in cache_dir (default feature_dir/.cache),
+  which is not an output of the rule: Snakemake removes the outputs
+  (features.npy and names.npy) before running the job, so they are
+  published from the cache when it is up to date.
+  '''
+  import shutil
+  import pandas as pd
+  from .functions.features import computefeatures
+  from .functions.metrics import count
+  from .functions.metrics import stage
+
+  cache_dir = os.path.join(feature_dir, '.cache') if cache_dir is None else cache_dir
+
+  # rows aligned with the patches db: the features of unchanged patches are reused from the previous run
+  names = pd.read_csv(patches_db, sep=',', header=0, usecols=['Filename']).Filename
+  with stage('features'):
+    computefeatures(names, patch_dir, cache_dir, features=feature_set, batch_size=batch_size, nprocs=nprocs)
+
+  # hard links (the cache files are replaced, never modified in place) or copies
+  with stage('write'):
+    for filename in ('features.npy', 'names.npy'):
+      src, dst = os.path.join(cache_dir, filename), os.path.join(feature_dir, filename)
+      if os.path.lexists(dst):
+        os.remove(dst)
+      try:
+        os.link(src, dst)
+      except OSError:
+        shutil.copyfile(src, dst)
+
+  count('chips', len(names))
+
+
+def extract_interest (patches_db, interest_db, interest_key):
+  '''
+  Extracts the patches which include only the interest label
+  '''
+  import pandas as pd
+
+  patches_db = pd.read_csv(patches_db, sep=',', header=0)
+  colors = set(patches_db.columns) - {'Filename'}
+
+  if not interest_key in colors:
+    raise ValueError('Interest key not found in the CMAP of patches db! Possible keys are {}'.format(', '.join(map(str, colors))))
+
+  query = ' & '.join(("(patches_db['{}'] == 0)".format(k) for k in colors if k != interest_key))
+  query = ' & '.join((query, "(patches_db['{}'] == 1)".format(interest_key)))
+
+  extract = patches_db[eval(query)]
+
+  extract.to_csv(interest_db, sep=',', header=True, index=False)
+
+
+def eigenslices (interest_db, pca_coords, patch_dir, n_components):
+  '''
+  Computes the leave-one-slide-out PCA coordinates of the patch spectra.
+  The pickle file stores the patch filenames (Filename), their coordinates
+  (coords) and their coordinates in a single PCA fitted on all the patches
+  (index_coords, see eigenslices_index), in the same order.
+  '''
+  import cv2
+  import pickle
+  import numpy as np
+  import pandas as pd
+  from numpy.fft import fft2 as fft
+  from sklearn.pipeline import make_pipeline
+  from sklearn.decomposition import PCA
+  from sklearn.model_selection import LeaveOneGroupOut
+  from sklearn.preprocessing import StandardScaler
+
+  db = pd.read_csv(interest_db, sep=',', header=0)
+  db['svs'] = db['Filename'].str.split('_').str[1]
+  groups = np.asarray(db.svs, dtype=int)
+
+  files = (os.path.join(patch_dir, f) for f in db.Filename)
+  images = np.asarray([cv2.imread(f) for f in files])
+
+  pipe = make_pipeline(StandardScaler(), PCA(n_components=n_components))
+  logo = LeaveOneGroupOut()
+
+  # TODO: split this loop along available workers (different rules)
+  results, names = [], []
+  for train_index, test_index in logo.split(X=images, groups=groups):
+    X_train = images[train_index].reshape(len(train_index), -1)
+    X_test  = images[test_index].reshape(len(test_index), -1)
+
+    X_train = abs(fft(X_train))
+    X_test  = abs(fft(X_test))
+
+    coords = pipe.fit(X_train).transform(X_test)
+    results.append(coords)
+    # the test patches of each slide follow the splits, not the db order
+    names.append(db.Filename.values[test_index])
+
+  results = np.concatenate(results)
+  names = np.concatenate(names)
+
+  # the coordinates of each split belong to a different PCA model, so they
+  # are not comparable across the slides: the index uses a single model
+  X = abs(fft(images.reshape(len(images), -1)))
+  shared = pipe.fit(X).transform(X)
+  shared = shared[np.concatenate([test_index for _, test_index in logo.split(X=images, groups=groups)])]
+
+  with open(pca_coords, 'wb') as fp:
+    pickle.dump({'Filename' : names, 'coords' : results, 'index_coords' : shared}, fp, 2)
+
+
+def eigenslices_index (pca_coords, index_dir):
+  '''
+  Builds the nearest-neighbour index of the eigenslices coordinates (see SlideSeg.functions.knn.NeighborIndex).
+  The index uses the coordinates of the PCA fitted on all the patches
+  (index_coords): the leave-one-slide-out coordinates (coords) come from a
+  different model for each slide, so their distances across slides are
+  meaningless.
+  '''
+  import pickle
+  from .functions.knn import NeighborIndex
+
+  with open(pca_coords, 'rb') as fp:
+    data = pickle.load(fp)
+
+  if 'index_coords' not in data:
+    raise ValueError('Invalid eigenslices file {0}! The coordinates of the shared PCA (index_coords) are missing: re-run the eigenslices rule'.format(pca_coords))
+
+  index = NeighborIndex.build(index_dir, data['Filename'], data['index_coords'])
+  print('Indexed {0} patches ({1} coordinates)'.format(len(index), index.dimensions))
@@ -67,7 +67,7 @@ def main ():
       temp.append(COLORS[nearest_color])
 
     # reshape to the image fmt
-    img = np.reshape(temp, newshape=(w, h, c))
+    img = np.reshape(temp, (w, h, c))
 
     # overwrite the image with its refined version
     cv2.imwrite(file, img)
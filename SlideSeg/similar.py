@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+import argparse
+
+from SlideSeg.functions.knn import NeighborIndex
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def parse_args ():
+
+  description = 'Similar patch retrieval from the eigenslices index'
+
+  parser = argparse.ArgumentParser(description=description)
+
+  parser.add_argument('--index',   required=True,  type=str, action='store',                 help='Directory of the index (pca_index_* output of the eigenslices_index rule)')
+  parser.add_argument('--patch',   required=False, type=str, action='store', default=[],     nargs='+', help='Filenames of the query patches')
+  parser.add_argument('--list',    required=False, type=str, action='store', default=None,   help='Text file with the filenames of the query patches (one for each line)')
+  parser.add_argument('--k',       required=False, type=int, action='store', default=10,     help='Number of similar patches of each query')
+  parser.add_argument('--batch',   required=False, type=int, action='store', default=64,     help='Number of queries processed at once')
+  parser.add_argument('--outfile', required=False, type=str, action='store', default=None,   help='Output csv file (default the standard output)')
+
+  args = parser.parse_args()
+
+  patches = list(args.patch)
+
+  if args.list is not None:
+    with open(args.list, 'r', encoding='utf-8') as fp:
+      patches.extend(row.strip() for row in fp if row.strip())
+
+  if not patches:
+    parser.error('At least one query patch is required (--patch or --list)')
+
+  return args, patches
+
+
+def main ():
+
+  args, patches = parse_args()
+
+  tic = time.perf_counter()
+  index = NeighborIndex(args.index)
+  neighbours = index.similar(patches, k=args.k, batch_size=args.batch)
+  toc = time.perf_counter()
+
+  out = sys.stdout if args.outfile is None else open(args.outfile, 'w', encoding='utf-8')
+
+  try:
+    out.write('Query,Rank,Filename,Distance\n')
+    for patch, similar in zip(patches, neighbours):
+      for rank, (name, distance) in enumerate(similar, start=1):
+        out.write('{},{:d},{},{:.6g}\n'.format(patch, rank, name, distance))
+
+  finally:
+    if out is not sys.stdout:
+      out.close()
+
+  print('{0:d} queries over {1:d} patches in {2:.1f} ms'.format(len(patches), len(index), (toc - tic) * 1e3), file=sys.stderr)
+
+
+if __name__ == '__main__':
+
+  main()
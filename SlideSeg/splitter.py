@@ -7,6 +7,9 @@ from __future__ import division
 import os
 import argparse
 import SlideSeg
+from SlideSeg.functions.slideseg import sweepdir
+from SlideSeg.functions.slideseg import parsesweep
+from SlideSeg.functions.slideseg import mergedetails
 
 __author__ = 'Nico Curti'
 __email__ = 'nico.curti2@unibo.it'
@@ -21,7 +24,7 @@ def parse_args ():
   booleans = { 'yes': True, 'true': True,   't': True,  'y': True,  '1': True,
                'no': False, 'false': False, 'f': False, 'n': False, '0': False
              }
-  str2bool = lambda x : booleans[x]
+  str2bool = lambda x : booleans[x.lower()]
 
   parser.add_argument('--image',    required=True,  type=str,      action='store',                help='.SVS image filename')
   parser.add_argument('--ann',      required=True,  type=str,      action='store',                help='Path to the annotation file')
@@ -32,6 +35,24 @@ def parse_args ():
   parser.add_argument('--save_all', required=False, type=str2bool, action='store', default=True,  help='True saves every image_chip, False only saves chips containing an annotated pixel')
   # parser.add_argument('--verbose',  required=False, type=str2bool, action='store', default=False, help='Suppress print output for chips/textfiles (1 = print, 0 = suppress output)')
   parser.add_argument('--tags',     required=False, type=str2bool, action='store', default=True,  help='Label images with key tags for sorting (1 = tags, 0 = no tags)')
+  parser.add_argument('--nshards',  required=False, type=int,      action='store', default=1,     help='Number of column bands in which the slide is split')
+  parser.add_argument('--shard',    required=False, type=int,      action='store', default=0,     help='Index of the column band to process (0 <= shard < nshards)')
+  parser.add_argument('--threads',  required=False, type=int,      action='store', default=1,     help='Number of threads used to crop and save the chips')
+  parser.add_argument('--merge',    required=False, type=str2bool, action='store', default=False, help='Merge the Details text files of the nshards shards (after all of them are done) into the Details text file of the slide, without processing the slide')
+  parser.add_argument('--cache',    required=False, type=str,      action='store', default=None,  help='Directory of the parsed contour cache (default .contours inside the output directory)')
+  parser.add_argument('--context',  required=False, type=int,      action='store', default=None,  nargs='+', help='Context scales of the multi-scale chips (e.g. 1 2 4), saved in the image_chips_x{scale} directories')
+  parser.add_argument('--stats',    required=False, type=str2bool, action='store', default=False, help='Accumulate the mean/std, color histograms and class pixel counts of the saved chips')
+  parser.add_argument('--metrics',  required=False, type=str,      action='store', default=None,  help='Write the per-stage timers, chips/sec, bytes written and peak memory in this json (or csv) file')
+  parser.add_argument('--profile',  required=False, type=str2bool, action='store', default=False, help='Profile the run with cProfile (stats written in {slide}.prof inside the output directory)')
+  parser.add_argument('--plan',     required=False, type=str2bool, action='store', default=False, help='Save the chip plan (level, col, row, labels) in {slide}_plan.npy inside the output directory')
+  parser.add_argument('--sampling', required=False, type=str,      action='store', default=None,  choices=['stratified', 'reservoir'], help='Sample the chips to extract before reading the slide (default all the annotated chips)')
+  parser.add_argument('--ratios',   required=False, type=str,      action='store', default=None,  nargs='+', help='Target class ratios of the sampling (e.g. MELANOMA-MALIGNO=0.5 NEVO-BENIGNO=0.3 NONE=0.2)')
+  parser.add_argument('--max_chips', required=False, type=int,     action='store', default=None,  help='Maximum number of sampled chips of the slide (split among the shards)')
+  parser.add_argument('--seed',     required=False, type=int,      action='store', default=None,  help='Random seed of the sampling')
+  parser.add_argument('--sweep',    required=False, type=str,      action='store', default=None,  nargs='+', help='Chip configurations size:overlap (e.g. 64:1 128:1 256:16) extracted from a single read of the slide, each one in its own size{size}_overlap{overlap} directory (size and overlap are ignored)')
+  parser.add_argument('--simplify', required=False, type=float,    action='store', default=None,  help='Simplify the contours (Douglas-Peucker) keeping them within this distance in pixels (e.g. 0.5) before the rasterization')
+  parser.add_argument('--rle',      required=False, type=str2bool, action='store', default=False, help='Keep the annotation mask run-length encoded instead of a dense RGB array of the slide')
+  parser.add_argument('--max_memory', '--max-memory', required=False, type=str, action='store', default=None, help='Memory budget (e.g. 2G, 512M) for processing the slide in horizontal bands (default: whole slide at once)')
 
   args = parser.parse_args()
 
@@ -43,6 +64,9 @@ def parse_args ():
 
   save_ratio = 'inf' if args.save_all is False else '0'
 
+  # the annotation directory can be read-only (or shared): the default cache is in the output directory
+  cache_dir = args.cache if args.cache is not None else os.path.join(out_dir, '.contours')
+
   params = {
               'slide_path' : args.image,
               'xml_path'   : args.ann,
@@ -56,6 +80,24 @@ def parse_args ():
               'save_ratio' : save_ratio,
   #             'print'      : args.verbose,
               'tags'       : args.tags,
+              'nshards'    : args.nshards,
+              'shard'      : args.shard,
+              'merge'      : args.merge,
+              'threads'    : args.threads,
+              'max_memory' : args.max_memory,
+              'rle'        : args.rle,
+              'simplify'   : args.simplify,
+              'sweep'      : args.sweep,
+              'cache'      : cache_dir,
+              'context'    : args.context,
+              'statistics' : args.stats,
+              'metrics'    : args.metrics,
+              'profile'    : args.profile,
+              'plan'       : args.plan,
+              'sampling'   : args.sampling,
+              'ratios'     : args.ratios,
+              'max_chips'  : args.max_chips,
+              'seed'       : args.seed,
             }
 
   return params
@@ -69,6 +111,18 @@ def main ():
   '''
 
   params = parse_args()
+  filename = os.path.basename(params['slide_path'])
+
+  if params['merge']:
+    # the Details text files of the shards (of each sweep configuration)
+    if params['sweep'] is not None:
+      dests = [os.path.join(sweepdir(params['output_dir'], size, overlap), 'textfiles') for size, overlap in parsesweep(params['sweep'])]
+    else:
+      dests = ['output/textfiles/']
+
+    for dest in dests:
+      print('Merged {0} shards into {1}'.format(params['nshards'], mergedetails(filename, params['nshards'], dest)))
+    return
 
   print('running SlideSeg with parameters:')
   print('  SVS filename         : {}'.format(params['slide_path']))
@@ -76,12 +130,24 @@ def main ():
   print('  Output Directory     : {}'.format(params['output_dir']))
   print('  Output image fmt     : {}'.format(params['format']))
   print('  Output image quality : {}'.format(params['quality']))
-  print('  Output image size    : {}'.format(params['size']))
-  print('  Output image overlap : {}'.format(params['overlap']))
+  if params['sweep'] is not None:
+    print('  Sweep configurations : {}'.format(' '.join(params['sweep'])))
+  else:
+    print('  Output image size    : {}'.format(params['size']))
+    print('  Output image overlap : {}'.format(params['overlap']))
   print('  Annotation Legend    : {}'.format(params['key']))
+  print('  Contour cache        : {}'.format(params['cache']))
   print('  Save all files       : {}'.format(params['save_all']))
+  print('  Shard                : {}/{}'.format(params['shard'], params['nshards']))
+  print('  Number of threads    : {}'.format(params['threads']))
+  print('  Context scales       : {}'.format(' '.join(map(str, params['context'])) if params['context'] is not None else 'none'))
+  print('  Chip statistics      : {}'.format(params['statistics']))
+  print('  Metrics file         : {}'.format(params['metrics'] if params['metrics'] is not None else 'none'))
+  print('  Profiling            : {}'.format(params['profile']))
+  print('  Memory budget        : {}'.format(params['max_memory'] if params['max_memory'] is not None else 'unbounded'))
+  print('  Run-length mask      : {}'.format(params['rle']))
+  print('  Contour accuracy     : {}'.format(params['simplify'] if params['simplify'] is not None else 'every vertex'))
 
-  filename = os.path.basename(params['slide_path'])
   os.makedirs(params['output_dir'], exist_ok=True)
   SlideSeg.run(params, filename)
 
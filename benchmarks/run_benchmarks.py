@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import numpy as np
+from glob import glob
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from contextlib import redirect_stderr
+
+from synthetic import makedataset
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import SlideSeg
+from SlideSeg.functions.slideseg import formatcheck
+from SlideSeg.functions.slideseg import getchips
+from SlideSeg.functions.slideseg import loadcontours
+from SlideSeg.functions.slideseg import rasterband
+from SlideSeg.functions.slideseg import rastermask
+from SlideSeg.functions.slideseg import rasterlabels
+from SlideSeg.functions.contours import parsecontours
+from SlideSeg.functions.contours import readcontours
+from SlideSeg.functions.contours import simplifytolerance
+from SlideSeg.functions.knn import NeighborIndex
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# name : (kind, function) of the registered benchmarks (in execution order)
+BENCHMARKS = OrderedDict()
+
+
+def parse_args ():
+
+  description = 'SlideSeg benchmarks on synthetic slides'
+
+  parser = argparse.ArgumentParser(description=description)
+
+  parser.add_argument('--workdir',   required=False, type=str,   action='store', default='bench_data',  help='Directory of the synthetic data and of the outputs')
+  parser.add_argument('--width',     required=False, type=int,   action='store', default=8192,          help='Width of the synthetic slide')
+  parser.add_argument('--height',    required=False, type=int,   action='store', default=8192,          help='Height of the synthetic slide')
+  parser.add_argument('--contours',  required=False, type=int,   action='store', default=32,            help='Number of annotated contours')
+  parser.add_argument('--vertices',  required=False, type=int,   action='store', default=512,           help='Number of vertices of each contour')
+  parser.add_argument('--size',      required=False, type=int,   action='store', default=128,           help='Size of the chips')
+  parser.add_argument('--overlap',   required=False, type=int,   action='store', default=1,             help='Overlap between chips')
+  parser.add_argument('--threads',   required=False, type=int,   action='store', default=1,             help='Number of threads of the patching benchmark')
+  parser.add_argument('--max_chips', required=False, type=int,   action='store', default=2000,          help='Maximum number of chips used by the refinement, counting and eigenslices benchmarks')
+  parser.add_argument('--points',    required=False, type=int,   action='store', default=1000000,       help='Number of points of the nearest-neighbour index benchmark')
+  parser.add_argument('--repeat',    required=False, type=int,   action='store', default=3,             help='Number of repetitions of each benchmark')
+  parser.add_argument('--only',      required=False, type=str,   action='store', default=None, nargs='+', help='Run only these benchmarks (possible values: {})'.format(', '.join(BENCHMARKS)))
+  parser.add_argument('--output',    required=False, type=str,   action='store', default='bench_results.json', help='Output json file of the results')
+  parser.add_argument('--baseline',  required=False, type=str,   action='store', default=None,          help='Baseline json file (a previous output) to compare with')
+  parser.add_argument('--tolerance', required=False, type=float, action='store', default=.2,            help='Relative slowdown with respect to the baseline reported as regression')
+  parser.add_argument('--seed',      required=False, type=int,   action='store', default=42,            help='Random seed of the synthetic data')
+  parser.add_argument('--verbose',   required=False, action='store_true', default=False,               help='Show the output (and the progress bars) of the benchmarked functions')
+
+  args = parser.parse_args()
+
+  return args
+
+
+def benchmark (name, kind):
+  '''
+  Registers a benchmark function: it takes the benchmark context and
+  returns the number of processed items (vertices, pixels, chips...)
+  '''
+  def register (func):
+    BENCHMARKS[name] = (kind, func)
+    return func
+
+  return register
+
+
+class Context (object):
+
+  def __init__ (self, args):
+    '''
+    Synthetic data and intermediate results shared among the benchmarks
+    '''
+    self.args = args
+    self.workdir = os.path.abspath(args.workdir)
+    self.cache_dir = os.path.join(self.workdir, 'contours')
+    self.output_dir = os.path.join(self.workdir, 'output')
+    self.key = os.path.join(self.workdir, 'keys.txt')
+
+    name = 'bench_{0}x{1}_{2}x{3}_{4}'.format(args.width, args.height, args.contours, args.vertices, args.seed)
+    self.slide = os.path.join(self.workdir, 'slices', '{0}.svs'.format(name))
+    self.roi = os.path.join(self.workdir, 'labels', '{0}.roi'.format(name))
+
+    if not (os.path.isfile(self.slide) and os.path.isfile(self.roi)):
+      print('generating the synthetic slide {0}...'.format(name), end='', flush=True)
+      makedataset(self.workdir, name, args.width, args.height, args.contours, args.vertices, args.seed)
+      print('[done]')
+
+    self._contours = None
+    self._mask = None
+    self._raster = None
+    self.mask_dir = None
+
+  @property
+  def contours (self):
+    if self._contours is None:
+      self._contours = loadcontours(self.key, self.roi)
+    return self._contours
+
+  @property
+  def mask (self):
+    if self._mask is None:
+      self._mask = rastermask(self.contours[0], (self.args.width, self.args.height))
+    return self._mask
+
+  @property
+  def raster (self):
+    if self._raster is None:
+      self._raster = rasterlabels(self.contours[0], (self.args.width, self.args.height))
+    return self._raster
+
+  @property
+  def parameters (self):
+    return {
+             'slide_path' : self.slide,
+             'xml_path'   : os.path.dirname(self.roi) + os.sep,
+             'output_dir' : self.output_dir,
+             'format'     : 'png',
+             'quality'    : 95,
+             'size'       : self.args.size,
+             'overlap'    : self.args.overlap,
+             'key'        : self.key,
+             'save_all'   : True,
+             'save_ratio' : '0',
+             'threads'    : self.args.threads,
+             'cache'      : self.cache_dir,
+           }
+
+  def chips (self):
+    '''
+    Makes sure that the chips of the patching benchmark exist
+    '''
+    if not os.path.isdir(os.path.join(self.output_dir, 'image_chips')):
+      SlideSeg.run(self.parameters, os.path.basename(self.slide))
+
+  def masks (self):
+    '''
+    Copies (at most max_chips) chip masks of the patching benchmark into the
+    directory processed by the refinement and counting benchmarks (again
+    before each repetition, see runbenchmark)
+    '''
+    self.chips()
+    mask_dir = os.path.join(self.output_dir, 'image_mask')
+
+    bench_dir = os.path.join(self.workdir, 'bench_mask')
+    shutil.rmtree(bench_dir, ignore_errors=True)
+    os.makedirs(bench_dir)
+
+    for filename in sorted(glob(os.path.join(mask_dir, '*.png')))[: self.args.max_chips]:
+      shutil.copy(filename, bench_dir)
+
+    self.mask_dir = bench_dir
+
+  def index (self):
+    '''
+    Makes sure that the nearest-neighbour index of the knn benchmark exists
+    (points random coordinates with the dimensions of the eigenslices)
+    '''
+    index_dir = os.path.join(self.workdir, 'knn_{0}_{1}'.format(self.args.points, self.args.seed))
+
+    if not os.path.isfile(os.path.join(index_dir, 'index.json')):
+      rng = np.random.default_rng(self.args.seed)
+      coords = rng.normal(size=(self.args.points, 16)).astype(np.float32)
+      NeighborIndex.build(index_dir, ['patch_{:d}.png'.format(i) for i in range(self.args.points)], coords)
+
+    return NeighborIndex(index_dir)
+
+
+@benchmark('parse', 'micro')
+def bench_parse (ctx):
+  contours = parsecontours(ctx.roi)
+  return len(contours['points'])
+
+
+@benchmark('parse_cached', 'micro')
+def bench_parse_cached (ctx):
+  # the first call (not measured) writes the cache
+  contours = readcontours(ctx.roi, cache_dir=ctx.cache_dir)
+  return len(contours['points'])
+
+
+@benchmark('makemask', 'micro')
+def bench_makemask (ctx):
+  mask = rastermask(ctx.contours[0], (ctx.args.width, ctx.args.height))
+  return mask.shape[0] * mask.shape[1]
+
+
+@benchmark('makemask_banded', 'micro')
+def bench_makemask_banded (ctx):
+  size = (ctx.args.width, ctx.args.height)
+  pixels = 0
+
+  for upper in range(0, ctx.args.height, 1024):
+    band = rasterband(ctx.contours[0], size, upper, min(upper + 1024, ctx.args.height))
+    pixels += band.shape[0] * band.shape[1]
+
+  return pixels
+
+
+@benchmark('makemask_simplified', 'micro')
+def bench_makemask_simplified (ctx):
+  # the simplified contours (half pixel accuracy) are cached by the first call (not measured)
+  contours, _ = loadcontours(ctx.key, ctx.roi, ctx.cache_dir, simplifytolerance(1., .5))
+  mask = rastermask(contours, (ctx.args.width, ctx.args.height))
+  return mask.shape[0] * mask.shape[1]
+
+
+@benchmark('makemask_rle', 'micro')
+def bench_makemask_rle (ctx):
+  raster = rasterlabels(ctx.contours[0], (ctx.args.width, ctx.args.height))
+  return raster.shape[0] * raster.shape[1]
+
+
+@benchmark('getchips', 'micro')
+def bench_getchips (ctx):
+  _, suffix = formatcheck('png')
+  plan = getchips(1, [(ctx.args.width, ctx.args.height)], ctx.args.size, ctx.args.overlap, ctx.mask,
+                  ctx.contours[1], os.path.basename(ctx.slide), suffix, True, 0.)
+  return len(plan)
+
+
+@benchmark('getchips_rle', 'micro')
+def bench_getchips_rle (ctx):
+  _, suffix = formatcheck('png')
+  plan = getchips(1, [(ctx.args.width, ctx.args.height)], ctx.args.size, ctx.args.overlap, ctx.raster,
+                  ctx.contours[1], os.path.basename(ctx.slide), suffix, True, 0.)
+  return len(plan)
+
+
+@benchmark('patching', 'macro')
+def bench_patching (ctx):
+  shutil.rmtree(ctx.output_dir, ignore_errors=True)
+  SlideSeg.run(ctx.parameters, os.path.basename(ctx.slide))
+  return len(os.listdir(os.path.join(ctx.output_dir, 'image_chips')))
+
+
+@benchmark('sweep', 'macro')
+def bench_sweep (ctx):
+  # the chip size of the patching benchmark, its double and its half, from a single read of the slide
+  configs = [(ctx.args.size, ctx.args.overlap), (2 * ctx.args.size, ctx.args.overlap), (ctx.args.size // 2, ctx.args.overlap)]
+  output_dir = os.path.join(ctx.workdir, 'sweep')
+  shutil.rmtree(output_dir, ignore_errors=True)
+  SlideSeg.run(dict(ctx.parameters, output_dir=output_dir, sweep=configs), os.path.basename(ctx.slide))
+  return sum(len(os.listdir(os.path.join(output_dir, 'size{0}_overlap{1}'.format(*config), 'image_chips'))) for config in configs)
+
+
+@benchmark('refinement', 'macro')
+def bench_refinement (ctx):
+  mask_dir = ctx.mask_dir
+  subprocess.check_call([sys.executable, os.path.join(os.path.dirname(here), 'SlideSeg', 'refine_mask.py'), '--mask_folder', mask_dir],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return len(os.listdir(mask_dir))
+
+
+@benchmark('counting', 'macro')
+def bench_counting (ctx):
+  mask_dir = ctx.mask_dir
+  outfile = os.path.join(ctx.workdir, 'bench_counter.csv')
+  subprocess.check_call([sys.executable, os.path.join(os.path.dirname(here), 'SlideSeg', 'counting_mask.py'), '--mask_folder', mask_dir, '--outfile', outfile],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return len(os.listdir(mask_dir))
+
+
+@benchmark('eigenslices', 'macro')
+def bench_eigenslices (ctx):
+  import cv2
+  from numpy.fft import fft2 as fft
+  from sklearn.pipeline import make_pipeline
+  from sklearn.decomposition import PCA
+  from sklearn.preprocessing import StandardScaler
+
+  files = sorted(glob(os.path.join(ctx.output_dir, 'image_chips', '*.png')))[: ctx.args.max_chips]
+  images = np.asarray([cv2.imread(f) for f in files])
+
+  # same transformation of the eigenslices rule (single split)
+  X = abs(fft(images.reshape(len(images), -1)))
+  make_pipeline(StandardScaler(), PCA(n_components=3)).fit_transform(X)
+
+  return len(images)
+
+
+@benchmark('knn_query', 'micro')
+def bench_knn_query (ctx):
+  index = ctx.index()
+  # the same queries at each repetition (the first ones of the index)
+  names = index.name(range(64))
+  index.similar(names, k=10)
+  return len(names)
+
+
+def runbenchmark (ctx, name, repeat, verbose=False):
+  '''
+  Runs a benchmark and collects its timings
+
+  Parameters
+  ----------
+    ctx : Context
+      Benchmark context
+
+    name : str
+      Benchmark name
+
+    repeat : int
+      Number of repetitions
+
+    verbose : bool
+      Show the output (and the progress bars) of the benchmarked function
+
+  Returns
+  -------
+    result : dict
+      Kind, timings (seconds), best/median time, processed items and throughput
+  '''
+  kind, func = BENCHMARKS[name]
+  times = []
+
+  # (the progress bars write on stderr while the functions are timed)
+  with open(os.devnull, 'w') as devnull, redirect_stdout(sys.stdout if verbose else devnull), redirect_stderr(sys.stderr if verbose else devnull):
+    # setup (not measured)
+    if name == 'parse_cached':
+      func(ctx)
+    elif name == 'eigenslices':
+      ctx.chips()
+    elif name == 'knn_query':
+      ctx.index()
+
+    for _ in range(repeat):
+      # refine_mask rewrites the masks in place: each repetition starts from a fresh copy (not measured)
+      if name in ('refinement', 'counting'):
+        ctx.masks()
+
+      tic = time.perf_counter()
+      items = func(ctx)
+      times.append(time.perf_counter() - tic)
+
+  best = min(times)
+
+  return {
+           'kind'          : kind,
+           'times'         : times,
+           'min'           : best,
+           'median'        : float(np.median(times)),
+           'items'         : items,
+           'items_per_sec' : items / best if best > 0 else None,
+         }
+
+
+def compare (results, baseline, tolerance):
+  '''
+  Compares the best timings with a baseline
+
+  Parameters
+  ----------
+    results : dict
+      Benchmark results (as written in the output file)
+
+    baseline : dict
+      Baseline results
+
+    tolerance : float
+      Relative slowdown reported as regression
+
+  Returns
+  -------
+    regressions : list
+      Names of the benchmarks slower than the baseline
+  '''
+  regressions = []
+
+  if baseline['config'] != results['config']:
+    print('Warning: the baseline was measured with a different configuration:')
+    print('  baseline : {}'.format(baseline['config']))
+    print('  current  : {}'.format(results['config']))
+
+  print('{0:<16} {1:>12} {2:>12} {3:>8}  {4}'.format('benchmark', 'baseline (s)', 'current (s)', 'ratio', 'status'))
+
+  for name, result in results['benchmarks'].items():
+
+    if name not in baseline['benchmarks']:
+      print('{0:<16} {1:>12} {2:>12.4f} {3:>8}  new'.format(name, '-', result['min'], '-'))
+      continue
+
+    reference = baseline['benchmarks'][name]['min']
+    ratio = result['min'] / reference if reference > 0 else float('inf')
+
+    if ratio > 1. + tolerance:
+      status = 'REGRESSION'
+      regressions.append(name)
+    elif ratio < 1. - tolerance:
+      status = 'faster'
+    else:
+      status = 'ok'
+
+    print('{0:<16} {1:>12.4f} {2:>12.4f} {3:>8.3f}  {4}'.format(name, reference, result['min'], ratio, status))
+
+  return regressions
+
+
+def main ():
+
+  args = parse_args()
+
+  names = list(BENCHMARKS) if args.only is None else args.only
+
+  for name in names:
+    if name not in BENCHMARKS:
+      raise ValueError('Invalid benchmark {0}! Possible values are {1}'.format(name, ', '.join(BENCHMARKS)))
+
+  os.makedirs(args.workdir, exist_ok=True)
+  output = os.path.abspath(args.output)
+  baseline = os.path.abspath(args.baseline) if args.baseline is not None else None
+
+  ctx = Context(args)
+
+  # the key and Details text files are written in the working directory
+  os.chdir(ctx.workdir)
+
+  results = {
+              'environment' : {
+                                'python'   : platform.python_version(),
+                                'numpy'    : np.__version__,
+                                'platform' : platform.platform(),
+                                'cpus'     : os.cpu_count(),
+                              },
+              'config'      : {key : getattr(args, key) for key in ('width', 'height', 'contours', 'vertices', 'size', 'overlap', 'threads', 'max_chips', 'seed')},
+              'benchmarks'  : OrderedDict(),
+            }
+
+  for name in names:
+    print('running {0} ({1})...'.format(name, BENCHMARKS[name][0]), end='', flush=True)
+    result = runbenchmark(ctx, name, args.repeat, args.verbose)
+    results['benchmarks'][name] = result
+    print('[done] best {0:.4f} s, {1:.1f} items/s'.format(result['min'], result['items_per_sec'] or 0.))
+
+  with open(output, 'w', encoding='utf-8') as fp:
+    json.dump(results, fp, indent=2)
+
+  print('results saved in {0}'.format(output))
+
+  if baseline is not None:
+    with open(baseline, 'r', encoding='utf-8') as fp:
+      regressions = compare(results, json.load(fp), args.tolerance)
+
+    if regressions:
+      print('Found {0} regressions: {1}'.format(len(regressions), ', '.join(regressions)))
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+
+  main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+
+from synthetic import makedataset
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+from SlideSeg.functions.contours import itercontours
+from SlideSeg.functions.contours import parsecontours
+from SlideSeg.functions.contours import simplifycontours
+from SlideSeg.functions.contours import simplifytolerance
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# fractional bits of the contour points rasterized at the downsampled levels
+SHIFT = 8
+
+
+def parse_args ():
+
+  description = 'Vertex reduction and rasterization time of the simplified contours'
+
+  parser = argparse.ArgumentParser(description=description)
+
+  parser.add_argument('--roi',        required=False, type=str,   action='store', default=None,  help='Annotation (xml/roi) file (default a synthetic one)')
+  parser.add_argument('--width',      required=False, type=int,   action='store', default=8192,  help='Width of the slide')
+  parser.add_argument('--height',     required=False, type=int,   action='store', default=8192,  help='Height of the slide')
+  parser.add_argument('--contours',   required=False, type=int,   action='store', default=32,    help='Number of synthetic contours')
+  parser.add_argument('--vertices',   required=False, type=int,   action='store', default=2048,  help='Number of vertices of each synthetic contour')
+  parser.add_argument('--workdir',    required=False, type=str,   action='store', default='bench_data', help='Directory of the synthetic data')
+  parser.add_argument('--downsample', required=False, type=int,   action='store', default=[1, 4, 16], nargs='+', help='Downsample factors of the rasterized levels')
+  parser.add_argument('--accuracy',   required=False, type=float, action='store', default=[.25, .5, .9], nargs='+', help='Accuracies (pixels of the rasterized level) of the simplification')
+  parser.add_argument('--repeat',     required=False, type=int,   action='store', default=5,     help='Number of repetitions of each rasterization')
+  parser.add_argument('--seed',       required=False, type=int,   action='store', default=42,    help='Random seed of the synthetic data')
+
+  args = parser.parse_args()
+
+  return args
+
+
+def rasterize (contours, size, downsample):
+  '''
+  Rasterizes the contours at a downsampled level (sub-pixel vertices)
+  '''
+  width, height = size
+  mat = np.zeros(shape=(height // downsample, width // downsample), dtype='uint8')
+  scale = (1 << SHIFT) / downsample
+
+  for _, _, cnt in itercontours(contours):
+    cv2.fillPoly(mat, [np.round(cnt * scale).astype(np.int32)], 255, shift=SHIFT)
+
+  return mat
+
+
+def besttime (func, repeat):
+  '''
+  Returns the result and the best time of repeated calls
+  '''
+  times = []
+  for _ in range(repeat):
+    tic = time.perf_counter()
+    result = func()
+    times.append(time.perf_counter() - tic)
+
+  return (result, min(times))
+
+
+def main ():
+
+  args = parse_args()
+
+  roi = args.roi
+  if roi is None:
+    name = 'simplify_{0}x{1}_{2}x{3}_{4}'.format(args.width, args.height, args.contours, args.vertices, args.seed)
+    roi = os.path.join(args.workdir, 'labels', '{0}.roi'.format(name))
+
+    if not os.path.isfile(roi):
+      print('generating the synthetic annotations {0}...'.format(name), end='', flush=True)
+      makedataset(args.workdir, name, args.width, args.height, args.contours, args.vertices, args.seed)
+      print('[done]')
+
+  size = (args.width, args.height)
+  contours = parsecontours(roi)
+  vertices = len(contours['points'])
+
+  print('{0:>10} {1:>8} {2:>9} {3:>9} {4:>9} {5:>10} {6:>8} {7:>10}'.format('downsample', 'accuracy', 'tolerance', 'vertices', 'reduction', 'raster (s)', 'speedup', 'changed'))
+
+  for downsample in args.downsample:
+    reference, reference_time = besttime(lambda : rasterize(contours, size, downsample), args.repeat)
+    annotated = max(np.count_nonzero(reference), 1)
+
+    print('{0:>10d} {1:>8} {2:>9} {3:>9d} {4:>9} {5:>10.4f} {6:>8} {7:>10}'.format(downsample, '-', '-', vertices, '-', reference_time, '-', '-'))
+
+    for accuracy in args.accuracy:
+      tolerance = simplifytolerance(downsample, accuracy)
+      simplified = simplifycontours(contours, tolerance)
+
+      mask, raster_time = besttime(lambda : rasterize(simplified, size, downsample), args.repeat)
+      # pixels of the contour borders which change label (fraction of the annotated pixels)
+      changed = np.count_nonzero(mask != reference) / annotated
+
+      print('{0:>10d} {1:>8.2f} {2:>9.2f} {3:>9d} {4:>8.1f}x {5:>10.4f} {6:>7.1f}x {7:>9.3%}'.format(
+            downsample, accuracy, tolerance, len(simplified['points']), vertices / max(len(simplified['points']), 1),
+            raster_time, reference_time / max(raster_time, 1e-9), changed))
+
+
+if __name__ == '__main__':
+
+  main()
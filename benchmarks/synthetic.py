@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import argparse
+import numpy as np
+from PIL import Image
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+# (name, color) of the synthetic annotations (the colors of refine_mask.py and counting_mask.py)
+LABELS = [('melanoma-maligno', '#0000ff'),
+          ('nevo-benigno', '#00ff00'),
+          ('extra-tissue', '#ff0000'),
+         ]
+
+
+def parse_args ():
+
+  description = 'Synthetic slide and annotation generator'
+
+  parser = argparse.ArgumentParser(description=description)
+
+  parser.add_argument('--out',      required=True,  type=str, action='store',                 help='Output directory (slices and labels are created inside)')
+  parser.add_argument('--name',     required=False, type=str, action='store', default='1',    help='Name of the slide')
+  parser.add_argument('--width',    required=False, type=int, action='store', default=8192,   help='Width of the slide')
+  parser.add_argument('--height',   required=False, type=int, action='store', default=8192,   help='Height of the slide')
+  parser.add_argument('--contours', required=False, type=int, action='store', default=32,     help='Number of annotated contours')
+  parser.add_argument('--vertices', required=False, type=int, action='store', default=512,    help='Number of vertices of each contour')
+  parser.add_argument('--seed',     required=False, type=int, action='store', default=42,     help='Random seed')
+  parser.add_argument('--ext',      required=False, type=str, action='store', default='svs',  help='Extension of the slide file (a tiff image)')
+
+  args = parser.parse_args()
+
+  return args
+
+
+def makeslide (filename, width, height, seed=42, band=1024, scale=64):
+  '''
+  Generates a synthetic H&E-like slide
+
+  Parameters
+  ----------
+    filename : str
+      Output filename (saved as tiff, whatever the extension)
+
+    width : int
+      Width of the slide
+
+    height : int
+      Height of the slide
+
+    seed : int
+      Random seed
+
+    band : int
+      Number of rows generated at once
+
+    scale : int
+      Size (in pixels) of the tissue blobs
+
+  Returns
+  -------
+    filename : str
+      The output filename
+
+  Notes
+  -----
+  The tissue is a smooth random field (interpolated from a low resolution
+  noise) thresholded into pink/purple blobs on a white background, plus
+  pixel noise, so the slide compresses and decodes like a real one.
+  The image is generated in bands of rows into a memory-mapped buffer.
+  '''
+  rng = np.random.RandomState(seed)
+  field = rng.rand(height // scale + 2, width // scale + 2).astype(np.float32)
+
+  buffer = os.path.join(os.path.dirname(os.path.abspath(filename)), '.{0}.raw'.format(os.path.basename(filename)))
+  image = np.memmap(buffer, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+
+  background = np.asarray([240, 238, 242], dtype=np.float32)
+  eosin = np.asarray([230, 150, 190], dtype=np.float32)
+  hematoxylin = np.asarray([110, 60, 150], dtype=np.float32)
+
+  # bilinear interpolation weights of the columns
+  x = (np.arange(width, dtype=np.float32) + .5) / scale
+  ix = x.astype(np.int64)
+  wx = x - ix
+
+  for start in range(0, height, band):
+    rows = np.arange(start, min(start + band, height))
+    y = (rows.astype(np.float32) + .5) / scale
+    iy = y.astype(np.int64)
+    wy = (y - iy)[:, None]
+
+    # smooth field of the band (the same for any band size)
+    top = field[iy][:, ix] * (1. - wx) + field[iy][:, ix + 1] * wx
+    bottom = field[iy + 1][:, ix] * (1. - wx) + field[iy + 1][:, ix + 1] * wx
+    tissue = top * (1. - wy) + bottom * wy
+
+    nuclei = rng.rand(len(rows), width).astype(np.float32)
+
+    color = np.where((nuclei > .97)[..., None], hematoxylin, eosin)
+    color = np.where((tissue > .5)[..., None], color, background)
+    color += rng.normal(0., 8., size=color.shape).astype(np.float32)
+
+    image[start : start + len(rows)] = np.clip(color, 0, 255).astype(np.uint8)
+
+  image.flush()
+  Image.fromarray(np.asarray(image)).save(filename, format='TIFF')
+
+  del image
+  os.remove(buffer)
+
+  return filename
+
+
+def makecontour (rng, width, height, nvertices):
+  '''
+  Generates a random star-shaped contour inside the slide
+  '''
+  radius = rng.uniform(.02, .08) * min(width, height)
+  cx = rng.uniform(radius, width - radius)
+  cy = rng.uniform(radius, height - radius)
+
+  theta = np.linspace(0, 2 * np.pi, nvertices, endpoint=False)
+  lobes, phase = rng.randint(2, 7), rng.uniform(0, 2 * np.pi)
+  rho = radius * (1. + .3 * np.sin(lobes * theta + phase) + .05 * rng.randn(nvertices))
+
+  return np.stack((cx + rho * np.cos(theta), cy + rho * np.sin(theta)), axis=1)
+
+
+def makeroi (filename, width, height, ncontours=32, nvertices=512, seed=42):
+  '''
+  Generates the Seeden Viewer annotations of a synthetic slide
+
+  Parameters
+  ----------
+    filename : str
+      Output .roi (xml) filename
+
+    width : int
+      Width of the slide
+
+    height : int
+      Height of the slide
+
+    ncontours : int
+      Number of contours
+
+    nvertices : int
+      Number of vertices of each contour (the vertex density)
+
+    seed : int
+      Random seed
+
+  Returns
+  -------
+    filename : str
+      The output filename
+  '''
+  rng = np.random.RandomState(seed)
+
+  with open(filename, 'w', encoding='utf-8') as out:
+    out.write('<annotations>\n')
+
+    for i in range(ncontours):
+      name, color = LABELS[i % len(LABELS)]
+      out.write('<contour name="{0}" color="{1}">\n'.format(name, color))
+
+      for x, y in makecontour(rng, width, height, nvertices):
+        out.write('<point>{0:.2f}, {1:.2f}</point>\n'.format(x, y))
+
+      out.write('</contour>\n')
+
+    out.write('</annotations>\n')
+
+  return filename
+
+
+def makedataset (directory, name='1', width=8192, height=8192, ncontours=32, nvertices=512, seed=42, ext='svs'):
+  '''
+  Generates a synthetic slide and its annotations in the pipeline layout
+
+  Parameters
+  ----------
+    directory : str
+      Output directory
+
+    name : str
+      Name of the slide
+
+    width : int
+      Width of the slide
+
+    height : int
+      Height of the slide
+
+    ncontours : int
+      Number of contours
+
+    nvertices : int
+      Number of vertices of each contour
+
+    seed : int
+      Random seed
+
+    ext : str
+      Extension of the slide file
+
+  Returns
+  -------
+    (slide, roi) : tuple
+      Filenames of the slide (directory/slices/{name}.{ext}) and of the
+      annotations (directory/labels/{name}.roi)
+  '''
+  slide = os.path.join(directory, 'slices', '{0}.{1}'.format(name, ext))
+  roi = os.path.join(directory, 'labels', '{0}.roi'.format(name))
+
+  os.makedirs(os.path.dirname(slide), exist_ok=True)
+  os.makedirs(os.path.dirname(roi), exist_ok=True)
+
+  makeslide(slide, width, height, seed=seed)
+  makeroi(roi, width, height, ncontours=ncontours, nvertices=nvertices, seed=seed)
+
+  return (slide, roi)
+
+
+def main ():
+
+  args = parse_args()
+
+  print('generating a {0}x{1} slide with {2} contours of {3} vertices...'.format(args.width, args.height, args.contours, args.vertices), end='', flush=True)
+  slide, roi = makedataset(args.out, args.name, args.width, args.height, args.contours, args.vertices, args.seed, args.ext)
+  print('[done]')
+  print('  slide : {}'.format(slide))
+  print('  roi   : {}'.format(roi))
+
+
+if __name__ == '__main__':
+
+  main()
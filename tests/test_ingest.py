@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+
+from SlideSeg.ingest import Watcher
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def test_changed_file_with_old_mtime (tmp_path):
+  '''
+  A file which changes keeps waiting for the settle time, even if its copy kept an old mtime
+  '''
+  slide, annotation = str(tmp_path / '1.svs'), str(tmp_path / '1.roi')
+  old = 1e9
+
+  for filename in (slide, annotation):
+    with open(filename, 'wb') as fp:
+      fp.write(b'0' * 16)
+    os.utime(filename, (old, old))
+
+  watcher = Watcher(str(tmp_path), 'svs', str(tmp_path), 'roi', settle=60.)
+  now = old + 3600.
+
+  # files older than the settle time are stable at the first scan
+  stable, waiting, unpaired = watcher.scan(now)
+  assert set(stable) == {'1'} and not waiting and not unpaired
+
+  # the copy goes on, but the mtime of the source is preserved
+  with open(slide, 'ab') as fp:
+    fp.write(b'0' * 16)
+  os.utime(slide, (old, old))
+
+  stable, waiting, unpaired = watcher.scan(now + 1.)
+  assert not stable and waiting == {'1'}
+
+  stable, waiting, unpaired = watcher.scan(now + 30.)
+  assert not stable and waiting == {'1'}
+
+  stable, waiting, unpaired = watcher.scan(now + 61.)
+  assert set(stable) == {'1'} and stable['1'][1] == now + 1.
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import time
+import socket
+from multiprocessing import Pool
+
+import pytest
+
+from SlideSeg.functions.slideseg import lockfile
+from SlideSeg.functions.slideseg import unlockfile
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def increment (filename):
+  '''
+  Read-modify-write of a counter, only correct under the lock
+  '''
+  lock = lockfile(filename, timeout=60., delay=.001, stale=3600.)
+  try:
+    with open(filename, 'r') as fp:
+      value = int(fp.read())
+    time.sleep(.001)
+    with open(filename, 'w') as fp:
+      fp.write(str(value + 1))
+  finally:
+    unlockfile(lock)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='the owner of a lock is checked only on POSIX')
+def test_stale_lock_race (tmp_path):
+  '''
+  The processes racing on a stale lock (owner not running) acquire it one at a time
+  '''
+  filename = str(tmp_path / 'counter.txt')
+  with open(filename, 'w') as fp:
+    fp.write('0')
+
+  for _ in range(5):
+    # a PID above the default pid_max is never running
+    with open(filename + '.lock', 'w') as fp:
+      fp.write('{0} {1:d}'.format(socket.gethostname(), 2 ** 22 + 1))
+
+    with Pool(8) as pool:
+      pool.map(increment, [filename] * 64)
+
+  with open(filename, 'r') as fp:
+    assert int(fp.read()) == 5 * 64
+
+  assert not os.path.exists(filename + '.lock')
+  assert os.listdir(str(tmp_path)) == ['counter.txt']
+
+
+def test_unlock_missing (tmp_path):
+  '''
+  Releasing a lock already removed is not an error
+  '''
+  lock = lockfile(str(tmp_path / 'keys.txt'))
+  os.remove(lock)
+  unlockfile(lock)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+from PIL import Image
+
+from SlideSeg.functions.reader import PatchReader
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+
+def makeslide (filename, width, height, compression='raw', seed=42):
+  '''
+  Saves a random RGB slide and returns its pixels
+  '''
+  pixels = np.random.default_rng(seed).integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+  Image.fromarray(pixels).save(filename, format='TIFF', compression=compression)
+  return pixels
+
+
+def test_uncompressed_slide_budget (tmp_path):
+  '''
+  The tiles of an uncompressed slide are read from the file, within a budget smaller than the slide
+  '''
+  slide = str(tmp_path / 'slide.tif')
+  pixels = makeslide(slide, 1800, 1750)
+  padded = np.pad(pixels, ((0, 64), (0, 64), (0, 0)))
+
+  rng = np.random.default_rng(0)
+
+  with PatchReader(tile_size=128, max_bytes=1 << 20) as reader:
+    for x, y in zip(rng.integers(0, 1800, size=64), rng.integers(0, 1750, size=64)):
+      assert np.array_equal(reader.get_patch(slide, x, y, 64), padded[y : y + 64, x : x + 64])
+
+    stats = reader.stats()
+    assert stats['slide_bytes'] == 0
+    assert stats['bytes'] <= 1 << 20
+    assert stats['evictions'] > 0
+
+
+def test_compressed_slide_warning (tmp_path, capsys):
+  '''
+  A compressed slide larger than the budget is decoded whole, with a warning
+  '''
+  slide = str(tmp_path / 'slide.tif')
+  pixels = makeslide(slide, 600, 500, compression='tiff_lzw')
+
+  with PatchReader(tile_size=128, max_bytes=1 << 18) as reader:
+    assert np.array_equal(reader.get_patch(slide, 10, 20, 64), pixels[20 : 84, 10 : 74])
+    assert reader.stats()['slide_bytes'] == 600 * 500 * 3
+
+  assert 'Warning: slide.tif is compressed' in capsys.readouterr().out
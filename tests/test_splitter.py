@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import subprocess
+
+__author__ = 'Nico Curti'
+__email__ = 'nico.curti2@unibo.it'
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from synthetic import makedataset
+
+
+def test_documented_command_line (tmp_path):
+  '''
+  The boolean options are written as in the README (--rle True, ...)
+  '''
+  slide, roi = makedataset(str(tmp_path), width=512, height=384, ncontours=4, nvertices=64)
+
+  command = [sys.executable, '-m', 'SlideSeg.splitter',
+             '--image', slide, '--ann', os.path.dirname(roi) + os.sep, '--size', '64',
+             '--rle', 'True', '--plan', 'True', '--stats', 'True', '--profile', 'True',
+             '--save_all', 'FALSE', '--tags', 'yes']
+
+  env = dict(os.environ, PYTHONPATH=ROOT)
+  run = subprocess.run(command, cwd=str(tmp_path), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  assert run.returncode == 0, run.stderr.decode()
+
+  out_dir = os.path.join(os.path.dirname(slide), '1_output')
+  for filename in ('1_plan.npy', '1_statistics.json', '1.prof'):
+    assert os.path.isfile(os.path.join(out_dir, filename))
+
+  assert os.path.isfile(os.path.join(str(tmp_path), 'output', 'textfiles', '1_Details.txt'))